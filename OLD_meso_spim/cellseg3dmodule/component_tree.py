@@ -0,0 +1,110 @@
+import logging
+
+import numpy as np
+from numba import jit
+from skimage.morphology import max_tree
+
+logger = logging.getLogger(__name__)
+
+
+@jit(nopython=True)
+def _subtree_areas(parent, traverser):
+    areas = np.ones(parent.size, dtype=np.int64)
+    for i in range(len(traverser) - 1, 0, -1):
+        node = traverser[i]
+        areas[parent[node]] += areas[node]
+    return areas
+
+
+@jit(nopython=True)
+def _label_components(parent, traverser, flat, areas, cut, min_size, start):
+    # voxels traverser[start:] are exactly the ones with a value >= cut
+    labels = np.zeros(flat.size, dtype=np.int32)
+    next_label = 1
+    for i in range(start, len(traverser)):
+        node = traverser[i]
+        node_parent = parent[node]
+        if node_parent == node or flat[node_parent] < cut:
+            # highest node above threshold : root of a connected component
+            if areas[node] >= min_size:
+                labels[node] = next_label
+                next_label += 1
+        else:
+            labels[node] = labels[node_parent]
+    return labels
+
+
+class ComponentTree:
+    """Component tree (max-tree) of a probability map.
+
+    The tree is built once, after which the connected components of ``probabilities > threshold``
+    can be extracted for any threshold, with objects smaller than a given size removed,
+    without relabelling the whole volume. Each query only visits the voxels above the threshold.
+
+    The result is the same as ``remove_small_objects(label(probabilities > threshold), min_size)``
+    (with full connectivity), up to the order of the label ids.
+
+    Args:
+        probabilities (numpy.ndarray): foreground probability map
+        connectivity (int): maximum number of orthogonal steps to reach a neighbour. Default: None (full connectivity, as skimage.measure.label)
+    """
+
+    def __init__(self, probabilities, connectivity=None):
+        image = np.squeeze(np.asarray(probabilities))
+        if connectivity is None:
+            connectivity = image.ndim
+        self.shape = image.shape
+        self.flat = np.ascontiguousarray(image).ravel()
+
+        logger.debug(
+            f"Building component tree for image of shape {self.shape}"
+        )
+        parent, self.traverser = max_tree(image, connectivity=connectivity)
+        self.parent = parent.ravel()
+        self.areas = _subtree_areas(self.parent, self.traverser)
+        # the traverser is ordered by increasing value, voxels above a threshold are a suffix of it
+        self._levels = self.flat[self.traverser]
+
+    def label(self, threshold, min_size=0):
+        """Connected components above threshold, without objects smaller than min_size.
+
+        Args:
+            threshold (float): threshold of foreground
+            min_size (int): objects with fewer voxels are removed. Default: 0
+
+        Returns:
+            numpy.ndarray: int32 instance labels, sequential
+        """
+        start = self._first_above(threshold)
+        if start == len(self._levels):
+            return np.zeros(self.shape, dtype=np.int32)
+        labels = _label_components(
+            self.parent,
+            self.traverser,
+            self.flat,
+            self.areas,
+            self._levels[start],
+            min_size,
+            start,
+        )
+        return labels.reshape(self.shape)
+
+    def _first_above(self, threshold):
+        """Position in the traverser of the first voxel with a value above threshold.
+
+        Compares with numpy's rules, so that the voxels selected are exactly those of ``probabilities > threshold``.
+        """
+        low, high = 0, len(self._levels)
+        while low < high:
+            mid = (low + high) // 2
+            if self._levels[mid] > threshold:
+                high = mid
+            else:
+                low = mid + 1
+        return low
+
+    def sweep(self, thresholds, min_sizes=(0,)):
+        """Yields ((threshold, min_size), labels) for every combination of parameters."""
+        for threshold in thresholds:
+            for min_size in min_sizes:
+                yield (threshold, min_size), self.label(threshold, min_size)
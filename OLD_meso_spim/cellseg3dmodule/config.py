@@ -26,6 +26,9 @@ MODEL_LIST = {
     "SwinUNetR": SwinUNetR,
 }
 
+# models whose get_output already applies a sigmoid, the others return logits
+PROBABILITY_OUTPUT_MODELS = ["SwinUNetR"]
+
 INSTANCE_SEGMENTATION_METHOD_LIST = {
     "Watershed": binary_watershed,
     "Connected components": binary_connected,
@@ -96,6 +99,12 @@ class Thresholding:
 class Zoom:
     enabled: bool = False
     zoom_values: Optional[List[float]] = None
+    # tiled resampling : zoom output tiles in parallel instead of the whole volume at once
+    tiled: bool = False
+    tile_size: int = 64
+    num_workers: Optional[int] = None
+    # write tiled zoom output to a temporary memory-mapped file in results_path instead of memory
+    memmap: bool = True
 
 
 @dataclass
@@ -115,6 +124,32 @@ class PostProcessConfig:
     instance: InstanceSegConfig = InstanceSegConfig()
 
 
+@dataclass
+class SemanticStorageConfig:
+    """Storage of the semantic probability maps, see storage.PROBABILITY_CODECS for the maximum error of each codec."""
+
+    codec: str = "uint8"  # "uint8", "float16" or "float32"
+    compression: Optional[str] = "zlib"
+    tile: Optional[List[int]] = None  # (Y, X) tile shape to chunk each plane
+
+
+@dataclass
+class LabelStorageConfig:
+    """Storage of the instance labels. Labels are always saved with the smallest unsigned dtype, see storage.compact_labels."""
+
+    compression: Optional[str] = "zlib"  # lossless only
+    tile: Optional[List[int]] = None  # (Y, X) tile shape to chunk each plane
+
+
+@dataclass
+class SemanticEvaluationConfig:
+    """Evaluation of the semantic output against ground truth, see evaluate_semantic.run_evaluation."""
+
+    labels_path: Optional[str] = None  # semantic ground truth tif
+    thresholds: Optional[List[float]] = None  # None : default threshold range
+    chunk_size: int = 32  # planes evaluated at once
+
+
 ################
 # Inference configs
 
@@ -150,8 +185,11 @@ class InferenceWorkerConfig:
     compute_stats: bool = False
     post_process_config: PostProcessConfig = PostProcessConfig()
     sliding_window_config: SlidingWindowConfig = SlidingWindowConfig()
+    semantic_storage: SemanticStorageConfig = SemanticStorageConfig()
+    instance_storage: LabelStorageConfig = LabelStorageConfig()
 
     run_semantic_evaluation: bool = False
+    semantic_evaluation: SemanticEvaluationConfig = SemanticEvaluationConfig()
     run_instance_evaluation: bool = False
     compute_instance_boundaries: bool = False
     keep_boundary_predictions: bool = False
@@ -7,149 +7,61 @@ from skimage import io
 from tifffile import imwrite
 from tqdm import tqdm
 
-from matching import matching
-from post_processing import (
+from cellseg3dmodule.matching import matching
+from cellseg3dmodule.param_search import InstanceParamSearch
+from cellseg3dmodule.post_processing import (
     binary_watershed,
     binary_connected,
-    bc_connected,
     bc_watershed,
 )
-from utils import read_tiff_stack_labels, define_matplotlib_defaults
+from cellseg3dmodule.utils import (
+    read_tiff_stack_labels,
+    define_matplotlib_defaults,
+)
 
 define_matplotlib_defaults()
 
 
-def run_instance_evaluation(y_pred, method_name):
-    accuracy_list_all_thresh = []
-    params_list_all_thresh = []
-    for thresh in [0.2, 0.4, 0.6]:
-        if method_name == "Watershed":
-
-            def method(image, threshold_seed, size_small, threshold_object):
-                return binary_watershed(
-                    image, threshold_seed, size_small, threshold_object
-                )
-
-        elif method_name == "Connected components":
-
-            def method(image, threshold_seed, size_small):
-                return binary_connected(image, threshold_seed, size_small)
-
-        elif method_name == "bcwatershed":
-
-            def method(image, thresh1, thresh2, thresh3, size_small):
-                return bc_watershed(
-                    image, thresh1, thresh2, thresh3, size_small
-                )
-
-        elif method_name == "bcconnected":
+def run_instance_evaluation(
+    y_true,
+    y_pred,
+    method_name,
+    results_path=None,
+    n_workers=None,
+    halving=False,
+):
+    """Finds the best instance segmentation parameters of a method, see param_search.InstanceParamSearch.
 
-            def method(image, thresh1, thresh2, size_small):
-                return bc_connected(image, thresh1, thresh2, size_small)
-
-        else:
-            raise NotImplementedError(
-                "Selected instance segmentation method is not defined"
-            )
-        if method_name == "Watershed":
-            accuracy_list = []
-            params_list = []
-            for threshold_seed in tqdm(np.arange(0.85, 0.99, 0.01)):
-                for size_small in np.arange(12, 30, 5):
-                    for threshold_object in np.arange(0.2, 0.55, 0.1):
-                        instance_labels = method(
-                            y_pred,
-                            threshold_seed,
-                            size_small,
-                            threshold_object,
-                        )
-                        metrics = matching(
-                            y_true, instance_labels, thresh=thresh
-                        )
-                        accuracy_list.append(metrics.accuracy)
-                        params_list.append(
-                            {
-                                "threshold_seed": threshold_seed,
-                                "threshold_object": threshold_object,
-                                "size_small": size_small,
-                            }
-                        )
-        if method_name == "Connected components":
-            accuracy_list = []
-            params_list = []
-            for threshold_seed in tqdm(np.arange(0.4, 0.99, 0.02)):
-                for size_small in np.arange(3, 50, 2):
-                    instance_labels = method(
-                        y_pred, threshold_seed, size_small
-                    )
-                    metrics = matching(y_true, instance_labels, thresh=thresh)
-                    accuracy_list.append(metrics.accuracy)
-                    params_list.append(
-                        {
-                            "threshold_seed": threshold_seed,
-                            "size_small": size_small,
-                        }
-                    )
-        if method_name == "bcwatershed":
-            accuracy_list = []
-            params_list = []
-            for thresh1 in tqdm(np.arange(0.2, 0.99, 0.1)):
-                for thresh2 in np.arange(0.01, 0.6, 0.1):
-                    for thresh3 in np.arange(0.01, 0.6, 0.1):
-                        for size_small in np.arange(5, 25, 7):
-                            instance_labels = method(
-                                y_pred, thresh1, thresh2, thresh3, size_small
-                            )
-                            metrics = matching(
-                                y_true, instance_labels, thresh=thresh
-                            )
-                            accuracy_list.append(metrics.accuracy)
-                            params_list.append(
-                                {
-                                    "thresh1": thresh1,
-                                    "thresh2": thresh2,
-                                    "thresh3": thresh3,
-                                    "size_small": size_small,
-                                }
-                            )
-        if method_name == "bcconnected":
-            accuracy_list = []
-            params_list = []
-            for thresh1 in tqdm(np.arange(0.01, 0.99, 0.05)):
-                for thresh2 in np.arange(0.01, 0.99, 0.05):
-                    for size_small in np.arange(3, 25, 5):
-                        instance_labels = method(
-                            y_pred, thresh1, thresh2, size_small
-                        )
-                        metrics = matching(
-                            y_true, instance_labels, thresh=thresh
-                        )
-                        accuracy_list.append(metrics.accuracy)
-                        params_list.append(
-                            {
-                                "thresh1": thresh1,
-                                "thresh2": thresh2,
-                                "size_small": size_small,
-                            }
-                        )
-        accuracy_list_all_thresh.append(accuracy_list)
-        params_list_all_thresh.append(params_list)
-
-    average_accuracies = np.mean(accuracy_list_all_thresh, axis=0)
-    print(
-        f"Max accuracy per threshold is {np.max(accuracy_list_all_thresh, axis=1)}"
+    Args:
+        y_true: ground truth instance labels
+        y_pred: predicted probabilities
+        method_name: one of param_search.SEARCH_SPACES
+        results_path: json lines file used to persist finished points and resume the search
+        n_workers: number of processes. Default: None (one per cpu)
+        halving: use successive halving on sub-volumes instead of the full grid
+    """
+    search = InstanceParamSearch(
+        y_true,
+        y_pred,
+        thresholds=(0.2, 0.4, 0.6),
+        results_path=results_path,
+        n_workers=n_workers,
     )
-    best_params = params_list_all_thresh[0][np.argmax(average_accuracies)]
+    best_params, points = search.run(method_name, halving=halving)
+    accuracies = np.array([accuracy for _, accuracy in points])
+    print(f"Max accuracy per threshold is {np.max(accuracies, axis=0)}")
     print(f"Best params are {best_params}")
     return best_params
 
 
-# Load instance segmentation ground truth
-base_path = "/home/maximevidal/Documents/cell-segmentation-models"
-label_path = os.path.join(base_path, "data/validation_new_labels/c5labels.tif")
-y_true = read_tiff_stack_labels(label_path)
-
 if __name__ == "__main__":
+    # Load instance segmentation ground truth
+    base_path = "/home/maximevidal/Documents/cell-segmentation-models"
+    label_path = os.path.join(
+        base_path, "data/validation_new_labels/c5labels.tif"
+    )
+    y_true = read_tiff_stack_labels(label_path)
+
     find_best_params = True
     run_with_best_params = False
     plot_segmentation_performance = False
@@ -168,9 +80,16 @@ if __name__ == "__main__":
             "Connected components",
             "bcwatershed",
             "bcconnected",
-        ]:  # TODO(maxime) //ize this
+        ]:
             print(f"Current method is {method}")
-            best_params[method] = run_instance_evaluation(y_pred, method)
+            best_params[method] = run_instance_evaluation(
+                y_true,
+                y_pred,
+                method,
+                results_path=os.path.join(
+                    base_path, "results/instance_param_search.jsonl"
+                ),
+            )
         print(
             best_params
         )  # TODO(maxime) save as JSON so we don't have it as a dict of dicts
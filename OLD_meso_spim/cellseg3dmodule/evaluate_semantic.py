@@ -1,63 +1,192 @@
 import os
+from itertools import zip_longest
+from pathlib import Path
 
 import numpy as np
-
-from utils import read_tiff_stack_labels
 import matplotlib.pyplot as plt
-from skimage import io
+
+from cellseg3dmodule.storage import (
+    decode_probabilities,
+    iter_blocks,
+    read_codec,
+)
+
+EPS = np.finfo(float).eps
+
+
+def _confusion_counts(y_true, y_pred):
+    """Single pass (tp, fp, fn) of two binary masks, non-zero values being foreground."""
+    mask_true = np.asarray(y_true).astype(bool, copy=False)
+    mask_pred = np.asarray(y_pred).astype(bool, copy=False)
+    tp = np.count_nonzero(mask_true & mask_pred)
+    return (
+        tp,
+        np.count_nonzero(mask_pred) - tp,
+        np.count_nonzero(mask_true) - tp,
+    )
+
+
+def semantic_metrics(tp, fp, fn):
+    """IoU, precision, recall and F1 from confusion counts (scalars or arrays)."""
+    tp, fp, fn = (np.asarray(c, dtype=np.float64) for c in (tp, fp, fn))
+    metrics_precision = (tp + EPS) / (tp + fp + EPS)
+    metrics_recall = (tp + EPS) / (tp + fn + EPS)
+    return {
+        "iou": tp / np.maximum(tp + fp + fn, 1),
+        "precision": metrics_precision,
+        "recall": metrics_recall,
+        "f1": 2
+        * (
+            (metrics_precision * metrics_recall)
+            / (metrics_precision + metrics_recall + EPS)
+        ),
+    }
 
 
 # Run metrics
 def precision(y_true, y_pred):
-    mask_true = np.array(y_true, dtype="bool")
-    mask_pred = np.array(y_pred, dtype="bool")
-    true_positives = np.sum(np.round(np.clip(mask_true * mask_pred, 0, 1)))
-    predicted_positives = np.sum(np.round(np.clip(mask_pred, 0, 1)))
-    precision = (true_positives + np.finfo(float).eps) / (
-        predicted_positives + np.finfo(float).eps
-    )
-    return precision
+    tp, fp, fn = _confusion_counts(y_true, y_pred)
+    return semantic_metrics(tp, fp, fn)["precision"]
 
 
 def recall(y_true, y_pred):
-    mask_true = np.array(y_true, dtype="bool")
-    mask_pred = np.array(y_pred, dtype="bool")
-    true_positives = np.sum(np.round(np.clip(mask_true * mask_pred, 0, 1)))
-    actual_positives = np.sum(np.round(np.clip(mask_true, 0, 1)))
-    recall = (true_positives + np.finfo(float).eps) / (
-        actual_positives + np.finfo(float).eps
-    )
-    return recall
+    tp, fp, fn = _confusion_counts(y_true, y_pred)
+    return semantic_metrics(tp, fp, fn)["recall"]
 
 
 def f1_score(y_true, y_pred):
-    f1_precision = precision(y_true, y_pred)
-    f1_recall = recall(y_true, y_pred)
-    return 2 * (
-        (f1_precision * f1_recall)
-        / (f1_precision + f1_recall + np.finfo(float).eps)
-    )
+    tp, fp, fn = _confusion_counts(y_true, y_pred)
+    return semantic_metrics(tp, fp, fn)["f1"]
 
 
 def iou(f1):
     return f1 / (2 - f1)
 
 
-def iou_vs_threshold(prediction, target, threshold_range):
-    threshold_list = []
-    IoU_scores_list = []
+class SemanticEvaluator:
+    """Accumulates confusion counts of ``prediction > t`` for several thresholds t, block by block.
+
+    Each voxel is binned once by the number of thresholds it exceeds, separately for target
+    foreground and background. Confusion counts for all thresholds are then cumulative sums
+    of the two histograms, so a single pass over the volumes gives every metric at every threshold.
+    Comparisons are exactly those of ``prediction > t``.
+
+    Args:
+        thresholds (array-like): thresholds, in any order. Default: (0.5,), e.g. for binary predictions
+    """
+
+    def __init__(self, thresholds=(0.5,)):
+        self.thresholds = np.atleast_1d(
+            np.asarray(thresholds, dtype=np.float64)
+        )
+        self._order = np.argsort(self.thresholds, kind="stable")
+        self._sorted_thresholds = self.thresholds[self._order]
+        self.hist_foreground = np.zeros(
+            len(self.thresholds) + 1, dtype=np.int64
+        )
+        self.hist_background = np.zeros_like(self.hist_foreground)
+
+    def update(self, prediction, target):
+        """Adds a block of predictions and the corresponding block of ground truth (non-zero being foreground)."""
+        prediction = np.asarray(prediction)
+        target = np.asarray(target)
+        if prediction.shape != target.shape:
+            raise ValueError(
+                f"Prediction block {prediction.shape} and target block {target.shape} have different shapes"
+            )
+        # a voxel is above the k smallest thresholds, k = number of thresholds strictly below its value
+        bins = np.searchsorted(self._sorted_thresholds, prediction.ravel())
+        foreground = target.astype(bool, copy=False).ravel()
+        self.hist_foreground += np.bincount(
+            bins[foreground], minlength=len(self.hist_foreground)
+        )
+        self.hist_background += np.bincount(
+            bins[~foreground], minlength=len(self.hist_background)
+        )
+        return self
 
-    for threshold in threshold_range:
-        mask = prediction > threshold
+    def evaluate(self, prediction, target, chunk_size=32, codec=None):
+        """Adds two whole volumes, read chunk_size planes at a time, and returns :meth:`metrics`.
 
-        intersection = np.logical_and(target, mask)
-        union = np.logical_or(target, mask)
-        iou_score = np.sum(intersection) / np.sum(union)
+        Args:
+            prediction: predicted probabilities or binary masks, path to a multi-page tif or any array supporting slicing (numpy, memmap, dask...)
+            target: ground truth, same kinds of sources as prediction
+            chunk_size (int): number of planes processed at once. Default: 32
+            codec (str): codec of an encoded probability map, see storage.decode_probabilities. Default: None
+                (the codec recorded in the tif for paths, otherwise predictions are used as they are, e.g. masks)
 
-        threshold_list.append(threshold)
-        IoU_scores_list.append(iou_score)
+        Raises:
+            ValueError: if the volumes are empty or have a different number of planes
+        """
+        if codec is None and isinstance(prediction, (str, Path)):
+            codec = read_codec(prediction)
+        n_blocks = 0
+        for n_blocks, (prediction_block, target_block) in enumerate(
+            zip_longest(
+                iter_blocks(prediction, chunk_size),
+                iter_blocks(target, chunk_size),
+            ),
+            start=1,
+        ):
+            if prediction_block is None or target_block is None:
+                raise ValueError(
+                    "Prediction and target have a different number of planes"
+                )
+            if codec is not None:
+                prediction_block = decode_probabilities(
+                    prediction_block, codec
+                )
+            self.update(prediction_block, target_block)
+        if n_blocks == 0:
+            raise ValueError("Empty volumes cannot be evaluated")
+        return self.metrics()
 
-    return threshold_list, IoU_scores_list
+    def counts(self):
+        """Confusion counts (tp, fp, fn, tn) for each threshold, in the order of thresholds."""
+        total_foreground = self.hist_foreground.sum()
+        total_background = self.hist_background.sum()
+        # voxels in bins > k are above the k-th sorted threshold
+        tp = total_foreground - np.cumsum(self.hist_foreground)[:-1]
+        fp = total_background - np.cumsum(self.hist_background)[:-1]
+        unsort = np.argsort(self._order)
+        tp, fp = tp[unsort], fp[unsort]
+        return tp, fp, total_foreground - tp, total_background - fp
+
+    def metrics(self):
+        """All metrics for each threshold.
+
+        Returns:
+            dict: "threshold", "iou", "precision", "recall", "f1", "tp", "fp", "fn" and "tn" arrays, in the order of thresholds
+        """
+        tp, fp, fn, tn = self.counts()
+        return dict(
+            threshold=self.thresholds,
+            **semantic_metrics(tp, fp, fn),
+            tp=tp,
+            fp=fp,
+            fn=fn,
+            tn=tn,
+        )
+
+
+def threshold_curve(prediction, target, thresholds, chunk_size=32, codec=None):
+    """IoU, precision, recall and F1 of ``prediction > t`` for every threshold t, in a single pass.
+
+    See :class:`SemanticEvaluator`. Volumes are processed chunk_size planes at a time along their first axis.
+    Encoded probability maps are decoded with codec, see :meth:`SemanticEvaluator.evaluate`.
+
+    Returns:
+        dict: "threshold", "iou", "precision", "recall", "f1", "tp", "fp", "fn" and "tn" arrays, in the order of thresholds
+    """
+    return SemanticEvaluator(thresholds).evaluate(
+        prediction, target, chunk_size=chunk_size, codec=codec
+    )
+
+
+def iou_vs_threshold(prediction, target, threshold_range):
+    """IoU for every threshold, computed in a single pass with :func:`threshold_curve`."""
+    curve = threshold_curve(prediction, target, threshold_range)
+    return list(threshold_range), list(curve["iou"])
 
 
 def plot_threshold(threshold_list, IoU_scores_list):
@@ -69,45 +198,64 @@ def plot_threshold(threshold_list, IoU_scores_list):
     plt.show()
 
 
-def run_evaluation(y_pred):
-    threshold_range = np.arange(0.1, 0.3, 0.002)
-    threshold_list, IoU_scores_list = iou_vs_threshold(
-        y_pred, y_true, threshold_range
+DEFAULT_THRESHOLD_RANGE = np.arange(0.1, 0.3, 0.002)
+
+
+def run_evaluation(
+    y_pred,
+    y_true,
+    threshold_range=None,
+    chunk_size=32,
+    plot=True,
+    codec=None,
+):
+    """Finds the threshold with the best IoU and reports all metrics at that threshold.
+
+    All thresholds are evaluated in one blockwise pass, see :class:`SemanticEvaluator`.
+
+    Args:
+        y_pred: predicted probabilities, path to a multi-page tif or any array supporting slicing
+        y_true: semantic ground truth, same kinds of sources as y_pred
+        threshold_range (array-like): thresholds to evaluate. Default: None (DEFAULT_THRESHOLD_RANGE)
+        chunk_size (int): number of planes processed at once. Default: 32
+        plot (bool): show the IoU vs threshold curve. Default: True
+        codec (str): codec of y_pred if it is an encoded probability map (e.g. semantic_storage.codec), see :meth:`SemanticEvaluator.evaluate`
+
+    Returns:
+        dict: metrics at the best threshold
+    """
+    if threshold_range is None:
+        threshold_range = DEFAULT_THRESHOLD_RANGE
+    curve = threshold_curve(
+        y_pred, y_true, threshold_range, chunk_size, codec=codec
     )
-    print(IoU_scores_list)
-    thresh_arr = np.array(list(zip(threshold_list, IoU_scores_list)))
-    best_thresh = int(np.where(thresh_arr == np.max(thresh_arr[:, 1]))[0][0])
-    best_iou = IoU_scores_list[best_thresh]
+    print(curve["iou"].tolist())
+    best = int(np.argmax(curve["iou"]))
+    best_metrics = {name: values[best] for name, values in curve.items()}
     print(
         "Highest IoU is {:.4f} with a threshold of {}".format(
-            best_iou, threshold_range[best_thresh]
+            best_metrics["iou"], best_metrics["threshold"]
         )
     )
-    plot_threshold(threshold_list, IoU_scores_list)
-
-    y_pred = y_pred >= threshold_range[best_thresh]
-    cell_precision = precision(y_true, y_pred)
-    cell_recall = recall(y_true, y_pred)
-    cell_f1 = f1_score(y_true, y_pred)
-    cell_iou = iou(cell_f1)
-    print("IoU score is " + str(cell_iou))
-    print("F1 score is " + str(cell_f1))
-    print("Precision is " + str(cell_precision))
-    print("Recall is " + str(cell_recall))
-
-
-base_path = "/home/maximevidal/Documents/cell-segmentation-models"
-label_path = os.path.join(
-    base_path, "data/validation_labels_semantic/c5labels.tif"
-)
-y_true = read_tiff_stack_labels(label_path)
+    if plot:
+        plot_threshold(list(curve["threshold"]), list(curve["iou"]))
+
+    print("IoU score is " + str(best_metrics["iou"]))
+    print("F1 score is " + str(best_metrics["f1"]))
+    print("Precision is " + str(best_metrics["precision"]))
+    print("Recall is " + str(best_metrics["recall"]))
+    return best_metrics
+
 
 if __name__ == "__main__":
+    base_path = "/home/maximevidal/Documents/cell-segmentation-models"
+    label_path = os.path.join(
+        base_path, "data/validation_labels_semantic/c5labels.tif"
+    )
     # Load segmentation
     # seg_path = base_path + "/results/predicted-images/Prediction_1_c5images_Swin_2022_06_17_12_34_52_.tif"
     seg_path = os.path.join(
         base_path,
         "results/predicted-images/Prediction_1_c5images_SegResNet_2022_06_27_20_30_26_.tif",
     )
-    y_pred = read_tiff_stack_labels(seg_path)
-    run_evaluation(y_pred)
+    run_evaluation(seg_path, label_path)
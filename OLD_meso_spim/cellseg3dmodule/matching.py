@@ -1,19 +1,27 @@
+import os
+
 import numpy as np
 
 from numba import jit
 from tqdm import tqdm
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from skimage.measure import regionprops
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import zip_longest
+from multiprocessing import shared_memory
 from csbdeep.utils import _raise
 
-matching_criteria = dict()
+from cellseg3dmodule.relabel import label_are_sequential, relabel_sequential
+from cellseg3dmodule.storage import iter_blocks
 
+matching_criteria = dict()
+sparse_matching_criteria = dict()
 
-def label_are_sequential(y):
-    """returns true if y has only sequential labels from 1..."""
-    labels = np.unique(y)
-    return (set(labels) - {0}) == set(range(1, 1 + labels.max()))
+# matching switches to sparse overlaps when the dense overlap matrix would have more entries than this
+SPARSE_OVERLAP_MIN_ENTRIES = 2**24
 
 
 def is_array_of_integers(y):
@@ -58,6 +66,59 @@ def _label_overlap(x, y):
     return overlap
 
 
+def sparse_label_overlap(x, y, check=True):
+    """Overlap counts of the (x, y) label pairs that actually overlap.
+
+    Pairs are encoded as 64-bit keys and counted with a single np.unique, so memory
+    scales with the number of overlapping pairs instead of x.max() * y.max().
+
+    Returns:
+        tuple: (x_ids, y_ids, counts) of the overlapping foreground pairs, and the sizes of every x and y label (bincounts, background included)
+    """
+    if check:
+        _check_label_array(x, "x")
+        _check_label_array(y, "y")
+        x.shape == y.shape or _raise(
+            ValueError("x and y must have the same shape")
+        )
+    x = x.ravel()
+    y = y.ravel()
+    x_sizes = np.bincount(x)
+    y_sizes = np.bincount(y)
+    n_y = np.uint64(len(y_sizes))
+    foreground = (x > 0) & (y > 0)
+    keys = x[foreground].astype(np.uint64) * n_y + y[foreground].astype(
+        np.uint64
+    )
+    keys, counts = np.unique(keys, return_counts=True)
+    x_ids = (keys // n_y).astype(np.int64)
+    y_ids = (keys % n_y).astype(np.int64)
+    return x_ids, y_ids, counts, x_sizes, y_sizes
+
+
+def _sparse_iou(true_ids, pred_ids, counts, true_sizes, pred_sizes):
+    return _safe_divide(
+        counts, true_sizes[true_ids] + pred_sizes[pred_ids] - counts
+    )
+
+
+sparse_matching_criteria["iou"] = _sparse_iou
+
+
+def _sparse_iot(true_ids, pred_ids, counts, true_sizes, pred_sizes):
+    return _safe_divide(counts, true_sizes[true_ids])
+
+
+sparse_matching_criteria["iot"] = _sparse_iot
+
+
+def _sparse_iop(true_ids, pred_ids, counts, true_sizes, pred_sizes):
+    return _safe_divide(counts, pred_sizes[pred_ids])
+
+
+sparse_matching_criteria["iop"] = _sparse_iop
+
+
 def _safe_divide(x, y, eps=1e-10):
     """computes a safe divide which returns 0 if y is zero"""
     if np.isscalar(x) and np.isscalar(y):
@@ -122,7 +183,12 @@ def f1(tp, fp, fn):
 
 
 def matching(
-    y_true, y_pred, thresh=0.5, criterion="iou", report_matches=False
+    y_true,
+    y_pred,
+    thresh=0.5,
+    criterion="iou",
+    report_matches=False,
+    sparse=None,
 ):
     """Calculate detection/instance segmentation metrics between ground truth and predicted label images.
 
@@ -151,6 +217,12 @@ def matching(
         matching criterion (default IoU)
     report_matches: bool
         if True, additionally calculate matched_pairs and matched_scores (note, that this returns even gt-pred pairs whose scores are below  'thresh')
+    sparse: bool or None
+        if True, only the overlapping label pairs are stored and scored (see sparse_label_overlap),
+        instead of the dense (n_true + 1) x (n_pred + 1) overlap matrix, and the assignment is solved
+        on the sparse graph of pairs above the threshold (see matching_from_overlaps). The tp, fp and fn
+        are unchanged, but matched_pairs then only contains pairs with a score >= thresh.
+        If None (default), the sparse path is used when the dense matrix would have more than SPARSE_OVERLAP_MIN_ENTRIES entries.
 
     Returns
     -------
@@ -184,6 +256,32 @@ def matching(
     thresh = float(thresh) if np.isscalar(thresh) else map(float, thresh)
     y_true, map_for_true, map_rev_true = relabel_sequential(y_true)
     y_pred, map_for_pred, map_rev_pred = relabel_sequential(y_pred)
+    if sparse is None:
+        sparse = (len(map_rev_true) * len(map_rev_pred)) > (
+            SPARSE_OVERLAP_MIN_ENTRIES
+        )
+
+    if sparse:
+        (
+            true_ids,
+            pred_ids,
+            counts,
+            true_sizes,
+            pred_sizes,
+        ) = sparse_label_overlap(y_true, y_pred, check=False)
+        return matching_from_overlaps(
+            true_ids,
+            pred_ids,
+            counts,
+            true_sizes,
+            pred_sizes,
+            thresh=thresh,
+            criterion=criterion,
+            report_matches=report_matches,
+            true_labels=map_rev_true,
+            pred_labels=map_rev_pred,
+        )
+
     overlap = label_overlap(y_true, y_pred, check=False)
     scores = matching_criteria[criterion](overlap)
     assert 0 <= np.min(scores) <= np.max(scores) <= 1
@@ -195,74 +293,420 @@ def matching(
 
     def _single(thr):
         # not_trivial = n_matched > 0 and np.any(scores >= thr)
-        not_trivial = n_matched > 0
-        if not_trivial:
+        assignment = None
+        if n_matched > 0:
             # compute optimal matching with scores as tie-breaker
             costs = -(scores >= thr).astype(float) - scores / (2 * n_matched)
             true_ind, pred_ind = linear_sum_assignment(costs)
             assert n_matched == len(true_ind) == len(pred_ind)
-            match_ok = scores[true_ind, pred_ind] >= thr
-            tp = np.count_nonzero(match_ok)
+            assignment = true_ind, pred_ind, scores[true_ind, pred_ind]
+        return _matching_stats(
+            criterion,
+            thr,
+            n_true,
+            n_pred,
+            assignment,
+            report_matches,
+            map_rev_true,
+            map_rev_pred,
+        )
+
+    return (
+        _single(thresh) if np.isscalar(thresh) else tuple(map(_single, thresh))
+    )
+
+
+def matching_from_overlaps(
+    true_ids,
+    pred_ids,
+    counts,
+    true_sizes,
+    pred_sizes,
+    thresh=0.5,
+    criterion="iou",
+    report_matches=False,
+    true_labels=None,
+    pred_labels=None,
+):
+    """Matching metrics computed from sparse overlap counts instead of label images.
+
+    Only the pairs whose score is above the threshold are assigned (see :func:`sparse_assignment`),
+    which gives the same tp, fp and fn as the dense assignment of :func:`matching`.
+    With report_matches, matched_pairs only contains these candidate pairs.
+
+    Parameters
+    ----------
+    true_ids, pred_ids: ndarray
+        indices (>= 1) of the overlapping foreground label pairs, as returned by sparse_label_overlap
+    counts: ndarray
+        number of voxels shared by each pair
+    true_sizes, pred_sizes: ndarray
+        number of voxels of each label index, background (index 0) first
+    true_labels, pred_labels: ndarray
+        original label id of each index, used in matched_pairs. Default: None (the indices themselves)
+
+    Returns
+    -------
+    Matching object (or tuple of them for several thresholds), as :func:`matching`
+    """
+    criterion in sparse_matching_criteria or _raise(
+        ValueError("Matching criterion '%s' not supported." % criterion)
+    )
+    if thresh is None:
+        thresh = 0
+    thresh = (
+        float(thresh) if np.isscalar(thresh) else tuple(map(float, thresh))
+    )
+    true_ids = np.asarray(true_ids, dtype=np.int64)
+    pred_ids = np.asarray(pred_ids, dtype=np.int64)
+    true_sizes = np.asarray(true_sizes)
+    pred_sizes = np.asarray(pred_sizes)
+    if true_labels is None:
+        true_labels = np.arange(len(true_sizes))
+    if pred_labels is None:
+        pred_labels = np.arange(len(pred_sizes))
+
+    pair_scores = sparse_matching_criteria[criterion](
+        true_ids, pred_ids, np.asarray(counts), true_sizes, pred_sizes
+    )
+    assert np.all((0 <= pair_scores) & (pair_scores <= 1))
+    # ignoring background
+    n_true, n_pred = len(true_sizes) - 1, len(pred_sizes) - 1
+    n_matched = min(n_true, n_pred)
+
+    def _single(thr):
+        assignment = None
+        if n_matched > 0:
+            true_ind, pred_ind, matched_scores = sparse_assignment(
+                true_ids - 1, pred_ids - 1, pair_scores, thr, n_matched
+            )
+            assignment = true_ind, pred_ind, matched_scores
+        return _matching_stats(
+            criterion,
+            thr,
+            n_true,
+            n_pred,
+            assignment,
+            report_matches,
+            true_labels,
+            pred_labels,
+        )
+
+    return (
+        _single(thresh) if np.isscalar(thresh) else tuple(map(_single, thresh))
+    )
+
+
+def sparse_assignment(true_ind, pred_ind, pair_scores, thresh, n_matched):
+    """Optimal assignment between labels, using only the candidate pairs with a score >= thresh.
+
+    Candidate pairs form a sparse bipartite graph, and each of its connected components
+    is solved independently : components made of a single pair are matched directly, the
+    others with ``linear_sum_assignment`` on the (small) dense matrix of the component.
+    As in :func:`matching`, the number of matched pairs is maximised first (for thresh > 0)
+    and scores are used as tie-breaker, so the number of true positives is the same.
+
+    Parameters
+    ----------
+    true_ind, pred_ind: ndarray
+        label indices of each pair
+    pair_scores: ndarray
+        score of each pair
+    thresh: float
+        threshold of the matching criterion
+    n_matched: int
+        maximal number of matches, min(n_true, n_pred), used to scale the tie-breaker
+
+    Returns
+    -------
+    tuple: true_ind, pred_ind and scores of the assigned pairs, sorted by true_ind
+    """
+    candidates = pair_scores >= thresh
+    true_ind = true_ind[candidates]
+    pred_ind = pred_ind[candidates]
+    pair_scores = pair_scores[candidates]
+    if len(pair_scores) == 0:
+        return true_ind, pred_ind, pair_scores
+
+    rows, row_ind = np.unique(true_ind, return_inverse=True)
+    cols, col_ind = np.unique(pred_ind, return_inverse=True)
+    n_nodes = len(rows) + len(cols)
+    graph = coo_matrix(
+        (np.ones(len(pair_scores)), (row_ind, len(rows) + col_ind)),
+        shape=(n_nodes, n_nodes),
+    )
+    _, components = connected_components(graph, directed=False)
+    pair_components = components[row_ind]
+    order = np.argsort(pair_components, kind="stable")
+    bounds = np.append(
+        np.flatnonzero(np.diff(pair_components[order], prepend=-1)),
+        len(order),
+    )
+    # every candidate pair counts as one match, its score breaks ties
+    weights = pair_scores / (2 * n_matched) + (1.0 if thresh > 0 else 0.0)
+
+    single = np.diff(bounds) == 1
+    assigned = [order[bounds[:-1][single]]]
+    for start, end in zip(bounds[:-1][~single], bounds[1:][~single]):
+        pairs = order[start:end]
+        _, sub_rows = np.unique(row_ind[pairs], return_inverse=True)
+        _, sub_cols = np.unique(col_ind[pairs], return_inverse=True)
+        shape = (sub_rows.max() + 1, sub_cols.max() + 1)
+        costs = np.zeros(shape)
+        costs[sub_rows, sub_cols] = -weights[pairs]
+        pair_lookup = np.full(shape, -1, dtype=np.int64)
+        pair_lookup[sub_rows, sub_cols] = pairs
+        component_pairs = pair_lookup[linear_sum_assignment(costs)]
+        # rows assigned to a non-candidate (zero cost) column are unmatched
+        assigned.append(component_pairs[component_pairs >= 0])
+    assigned = np.concatenate(assigned)
+    assigned = assigned[np.argsort(true_ind[assigned], kind="stable")]
+    return true_ind[assigned], pred_ind[assigned], pair_scores[assigned]
+
+
+def _matching_stats(
+    criterion,
+    thr,
+    n_true,
+    n_pred,
+    assignment,
+    report_matches,
+    true_labels,
+    pred_labels,
+):
+    """Builds the Matching result of a threshold from an assignment (None if there is nothing to match)."""
+    not_trivial = assignment is not None
+    if not_trivial:
+        true_ind, pred_ind, matched_scores = assignment
+        match_ok = matched_scores >= thr
+        # with thr <= 0 every assignable pair is a match, including non-overlapping ones
+        tp = min(n_true, n_pred) if thr <= 0 else np.count_nonzero(match_ok)
+    else:
+        tp = 0
+    fp = n_pred - tp
+    fn = n_true - tp
+    # assert tp+fp == n_pred
+    # assert tp+fn == n_true
+
+    # the score sum over all matched objects (tp)
+    sum_matched_score = (
+        np.sum(matched_scores[match_ok]) if not_trivial else 0.0
+    )
 
+    # the score average over all matched objects (tp)
+    mean_matched_score = _safe_divide(sum_matched_score, tp)
+    # the score average over all gt/true objects
+    mean_true_score = _safe_divide(sum_matched_score, n_true)
+    panoptic_quality = _safe_divide(sum_matched_score, tp + fp / 2 + fn / 2)
+
+    stats_dict = dict(
+        criterion=criterion,
+        thresh=thr,
+        fp=fp,
+        tp=tp,
+        fn=fn,
+        precision=precision(tp, fp, fn),
+        recall=recall(tp, fp, fn),
+        accuracy=accuracy(tp, fp, fn),
+        f1=f1(tp, fp, fn),
+        n_true=n_true,
+        n_pred=n_pred,
+        mean_true_score=mean_true_score,
+        mean_matched_score=mean_matched_score,
+        panoptic_quality=panoptic_quality,
+    )
+    if bool(report_matches):
+        if not_trivial:
+            stats_dict.update(
+                # int() to be json serializable
+                matched_pairs=tuple(
+                    (int(true_labels[i]), int(pred_labels[j]))
+                    for i, j in zip(1 + true_ind, 1 + pred_ind)
+                ),
+                matched_scores=tuple(matched_scores),
+                matched_tps=tuple(map(int, np.flatnonzero(match_ok))),
+            )
         else:
-            tp = 0
-        fp = n_pred - tp
-        fn = n_true - tp
-        # assert tp+fp == n_pred
-        # assert tp+fn == n_true
-
-        # the score sum over all matched objects (tp)
-        sum_matched_score = (
-            np.sum(scores[true_ind, pred_ind][match_ok])
-            if not_trivial
-            else 0.0
+            stats_dict.update(
+                matched_pairs=(),
+                matched_scores=(),
+                matched_tps=(),
+            )
+    return namedtuple("Matching", stats_dict.keys())(*stats_dict.values())
+
+
+class OverlapAccumulator:
+    """Accumulates sparse label overlaps block by block, to match volumes that do not fit in memory.
+
+    Each block only contributes the (true, pred) pairs and label sizes it contains, encoded as
+    64-bit keys (label ids must be < 2**32). Pending blocks are merged once their number of entries
+    exceeds merge_size, so that memory scales with the number of overlapping pairs.
+    Since labels are counted over all blocks, objects spanning several blocks are matched as a whole.
+
+    Args:
+        merge_size (int): number of pending entries above which accumulated counts are merged. Default: 2**22
+    """
+
+    def __init__(self, merge_size=2**22):
+        self.merge_size = merge_size
+        self.n_voxels = 0
+        self._pending = {"pairs": [], "true": [], "pred": []}
+
+    @staticmethod
+    def _count(keys):
+        keys, counts = np.unique(keys, return_counts=True)
+        return keys, counts.astype(np.int64)
+
+    @staticmethod
+    def _merge(counted):
+        keys = np.concatenate([k for k, _ in counted])
+        counts = np.concatenate([c for _, c in counted])
+        keys, inverse = np.unique(keys, return_inverse=True)
+        return keys, np.bincount(inverse.ravel(), weights=counts).astype(
+            np.int64
+        )
+
+    def update(self, y_true, y_pred):
+        """Adds the overlaps of a pair of corresponding label blocks."""
+        y_true = np.asarray(y_true)
+        y_pred = np.asarray(y_pred)
+        _check_label_array(y_true, "y_true")
+        _check_label_array(y_pred, "y_pred")
+        y_true.shape == y_pred.shape or _raise(
+            ValueError(
+                f"y_true ({y_true.shape}) and y_pred ({y_pred.shape}) blocks have different shapes"
+            )
         )
+        if y_true.size == 0:
+            return self
+        max(y_true.max(), y_pred.max()) < 2**32 or _raise(
+            ValueError("label ids must be smaller than 2**32")
+        )
+        y_true = y_true.ravel().astype(np.uint64)
+        y_pred = y_pred.ravel().astype(np.uint64)
+        self.n_voxels += y_true.size
+
+        foreground = (y_true > 0) & (y_pred > 0)
+        pairs = (y_true[foreground] << np.uint64(32)) | y_pred[foreground]
+        self._pending["pairs"].append(self._count(pairs))
+        self._pending["true"].append(self._count(y_true[y_true > 0]))
+        self._pending["pred"].append(self._count(y_pred[y_pred > 0]))
+
+        n_pending = sum(
+            len(k) for counted in self._pending.values() for k, _ in counted
+        )
+        if n_pending > self.merge_size:
+            self._pending = {
+                name: [self._merge(counted)]
+                for name, counted in self._pending.items()
+            }
+        return self
+
+    def overlaps(self):
+        """Sparse overlaps of all blocks added so far.
+
+        Returns:
+            tuple: (true_ids, pred_ids, counts, true_sizes, pred_sizes, true_labels, pred_labels),
+            ids being indices into the sizes and labels arrays (index 0 is the background), see :func:`matching_from_overlaps`
+        """
+        empty = (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+        merged = {
+            name: self._merge(counted + [empty])
+            for name, counted in self._pending.items()
+        }
+        self._pending = {name: [m] for name, m in merged.items()}
+
+        true_labels, true_sizes = merged["true"]
+        pred_labels, pred_sizes = merged["pred"]
+        pair_keys, counts = merged["pairs"]
+        pair_true = pair_keys >> np.uint64(32)
+        pair_pred = pair_keys & np.uint64(2**32 - 1)
+        true_ids = 1 + np.searchsorted(true_labels, pair_true)
+        pred_ids = 1 + np.searchsorted(pred_labels, pair_pred)
+
+        def with_background(labels, sizes):
+            return (
+                np.concatenate([[self.n_voxels - sizes.sum()], sizes]),
+                np.concatenate([[0], labels]).astype(np.int64),
+            )
 
-        # the score average over all matched objects (tp)
-        mean_matched_score = _safe_divide(sum_matched_score, tp)
-        # the score average over all gt/true objects
-        mean_true_score = _safe_divide(sum_matched_score, n_true)
-        panoptic_quality = _safe_divide(
-            sum_matched_score, tp + fp / 2 + fn / 2
+        true_sizes, true_labels = with_background(true_labels, true_sizes)
+        pred_sizes, pred_labels = with_background(pred_labels, pred_sizes)
+        return (
+            true_ids,
+            pred_ids,
+            counts,
+            true_sizes,
+            pred_sizes,
+            true_labels,
+            pred_labels,
         )
 
-        stats_dict = dict(
+    def matching(self, thresh=0.5, criterion="iou", report_matches=False):
+        """Matching metrics of all blocks added so far, see :func:`matching_from_overlaps`."""
+        (
+            true_ids,
+            pred_ids,
+            counts,
+            true_sizes,
+            pred_sizes,
+            true_labels,
+            pred_labels,
+        ) = self.overlaps()
+        return matching_from_overlaps(
+            true_ids,
+            pred_ids,
+            counts,
+            true_sizes,
+            pred_sizes,
+            thresh=thresh,
             criterion=criterion,
-            thresh=thr,
-            fp=fp,
-            tp=tp,
-            fn=fn,
-            precision=precision(tp, fp, fn),
-            recall=recall(tp, fp, fn),
-            accuracy=accuracy(tp, fp, fn),
-            f1=f1(tp, fp, fn),
-            n_true=n_true,
-            n_pred=n_pred,
-            mean_true_score=mean_true_score,
-            mean_matched_score=mean_matched_score,
-            panoptic_quality=panoptic_quality,
+            report_matches=report_matches,
+            true_labels=true_labels,
+            pred_labels=pred_labels,
         )
-        if bool(report_matches):
-            if not_trivial:
-                stats_dict.update(
-                    # int() to be json serializable
-                    matched_pairs=tuple(
-                        (int(map_rev_true[i]), int(map_rev_pred[j]))
-                        for i, j in zip(1 + true_ind, 1 + pred_ind)
-                    ),
-                    matched_scores=tuple(scores[true_ind, pred_ind]),
-                    matched_tps=tuple(map(int, np.flatnonzero(match_ok))),
-                )
-            else:
-                stats_dict.update(
-                    matched_pairs=(),
-                    matched_scores=(),
-                    matched_tps=(),
-                )
-        return namedtuple("Matching", stats_dict.keys())(*stats_dict.values())
 
-    return (
-        _single(thresh) if np.isscalar(thresh) else tuple(map(_single, thresh))
+
+def matching_blockwise(
+    y_true,
+    y_pred,
+    thresh=0.5,
+    criterion="iou",
+    report_matches=False,
+    block_size=16,
+    show_progress=True,
+):
+    """Matching metrics of two label volumes read block by block along their first axis.
+
+    Neither volume is ever fully loaded : only the sparse overlaps and label sizes are kept
+    (see OverlapAccumulator), then the matching is finished with :func:`matching_from_overlaps`.
+    The result is the same as ``matching(y_true, y_pred, ..., sparse=True)``.
+
+    Parameters
+    ----------
+    y_true, y_pred: array-like or str
+        label volumes, either paths to multi-page tif files or arrays supporting slicing (numpy, memmap, dask, zarr...)
+    thresh, criterion, report_matches:
+        see :func:`matching`
+    block_size: int
+        number of planes read at once (default 16)
+    show_progress: bool
+        display a progress bar over blocks
+    """
+    accumulator = OverlapAccumulator()
+    for block_true, block_pred in tqdm(
+        zip_longest(
+            iter_blocks(y_true, block_size),
+            iter_blocks(y_pred, block_size),
+        ),
+        disable=not bool(show_progress),
+    ):
+        (block_true is not None and block_pred is not None) or _raise(
+            ValueError("y_true and y_pred have a different number of planes")
+        )
+        accumulator.update(block_true, block_pred)
+    return accumulator.matching(
+        thresh=thresh, criterion=criterion, report_matches=report_matches
     )
 
 
@@ -274,6 +718,7 @@ def matching_dataset(
     by_image=False,
     show_progress=True,
     parallel=False,
+    n_workers=None,
 ):
     """matching metrics for list of images, see `stardist.matching.matching`"""
     len(y_true) == len(y_pred) or _raise(
@@ -286,9 +731,85 @@ def matching_dataset(
         by_image=by_image,
         show_progress=show_progress,
         parallel=parallel,
+        n_workers=n_workers,
     )
 
 
+def _to_shared_memory(array):
+    """Copies an array to a new shared memory block, returns the block and its (name, shape, dtype) descriptor."""
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _matching_shared_memory(descriptors, thresh, criterion):
+    """Process pool task : matches label images read from shared memory blocks."""
+    blocks = [
+        shared_memory.SharedMemory(name=name) for name, _, _ in descriptors
+    ]
+    try:
+        labels = [
+            np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            for shm, (_, shape, dtype) in zip(blocks, descriptors)
+        ]
+        stats = matching(
+            *labels, thresh=thresh, criterion=criterion, report_matches=False
+        )
+        # Matching namedtuples are created dynamically and cannot be pickled
+        return tuple(s._asdict() for s in stats)
+    finally:
+        # views on the buffers must be released before closing the blocks
+        labels = None
+        for shm in blocks:
+            shm.close()
+
+
+def _matching_processes(y_gen, thresh, criterion, n_workers=None):
+    """Yields the matching of each (y_true, y_pred) pair, in order, computed in a process pool.
+
+    Label images are copied once to shared memory, which workers map without pickling the arrays.
+    At most two tasks per worker are in flight, so that only a bounded number of images are held in memory.
+    """
+    max_in_flight = 2 * (n_workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        in_flight = deque()
+
+        def _finish_oldest():
+            future, blocks = in_flight.popleft()
+            try:
+                return tuple(
+                    namedtuple("Matching", d.keys())(*d.values())
+                    for d in future.result()
+                )
+            finally:
+                for shm in blocks:
+                    shm.close()
+                    shm.unlink()
+
+        try:
+            for y_true, y_pred in y_gen:
+                shared = [_to_shared_memory(y) for y in (y_true, y_pred)]
+                future = pool.submit(
+                    _matching_shared_memory,
+                    [descriptor for _, descriptor in shared],
+                    thresh,
+                    criterion,
+                )
+                in_flight.append((future, [shm for shm, _ in shared]))
+                if len(in_flight) >= max_in_flight:
+                    yield _finish_oldest()
+            while in_flight:
+                yield _finish_oldest()
+        finally:
+            while in_flight:
+                future, blocks = in_flight.popleft()
+                future.cancel()
+                for shm in blocks:
+                    shm.close()
+                    shm.unlink()
+
+
 def matching_dataset_lazy(
     y_gen,
     thresh=0.5,
@@ -296,7 +817,14 @@ def matching_dataset_lazy(
     by_image=False,
     show_progress=True,
     parallel=False,
+    n_workers=None,
 ):
+    """matching metrics for an iterable of (y_true, y_pred) pairs, see `matching_dataset`.
+
+    parallel can be False, True or "thread" (thread pool), or "process" : pairs are then
+    matched in a process pool, label images being passed through shared memory instead of pickled
+    (see _matching_processes). n_workers sets the number of threads or processes.
+    """
     expected_keys = set(
         (
             "fp",
@@ -327,13 +855,17 @@ def matching_dataset_lazy(
         tqdm_kwargs["total"] = int(show_progress)
 
     # compute matching stats for every pair of label images
-    if parallel:
-        from concurrent.futures import ThreadPoolExecutor
-
+    if parallel == "process":
+        stats_all = tuple(
+            _matching_processes(
+                tqdm(y_gen, **tqdm_kwargs), thresh, criterion, n_workers
+            )
+        )
+    elif parallel:
         fn = lambda pair: matching(
             *pair, thresh=thresh, criterion=criterion, report_matches=False
         )
-        with ThreadPoolExecutor() as pool:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
             stats_all = tuple(pool.map(fn, tqdm(y_gen, **tqdm_kwargs)))
     else:
         stats_all = tuple(
@@ -409,103 +941,18 @@ def matching_dataset_lazy(
     return accumulate[0] if single_thresh else accumulate
 
 
-# copied from scikit-image master for now (remove when part of a release)
-def relabel_sequential(label_field, offset=1):
-    """Relabel arbitrary labels to {`offset`, ... `offset` + number_of_labels}.
-
-    This function also returns the forward map (mapping the original labels to
-    the reduced labels) and the inverse map (mapping the reduced labels back
-    to the original ones).
-
-    Parameters
-    ----------
-    label_field : numpy array of int, arbitrary shape
-        An array of labels, which must be non-negative integers.
-    offset : int, optional
-        The return labels will start at `offset`, which should be
-        strictly positive.
-
-    Returns
-    -------
-    relabeled : numpy array of int, same shape as `label_field`
-        The input label field with labels mapped to
-        {offset, ..., number_of_labels + offset - 1}.
-        The data type will be the same as `label_field`, except when
-        offset + number_of_labels causes overflow of the current data type.
-    forward_map : numpy array of int, shape ``(label_field.max() + 1,)``
-        The map from the original label space to the returned label
-        space. Can be used to re-apply the same mapping. See examples
-        for usage. The data type will be the same as `relabeled`.
-    inverse_map : 1D numpy array of int, of length offset + number of labels
-        The map from the new label space to the original space. This
-        can be used to reconstruct the original label field from the
-        relabeled one. The data type will be the same as `relabeled`.
-
-    Notes
-    -----
-    The label 0 is assumed to denote the background and is never remapped.
-
-    The forward map can be extremely big for some inputs, since its
-    length is given by the maximum of the label field. However, in most
-    situations, ``label_field.max()`` is much smaller than
-    ``label_field.size``, and in these cases the forward map is
-    guaranteed to be smaller than either the input or output images.
-
-    Examples
-    --------
-    >>> from skimage.segmentation import relabel_sequential
-    >>> label_field = np.array([1, 1, 5, 5, 8, 99, 42])
-    >>> relab, fw, inv = relabel_sequential(label_field)
-    >>> relab
-    array([1, 1, 2, 2, 3, 5, 4])
-    >>> fw
-    array([0, 1, 0, 0, 0, 2, 0, 0, 3, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-           0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 4, 0,
-           0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-           0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-           0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 5])
-    >>> inv
-    array([ 0,  1,  5,  8, 42, 99])
-    >>> (fw[label_field] == relab).all()
-    True
-    >>> (inv[relab] == label_field).all()
-    True
-    >>> relab, fw, inv = relabel_sequential(label_field, offset=5)
-    >>> relab
-    array([5, 5, 6, 6, 7, 9, 8])
-    """
-    offset = int(offset)
-    if offset <= 0:
-        raise ValueError("Offset must be strictly positive.")
-    if np.min(label_field) < 0:
-        raise ValueError("Cannot relabel array that contains negative values.")
-    max_label = int(label_field.max())  # Ensure max_label is an integer
-    if not np.issubdtype(label_field.dtype, np.integer):
-        new_type = np.min_scalar_type(max_label)
-        label_field = label_field.astype(new_type)
-    labels = np.unique(label_field)
-    labels0 = labels[labels != 0]
-    new_max_label = offset - 1 + len(labels0)
-    new_labels0 = np.arange(offset, new_max_label + 1)
-    output_type = label_field.dtype
-    required_type = np.min_scalar_type(new_max_label)
-    if np.dtype(required_type).itemsize > np.dtype(label_field.dtype).itemsize:
-        output_type = required_type
-    forward_map = np.zeros(max_label + 1, dtype=output_type)
-    forward_map[labels0] = new_labels0
-    inverse_map = np.zeros(new_max_label + 1, dtype=output_type)
-    inverse_map[offset:] = labels0
-    relabeled = forward_map[label_field]
-    return relabeled, forward_map, inverse_map
-
-
-def group_matching_labels(ys, thresh=1e-10, criterion="iou"):
+def group_matching_labels(ys, thresh=1e-10, criterion="iou", n_workers=None):
     """
     Group matching objects (i.e. assign the same label id) in a
     list of label images (e.g. consecutive frames of a time-lapse).
 
-    Uses function `matching` (with provided `criterion` and `thresh`) to
-    iteratively/greedily match and group objects/labels in consecutive images of `ys`.
+    Matches objects (with provided `criterion` and `thresh`) in consecutive images of `ys`,
+    and groups them iteratively/greedily along the sequence.
+    The sparse overlaps and assignment (see sparse_assignment) of every pair of consecutive images
+    are computed in parallel threads, then group ids are propagated label by label and each image
+    is remapped with a lookup table. Only pairs with a score >= thresh can be grouped, so thresh should be > 0.
+    Objects with several equally good matches may be grouped differently than by matching each image
+    with the previously grouped one, as ties are broken by label order.
     To that end, matching objects are grouped together by assigning the same label id,
     whereas unmatched objects are assigned a new label id.
     At the end of this process, each label group will have been assigned a unique id.
@@ -529,6 +976,8 @@ def group_matching_labels(ys, thresh=1e-10, criterion="iou"):
     ----------
     ys : np.ndarray or list/tuple of np.ndarray
         list/array of integer labels (2D or 3D)
+    n_workers : int
+        number of threads used to match consecutive images (default: None, as many as the executor allows)
 
     """
     # check 'ys' without making a copy
@@ -548,29 +997,56 @@ def group_matching_labels(ys, thresh=1e-10, criterion="iou"):
         )
         ys_grouped = np.empty((len(ys),) + ys[0].shape, dtype=np.int32)
 
-    def _match_single(y_prev, y, next_id):
-        y = y.astype(np.int32, copy=False)
-        res = matching(
-            y_prev, y, report_matches=True, thresh=thresh, criterion=criterion
-        )
-        # relabel dict (for matching labels) that maps label ids from y -> y_prev
-        relabel = dict(reversed(res.matched_pairs[i]) for i in res.matched_tps)
-        y_grouped = np.zeros_like(y)
-        for r in regionprops(y):
-            m = y[r.slice] == r.label
-            if r.label in relabel:
-                y_grouped[r.slice][m] = relabel[r.label]
-            else:
-                y_grouped[r.slice][m] = next_id
-                next_id += 1
-        return y_grouped, next_id
-
-    ys_grouped[0] = ys[0]
-    next_id = ys_grouped[0].max() + 1
-    for i in range(len(ys) - 1):
-        ys_grouped[i + 1], next_id = _match_single(
-            ys_grouped[i], ys[i + 1], next_id
+    criterion in sparse_matching_criteria or _raise(
+        ValueError("Matching criterion '%s' not supported." % criterion)
+    )
+
+    def _relabel(i):
+        # each image is relabelled once and shared by its two neighbouring pairs
+        labels, _, inverse_map = relabel_sequential(np.asarray(ys[i]))
+        return labels, inverse_map
+
+    def _match_pair(i):
+        """Index of the matched label of image i for each label index of image i + 1 (0 if unmatched)."""
+        (
+            true_ids,
+            pred_ids,
+            counts,
+            true_sizes,
+            pred_sizes,
+        ) = sparse_label_overlap(relabeled[i], relabeled[i + 1], check=False)
+        pair_scores = sparse_matching_criteria[criterion](
+            true_ids, pred_ids, counts, true_sizes, pred_sizes
         )
+        matched = np.zeros(len(pred_sizes), dtype=np.int64)
+        n_matched = min(len(true_sizes), len(pred_sizes)) - 1
+        if n_matched > 0:
+            true_ind, pred_ind, _ = sparse_assignment(
+                true_ids, pred_ids, pair_scores, thresh, n_matched
+            )
+            matched[pred_ind] = true_ind
+        return matched
+
+    # overlaps and assignments of all consecutive pairs are independent
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        relabeled, inverse_maps = zip(*pool.map(_relabel, range(len(ys))))
+        matches = list(pool.map(_match_pair, range(len(ys) - 1)))
+
+    # propagate group ids along the sequence, one value per label
+    group_ids = [inverse_maps[0].astype(np.int32)]
+    next_id = int(inverse_maps[0].max()) + 1
+    for matched in matches:
+        ids = np.zeros(len(matched), dtype=np.int32)
+        is_matched = matched > 0
+        ids[is_matched] = group_ids[-1][matched[is_matched]]
+        # unmatched objects get new ids in increasing label order
+        new = np.flatnonzero(~is_matched[1:]) + 1
+        ids[new] = next_id + np.arange(len(new))
+        next_id += len(new)
+        group_ids.append(ids)
+
+    for i, (ids, labels) in enumerate(zip(group_ids, relabeled)):
+        ys_grouped[i] = ids[labels]
     return ys_grouped
 
 
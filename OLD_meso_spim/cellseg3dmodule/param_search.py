@@ -0,0 +1,284 @@
+import json
+import logging
+import math
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from cellseg3dmodule.component_tree import ComponentTree
+from cellseg3dmodule.matching import matching
+from cellseg3dmodule.post_processing import (
+    SizedLabels,
+    binary_watershed,
+    bc_connected,
+    bc_watershed,
+)
+
+logger = logging.getLogger(__name__)
+
+# Grid searched for each method. "size_small" is swept on cached label sizes (see SizedLabels),
+# the other parameters each require a new instance segmentation.
+SEARCH_SPACES = {
+    "Watershed": {
+        "threshold_seed": np.arange(0.85, 0.99, 0.01),
+        "threshold_object": np.arange(0.2, 0.55, 0.1),
+        "size_small": np.arange(12, 30, 5),
+    },
+    "Connected components": {
+        "threshold_seed": np.arange(0.4, 0.99, 0.02),
+        "size_small": np.arange(3, 50, 2),
+    },
+    "bcwatershed": {
+        "thresh1": np.arange(0.2, 0.99, 0.1),
+        "thresh2": np.arange(0.01, 0.6, 0.1),
+        "thresh3": np.arange(0.01, 0.6, 0.1),
+        "size_small": np.arange(5, 25, 7),
+    },
+    "bcconnected": {
+        "thresh1": np.arange(0.01, 0.99, 0.05),
+        "thresh2": np.arange(0.01, 0.99, 0.05),
+        "size_small": np.arange(3, 25, 5),
+    },
+}
+
+# data shared by the tasks of a worker process, set once by _init_worker
+_WORKER_DATA = {}
+
+
+def _init_worker(y_true, y_pred):
+    _WORKER_DATA.clear()
+    _WORKER_DATA["y_true"] = y_true
+    _WORKER_DATA["y_pred"] = y_pred
+
+
+def _to_builtin(value):
+    """Converts numpy parameters to rounded python values, to be stored as json."""
+    if isinstance(value, (float, np.floating)):
+        return round(float(value), 6)
+    return int(value)
+
+
+def _crop(volume, fraction, ndim=None):
+    """Central crop of the volume, each side being reduced to the given fraction.
+
+    Only the last ndim (spatial) axes are cropped, so that e.g. a leading channel axis is kept whole.
+    If ndim is None, all axes are cropped.
+    """
+    if fraction >= 1:
+        return volume
+    ndim = volume.ndim if ndim is None else ndim
+    slices = [slice(None)] * (volume.ndim - ndim)
+    for size in volume.shape[volume.ndim - ndim :]:
+        crop = max(1, math.ceil(size * fraction))
+        start = (size - crop) // 2
+        slices.append(slice(start, start + crop))
+    return volume[tuple(slices)]
+
+
+def _segment(method_name, image, params, fraction):
+    """Instance segmentation without small object removal."""
+    if method_name == "Watershed":
+        return binary_watershed(
+            image, params["threshold_seed"], 0, params["threshold_object"]
+        )
+    if method_name == "Connected components":
+        tree_key = ("component_tree", fraction)
+        if tree_key not in _WORKER_DATA:
+            _WORKER_DATA[tree_key] = ComponentTree(image)
+        return _WORKER_DATA[tree_key].label(params["threshold_seed"])
+    if method_name == "bcwatershed":
+        return bc_watershed(
+            image, params["thresh1"], params["thresh2"], params["thresh3"], 0
+        )
+    if method_name == "bcconnected":
+        return bc_connected(image, params["thresh1"], params["thresh2"], 0)
+    raise NotImplementedError(
+        "Selected instance segmentation method is not defined"
+    )
+
+
+def _evaluate_group(task):
+    """Segments once, then scores every size_small and every matching threshold."""
+    method_name, params, sizes_small, thresholds, fraction = task
+    y_true = _crop(_WORKER_DATA["y_true"], fraction)
+    y_pred = _crop(_WORKER_DATA["y_pred"], fraction, ndim=y_true.ndim)
+
+    sized_labels = SizedLabels(_segment(method_name, y_pred, params, fraction))
+    results = []
+    for size_small, instance_labels in sized_labels.sweep(sizes_small):
+        metrics = matching(y_true, instance_labels, thresh=tuple(thresholds))
+        results.append(
+            (
+                dict(params, size_small=size_small),
+                [float(m.accuracy) for m in metrics],
+            )
+        )
+    return results
+
+
+class InstanceParamSearch:
+    """Hyper-parameter search for instance segmentation methods.
+
+    Each instance segmentation is computed once per set of parameters, all size_small values
+    are derived from it, and all matching thresholds are scored in a single ``matching`` call.
+    Parameter sets are spread over a process pool, and finished points are appended to a
+    json lines file so that an interrupted search resumes where it stopped.
+
+    Args:
+        y_true (numpy.ndarray): ground truth instance labels
+        y_pred (numpy.ndarray): predicted probabilities
+        thresholds (tuple): IoU thresholds used for matching. Default: (0.2, 0.4, 0.6)
+        results_path (str): json lines file to store finished points, or None to keep them in memory only
+        n_workers (int): number of processes. Default: None (one per cpu). Use 1 to run in the current process
+    """
+
+    def __init__(
+        self,
+        y_true,
+        y_pred,
+        thresholds=(0.2, 0.4, 0.6),
+        results_path=None,
+        n_workers=None,
+    ):
+        self.y_true = y_true
+        self.y_pred = y_pred
+        self.thresholds = tuple(thresholds)
+        self.results_path = results_path
+        self.n_workers = n_workers
+        self.results = self._load_results()
+
+    def _point_key(self, method_name, params, fraction):
+        return json.dumps(
+            {
+                "method": method_name,
+                "params": params,
+                "fraction": fraction,
+                "thresholds": self.thresholds,
+            },
+            sort_keys=True,
+        )
+
+    def _load_results(self):
+        results = {}
+        if self.results_path is None or not Path(self.results_path).is_file():
+            return results
+        with Path(self.results_path).open() as f:
+            for line in f:
+                if line.strip():
+                    point = json.loads(line)
+                    results[point["key"]] = point["accuracies"]
+        logger.info(
+            f"Loaded {len(results)} finished points from {self.results_path}"
+        )
+        return results
+
+    def _save_point(self, key, accuracies):
+        self.results[key] = accuracies
+        if self.results_path is None:
+            return
+        with Path(self.results_path).open("a") as f:
+            f.write(json.dumps({"key": key, "accuracies": accuracies}) + "\n")
+
+    def _groups(self, method_name):
+        """Parameter sets that each require a segmentation, size_small excluded."""
+        space = SEARCH_SPACES[method_name]
+        names = [name for name in space if name != "size_small"]
+        return [
+            {name: _to_builtin(v) for name, v in zip(names, values)}
+            for values in product(*[space[name] for name in names])
+        ]
+
+    def _evaluate(self, method_name, groups, fraction):
+        """Returns the accuracies of every point of the groups, computing the missing ones."""
+        sizes_small = [
+            _to_builtin(s) for s in SEARCH_SPACES[method_name]["size_small"]
+        ]
+
+        def keys(params):
+            return [
+                self._point_key(
+                    method_name, dict(params, size_small=s), fraction
+                )
+                for s in sizes_small
+            ]
+
+        tasks = [
+            (method_name, params, sizes_small, self.thresholds, fraction)
+            for params in groups
+            if not all(key in self.results for key in keys(params))
+        ]
+        logger.info(
+            f"{method_name} : {len(groups) - len(tasks)} parameter sets already done, {len(tasks)} to compute"
+        )
+        if self.n_workers == 1:
+            _init_worker(self.y_true, self.y_pred)
+            finished = map(_evaluate_group, tasks)
+            self._collect(method_name, finished, fraction, len(tasks))
+        elif len(tasks) > 0:
+            with ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                initializer=_init_worker,
+                initargs=(self.y_true, self.y_pred),
+            ) as pool:
+                finished = pool.map(_evaluate_group, tasks)
+                self._collect(method_name, finished, fraction, len(tasks))
+
+        return [
+            (dict(params, size_small=s), self.results[key])
+            for params in groups
+            for s, key in zip(sizes_small, keys(params))
+        ]
+
+    def _collect(self, method_name, finished, fraction, total):
+        for group_results in tqdm(finished, total=total):
+            for params, accuracies in group_results:
+                self._save_point(
+                    self._point_key(method_name, params, fraction),
+                    accuracies,
+                )
+
+    def run(self, method_name, halving=False, fractions=(0.25, 0.5), eta=3):
+        """Searches the best parameters of a method.
+
+        Args:
+            method_name (str): one of SEARCH_SPACES
+            halving (bool): if True, use successive halving : parameter sets are first scored on central
+                sub-volumes of increasing size (see fractions), and only the best 1/eta are kept at each step.
+                The remaining ones are then scored on the whole volume. Default: False (full grid)
+            fractions (tuple): sub-volume side fractions used by successive halving. Default: (0.25, 0.5)
+            eta (int): inverse of the fraction of parameter sets kept at each halving step. Default: 3
+
+        Returns:
+            tuple: best parameters (dict), and list of (parameters, accuracy for each threshold) on the whole volume
+        """
+        if method_name not in SEARCH_SPACES:
+            raise NotImplementedError(
+                "Selected instance segmentation method is not defined"
+            )
+        groups = self._groups(method_name)
+
+        if halving:
+            for fraction in fractions:
+                points = self._evaluate(method_name, groups, fraction)
+                group_scores = {}
+                for params, accuracies in points:
+                    group = json.dumps(
+                        {k: v for k, v in params.items() if k != "size_small"},
+                        sort_keys=True,
+                    )
+                    group_scores[group] = max(
+                        group_scores.get(group, -1), np.mean(accuracies)
+                    )
+                n_kept = max(1, math.ceil(len(groups) / eta))
+                kept = sorted(group_scores, key=group_scores.get)[-n_kept:]
+                groups = [json.loads(group) for group in kept]
+                logger.info(
+                    f"Kept {len(groups)} parameter sets after sub-volume fraction {fraction}"
+                )
+
+        points = self._evaluate(method_name, groups, 1)
+        best = int(np.argmax([np.mean(acc) for _, acc in points]))
+        return points[best][0], points
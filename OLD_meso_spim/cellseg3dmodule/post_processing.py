@@ -9,9 +9,47 @@ from skimage.measure import label
 
 # from skimage.measure import marching_cubes
 # from skimage.measure import mesh_surface_area
-from skimage.morphology import remove_small_objects, dilation
+from skimage.morphology import dilation
 from skimage.segmentation import watershed
-from skimage.transform import resize
+
+from cellseg3dmodule.relabel import relabel_sequential
+from cellseg3dmodule.resampling import resize_labels
+
+
+class SizedLabels:
+    """Instance labels with their per-label voxel counts, computed once with a single bincount.
+
+    Small objects can then be removed for any size threshold with a lookup-table remap,
+    which makes sweeping the size threshold a single vectorised indexing per value.
+
+    Args:
+        labels (numpy.ndarray): non-negative integer instance labels
+    """
+
+    def __init__(self, labels):
+        self.labels = np.asarray(labels)
+        if self.labels.size and self.labels.min() < 0:
+            raise ValueError("Labels must be non-negative")
+        self.sizes = np.bincount(
+            self.labels.ravel().astype(np.intp, copy=False)
+        )
+
+    def remove_small(self, thres_small, sequential=False):
+        """Same as ``skimage.morphology.remove_small_objects(labels, thres_small)``: removes objects with fewer than thres_small voxels.
+
+        If sequential is True, the remaining labels are also renumbered 1...n, in place on the new array.
+        """
+        lut = np.arange(len(self.sizes), dtype=self.labels.dtype)
+        lut[self.sizes < thres_small] = 0
+        labels = lut[self.labels]
+        if sequential:
+            labels, _, _ = relabel_sequential(labels, in_place=True)
+        return labels
+
+    def sweep(self, sizes_small):
+        """Yields (thres_small, labels) for every size threshold."""
+        for thres_small in sizes_small:
+            yield thres_small, self.remove_small(thres_small)
 
 
 def binary_connected(
@@ -26,13 +64,11 @@ def binary_connected(
         thres_small (int): size threshold of small objects to remove. Default: 128
         scale_factors (tuple): scale factors for resizing in :math:`(Z, Y, X)` order. Default: (1.0, 1.0, 1.0)
     """
-    if volume.shape[0] > 1:
-        semantic = volume[0]
-    else:
-        semantic = volume
+    # channel-first volumes : use the foreground channel
+    semantic = volume[0] if volume.ndim == 4 else np.squeeze(volume)
     foreground = semantic > thres  # int(255 * thres)
     segm = label(foreground)
-    segm = remove_small_objects(segm, thres_small)
+    segm = SizedLabels(segm).remove_small(thres_small, sequential=True)
 
     if not all(x == 1.0 for x in scale_factors):
         target_size = (
@@ -40,13 +76,7 @@ def binary_connected(
             int(semantic.shape[1] * scale_factors[1]),
             int(semantic.shape[2] * scale_factors[2]),
         )
-        segm = resize(
-            segm,
-            target_size,
-            order=0,
-            anti_aliasing=False,
-            preserve_range=True,
-        )
+        segm = resize_labels(segm, target_size)
 
     return segm
 
@@ -82,9 +112,9 @@ def binary_watershed(
     seed_map = semantic > thres_seeding
     foreground = semantic > thres_objects
     seed = label(seed_map)
-    seed = remove_small_objects(seed, rem_seed_thres)
+    seed = SizedLabels(seed).remove_small(rem_seed_thres)
     segm = watershed(-semantic.astype(np.float64), seed, mask=foreground)
-    segm = remove_small_objects(segm, thres_small)
+    segm = SizedLabels(segm).remove_small(thres_small, sequential=True)
 
     if not all(x == 1.0 for x in scale_factors):
         target_size = (
@@ -92,13 +122,7 @@ def binary_watershed(
             int(semantic.shape[1] * scale_factors[1]),
             int(semantic.shape[2] * scale_factors[2]),
         )
-        segm = resize(
-            segm,
-            target_size,
-            order=0,
-            anti_aliasing=False,
-            preserve_range=True,
-        )
+        segm = resize_labels(segm, target_size)
 
     return np.array(segm)
 
@@ -129,7 +153,7 @@ def bc_watershed(
     foreground = semantic > thres3
     seed = label(seed_map)
     segm = watershed(-semantic, seed, mask=foreground)
-    segm = remove_small_objects(segm, thres_small)
+    segm = SizedLabels(segm).remove_small(thres_small, sequential=True)
 
     if not all(x == 1.0 for x in scale_factors):
         target_size = (
@@ -137,13 +161,7 @@ def bc_watershed(
             int(semantic.shape[1] * scale_factors[1]),
             int(semantic.shape[2] * scale_factors[2]),
         )
-        segm = resize(
-            segm,
-            target_size,
-            order=0,
-            anti_aliasing=False,
-            preserve_range=True,
-        )
+        segm = resize_labels(segm, target_size)
     return segm.astype(np.uint32)
 
 
@@ -180,7 +198,7 @@ def bc_connected(
     segm = label(foreground)
     struct = np.ones(dilation_struct)
     segm = dilation(segm, struct)
-    segm = remove_small_objects(segm, thres_small)
+    segm = SizedLabels(segm).remove_small(thres_small, sequential=True)
 
     if not all(x == 1.0 for x in scale_factors):
         target_size = (
@@ -188,11 +206,5 @@ def bc_connected(
             int(semantic.shape[1] * scale_factors[1]),
             int(semantic.shape[2] * scale_factors[2]),
         )
-        segm = resize(
-            segm,
-            target_size,
-            order=0,
-            anti_aliasing=False,
-            preserve_range=True,
-        )
+        segm = resize_labels(segm, target_size)
     return segm.astype(np.uint32)
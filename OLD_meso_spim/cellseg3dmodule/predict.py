@@ -2,13 +2,13 @@ import logging
 from pathlib import Path
 from pathlib import PurePath
 from datetime import datetime
+from tempfile import TemporaryFile
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 from monai.inferers import sliding_window_inference
 from monai.transforms import (
-    AsDiscrete,
     AddChannel,
     Compose,
     EnsureChannelFirst,
@@ -20,8 +20,16 @@ from monai.transforms import (
 from tifffile import imwrite
 
 from cellseg3dmodule.config import InferenceWorkerConfig
+from cellseg3dmodule.config import PROBABILITY_OUTPUT_MODELS
 from cellseg3dmodule.config import WEIGHTS_PATH
 from cellseg3dmodule.post_processing import binary_watershed, binary_connected
+from cellseg3dmodule.resampling import tiled_zoom, zoomed_shape
+from cellseg3dmodule.storage import (
+    codec_metadata,
+    compact_labels,
+    decode_probabilities,
+    encode_probabilities,
+)
 from cellseg3dmodule.scripts.weights_download import WeightsDownloader
 
 logger = logging.getLogger(__name__)
@@ -48,6 +56,7 @@ class Inference:
         logger.info(f"Using {self.device} device")
         logger.info("Using torch :")
         logger.info(torch.__version__)
+        self.model = None  # built on first use, see load_model
 
     def log(self, message):
         logger.info(message)
@@ -66,6 +75,7 @@ class Inference:
         if config.post_process_config.thresholding.enabled:
             self.log(
                 f"Thresholding is enabled at {config.post_process_config.thresholding.threshold_value}"
+                f" (applied on the saved probabilities)"
             )
 
         self.log(f"Window size is {config.sliding_window_config.window_size}")
@@ -82,6 +92,10 @@ class Inference:
             self.log(
                 f"Scaling factor : {config.post_process_config.zoom.zoom_values} (x,y,z)"
             )
+            if config.post_process_config.zoom.tiled:
+                self.log(
+                    f"Tiled rescaling with tiles of {config.post_process_config.zoom.tile_size} pixels"
+                )
 
         instance_config = config.post_process_config.instance
         if instance_config.enabled:
@@ -91,45 +105,93 @@ class Inference:
                 f"Objects smaller than {instance_config.small_object_removal_threshold.threshold_value} pixels will be removed\n"
             )
 
-    def instance_seg(self, to_instance, image_id: int = 0):
-        if image_id is not None:
-            self.log(f"\nRunning instance segmentation for image n°{image_id}")
-
-        threshold = (
-            self.config.post_process_config.instance.threshold.threshold_value
-        )
-        size_small = (
-            self.config.post_process_config.instance.small_object_removal_threshold.threshold_value
+    def threshold(self, probabilities, threshold_value=None, codec=None):
+        """Thresholds a saved probability map, without running the model again.
+
+        Args:
+            probabilities: probability map, as float or encoded for storage (see storage.encode_probabilities)
+            threshold_value: threshold to apply. Defaults to post_process_config.thresholding.threshold_value
+            codec: codec of encoded probabilities, None if they are float (see storage.decode_probabilities)
+        """
+        if threshold_value is None:
+            threshold_value = (
+                self.config.post_process_config.thresholding.threshold_value
+            )
+        probabilities = decode_probabilities(probabilities, codec)
+        return (probabilities > threshold_value).astype(np.uint8)
+
+    def save_thresholded(self, probabilities, threshold_value, image_id=0):
+        """Thresholds a probability map and saves the binary result."""
+        binary = self.threshold(probabilities, threshold_value)
+        return self.save_image(
+            name=f"Thresholded_labels_{image_id}",
+            image=binary,
+            folder="thresholded_labels",
         )
-        method_name = self.config.post_process_config.instance.method
 
-        if method_name == "Watershed":
+    @staticmethod
+    def segment_instances(
+        probabilities, method_name, threshold, size_small, codec=None
+    ):
+        """Instance labels of a probability map, without saving them.
 
-            def method(image):
-                return binary_watershed(image, threshold, size_small)
+        Encoded probabilities are decoded with their codec, see storage.decode_probabilities.
+        """
+        probabilities = decode_probabilities(probabilities, codec)
+        if method_name == "Watershed":
+            return binary_watershed(probabilities, threshold, size_small)
+        if method_name == "Connected components":
+            return binary_connected(probabilities, threshold, size_small)
+        raise NotImplementedError(
+            "Selected instance segmentation method is not defined"
+        )
 
-        elif method_name == "Connected components":
+    def instance_seg(
+        self,
+        to_instance,
+        image_id: int = 0,
+        method_name: str = None,
+        threshold: float = None,
+        size_small: int = None,
+        return_labels: bool = False,
+    ):
+        """Runs instance segmentation on a probability map.
 
-            def method(image):
-                return binary_connected(image, threshold, size_small)
+        Parameters left to None are read from post_process_config.instance.
+        If return_labels is True, returns (path, labels) with the labels as saved, so that they need not be read back.
+        """
+        if image_id is not None:
+            self.log(f"\nRunning instance segmentation for image n°{image_id}")
 
-        else:
-            raise NotImplementedError(
-                "Selected instance segmentation method is not defined"
+        instance_config = self.config.post_process_config.instance
+        if threshold is None:
+            threshold = instance_config.threshold.threshold_value
+        if size_small is None:
+            size_small = (
+                instance_config.small_object_removal_threshold.threshold_value
             )
+        if method_name is None:
+            method_name = instance_config.method
+        instance_labels = self.segment_instances(
+            to_instance, method_name, threshold, size_small
+        )
 
-        instance_labels = method(to_instance)
-
+        instance_labels = compact_labels(instance_labels)
+        storage_config = self.config.instance_storage
         instance_filepath = self.save_image(
             name=f"Instance_labels_{image_id}",
             image=instance_labels,
             folder="instance_labels",
+            compression=storage_config.compression,
+            tile=storage_config.tile,
         )
 
         self.log(
             f"Instance segmentation results for image n°{image_id} have been saved as:"
         )
         self.log(PurePath(instance_filepath).name)
+        if return_labels:
+            return instance_filepath, instance_labels
         return instance_filepath
 
     def load_layer(self, volume):
@@ -171,6 +233,17 @@ class Inference:
         self.log("Done")
         return input_image
 
+    def activation(self, outputs):
+        """Maps model outputs to probabilities in [0, 1], see PROBABILITY_OUTPUT_MODELS.
+
+        Softmax over channels when computing instance boundaries, sigmoid for models returning logits.
+        """
+        if self.config.compute_instance_boundaries:
+            return F.softmax(outputs, dim=1)
+        if self.config.model_info.name in PROBABILITY_OUTPUT_MODELS:
+            return outputs
+        return torch.sigmoid(outputs)
+
     def model_output(
         self,
         inputs,
@@ -182,7 +255,9 @@ class Inference:
         inputs = inputs.to("cpu")
         # print(f"Input size: {inputs.shape}")
         model_output = lambda inputs: post_process_transforms(
-            self.config.model_info.get_model().get_output(model, inputs)
+            self.activation(
+                self.config.model_info.get_model().get_output(model, inputs)
+            )
         )
 
         if self.config.keep_on_cpu:
@@ -210,13 +285,23 @@ class Inference:
             out = aniso_transform(out)
 
         if post_process:
-            out = np.array(out).astype(np.float32)
+            # no copy if out is already a float32 array (e.g. a memmap from aniso_transform)
+            out = np.asarray(out, dtype=np.float32)
             out = np.squeeze(out)
             return out
         else:
             return out
 
-    def save_image(self, name, image, folder: str = None):
+    def save_image(
+        self,
+        name,
+        image,
+        folder: str = None,
+        compression=None,
+        tile=None,
+        metadata=None,
+    ):
+        """Writes an image as a tif in results_path/folder. metadata is stored in the tif description, see tifffile.imwrite."""
         time = "{:%Y_%m_%d_%H_%M_%S}".format(datetime.now())
 
         result_folder = ""
@@ -230,16 +315,47 @@ class Inference:
         file_path = folder_path / Path(
             f"{name}_" + f"{time}_" + self.config.filetype
         )
-        imwrite(file_path, image)
+        imwrite(
+            file_path,
+            image,
+            compression=compression,
+            tile=None if tile is None else tuple(tile),
+            metadata={} if metadata is None else metadata,
+        )
         filename = PurePath(file_path).name
 
         self.log(f"\nPrediction saved as : {filename}")
         return file_path
 
     def aniso_transform(self, image):
-        zoom = self.config.post_process_config.zoom.zoom_values
+        zoom_config = self.config.post_process_config.zoom
+        zoom = zoom_config.zoom_values
         if zoom is None:
             zoom = [1, 1, 1]
+        if zoom_config.tiled:
+            # tiles are read from the output one at a time, and written to a memmap if enabled
+            out = None
+            if zoom_config.memmap:
+                out_shape = (image.shape[1],) + zoomed_shape(
+                    image.shape[2:], zoom
+                )
+                # default temporary directory if results_path is not a path
+                temp_dir = self.config.results_path
+                if not isinstance(temp_dir, (str, PurePath)):
+                    temp_dir = None
+                out = np.memmap(
+                    TemporaryFile(dir=temp_dir),
+                    dtype=np.float32,
+                    mode="w+",
+                    shape=out_shape,
+                )
+            return tiled_zoom(
+                image[0],
+                zoom,
+                tile_size=zoom_config.tile_size,
+                num_workers=zoom_config.num_workers,
+                out=out,
+            )
         anisotropic_transform = Zoom(
             zoom=zoom,
             keep_size=False,
@@ -247,72 +363,96 @@ class Inference:
         )
         return anisotropic_transform(image[0])
 
-    def inference(self, image_id: int = 0):
-        try:
-            dims = self.config.model_info.model_input_size
-            # self.log(f"MODEL DIMS : {dims}")
-            model_name = self.config.model_info.name
-            model_class = self.config.model_info.get_model()
-            self.log(model_name)
-
-            weights_config = self.config.weights_config
-            post_process_config = self.config.post_process_config
-
-            if model_name == "SegResNet":
-                model = model_class.get_net(
-                    input_image_size=[
-                        dims,
-                        dims,
-                        dims,
-                    ],
-                )
-            elif model_name == "SwinUNetR":
-                out_channels = 1
-                if self.config.compute_instance_boundaries:
-                    out_channels = 3
-                model = model_class.get_net(
-                    img_size=[dims, dims, dims],
-                    use_checkpoint=False,
-                    out_channels=out_channels,
-                )
-            else:
-                model = model_class.get_net()
-            model = model.to(self.config.device)
+    def load_model(self):
+        """Builds the model and loads its weights. The model is kept, so later calls (e.g. one per chunk) reuse it."""
+        if self.model is not None:
+            return self.model.to(self.config.device)
+
+        dims = self.config.model_info.model_input_size
+        # self.log(f"MODEL DIMS : {dims}")
+        model_name = self.config.model_info.name
+        model_class = self.config.model_info.get_model()
+        self.log(model_name)
+
+        weights_config = self.config.weights_config
+
+        if model_name == "SegResNet":
+            model = model_class.get_net(
+                input_image_size=[
+                    dims,
+                    dims,
+                    dims,
+                ],
+            )
+        elif model_name == "SwinUNetR":
+            out_channels = 1
+            if self.config.compute_instance_boundaries:
+                out_channels = 3
+            model = model_class.get_net(
+                img_size=[dims, dims, dims],
+                use_checkpoint=False,
+                out_channels=out_channels,
+            )
+        else:
+            model = model_class.get_net()
+        model = model.to(self.config.device)
 
-            self.log_parameters()
+        self.log_parameters()
 
-            model.to(self.config.device)
+        self.log("\nLoading weights...")
+        if weights_config.path is not None:
+            weights_path = weights_config.path
+        else:
+            downloader = WeightsDownloader()
+            downloader.download_weights(
+                model_name, model_class.get_weights_file()
+            )
+            weights_path = str(
+                Path(WEIGHTS_PATH) / model_class.get_weights_file()
+            )
+        logger.info(f"Trying to load weights : {weights_path}")
+        model.load_state_dict(
+            torch.load(
+                weights_path,
+                map_location=self.config.device,
+            )
+        )
+        self.log("Done")
+        model.eval()
+        self.model = model
+        return model
+
+    def predict(self, volume, zoom=False):
+        """Foreground probabilities of a single volume, e.g. a chunk of a whole scan.
+
+        The output has the same axes as the input : no transposition is applied.
+        If zoom is True, probabilities are zoomed by post_process_config.zoom as in :meth:`inference`,
+        otherwise they have the shape of the input.
+        Only single-channel models are supported (compute_instance_boundaries must be disabled).
+        """
+        if self.config.compute_instance_boundaries:
+            raise NotImplementedError(
+                "Chunk prediction does not support instance boundaries"
+            )
+        model = self.load_model()
+        image = self.load_layer(volume).type(torch.FloatTensor)
+        with torch.no_grad():
+            return self.model_output(
+                image,
+                model,
+                EnsureType(),
+                aniso_transform=self.aniso_transform if zoom else None,
+            )
 
-            if not post_process_config.thresholding.enabled:
-                post_process_transforms = EnsureType()
-            else:
-                t = post_process_config.thresholding.threshold_value
-                post_process_transforms = Compose(
-                    [AsDiscrete(threshold=t), EnsureType()]
-                )
+    def inference(self, image_id: int = 0):
+        try:
+            model = self.load_model()
 
-            self.log("\nLoading weights...")
-            if weights_config.path is not None:
-                weights_path = weights_config.path
-            else:
-                downloader = WeightsDownloader()
-                downloader.download_weights(
-                    model_name, model_class.get_weights_file()
-                )
-                weights_path = str(
-                    Path(WEIGHTS_PATH) / model_class.get_weights_file()
-                )
-            logger.info(f"Trying to load weights : {weights_path}")
-            model.load_state_dict(
-                torch.load(
-                    weights_path,
-                    map_location=self.config.device,
-                )
-            )
-            self.log("Done")
+            # probabilities are always kept, thresholding is applied downstream (see threshold)
+            # they are stored according to config.semantic_storage, see storage.encode_probabilities
+            post_process_transforms = EnsureType()
 
             input_image = self.load_layer(self.config.image)
-            model.eval()
             with torch.no_grad():
                 self.log(f"Inference started on layer...")
 
@@ -325,14 +465,17 @@ class Inference:
                     aniso_transform=self.aniso_transform,
                 )
 
+                storage_config = self.config.semantic_storage
                 file_path = self.save_image(
                     name=f"Semantic_labels_{image_id}",
-                    image=out,
+                    image=encode_probabilities(out, storage_config.codec),
                     folder="semantic_labels",
+                    compression=storage_config.compression,
+                    tile=storage_config.tile,
+                    metadata=codec_metadata(storage_config.codec),
                 )
 
             if self.config.compute_instance_boundaries:
-                out = F.softmax(out, dim=1)
                 out = np.array(out)  # .astype(np.float32)
                 logger.info(
                     f" Output max {out.max()}, output min {out.min()},"
@@ -356,7 +499,7 @@ class Inference:
                 else:
                     out = np.transpose(out, (2, 1, 0))
             else:
-                out = np.array(out)
+                out = np.asarray(out)
                 logger.info(
                     f" Output max {out.max()}, output min {out.min()},"
                     f" output mean {out.mean()}, output median {np.median(out)}"
@@ -370,9 +513,21 @@ class Inference:
                 out = np.transpose(out, (2, 1, 0))
 
             if self.config.run_semantic_evaluation:
-                from evaluate_semantic import run_evaluation
+                from cellseg3dmodule.evaluate_semantic import run_evaluation
 
-                run_evaluation(out)
+                evaluation_config = self.config.semantic_evaluation
+                if evaluation_config.labels_path is None:
+                    raise ValueError(
+                        "Semantic evaluation requires semantic_evaluation.labels_path"
+                    )
+                self.log("Running semantic evaluation...")
+                run_evaluation(
+                    out,
+                    evaluation_config.labels_path,
+                    threshold_range=evaluation_config.thresholds,
+                    chunk_size=evaluation_config.chunk_size,
+                    plot=False,
+                )
 
             model.to("cpu")
             return file_path
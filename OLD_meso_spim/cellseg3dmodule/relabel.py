@@ -0,0 +1,127 @@
+import logging
+
+import numpy as np
+from numba import jit
+
+logger = logging.getLogger(__name__)
+
+
+@jit(nopython=True, nogil=True)
+def _mark_present(flat, present):
+    for i in range(flat.size):
+        present[flat[i]] = True
+
+
+@jit(nopython=True, nogil=True)
+def _apply_map(flat, forward_map, out):
+    # out may be flat itself, each voxel is read before being written
+    for i in range(flat.size):
+        out[i] = forward_map[flat[i]]
+
+
+def _check_labels(labels):
+    if not np.issubdtype(labels.dtype, np.integer):
+        raise ValueError("Labels must be integers")
+    if labels.size and labels.min() < 0:
+        raise ValueError("Cannot relabel array that contains negative values.")
+
+
+def label_presence(labels):
+    """Boolean table of the label ids present in a label volume, computed in a single pass.
+
+    Args:
+        labels (numpy.ndarray): non-negative integer labels
+
+    Returns:
+        numpy.ndarray: (labels.max() + 1,) table, True for each id present (background included)
+    """
+    labels = np.asarray(labels)
+    _check_labels(labels)
+    max_label = int(labels.max()) if labels.size else 0
+    present = np.zeros(max_label + 1, dtype=np.bool_)
+    _mark_present(labels.reshape(-1), present)
+    return present
+
+
+def label_are_sequential(labels, presence=None):
+    """Returns True if the labels are exactly 1...n (background 0 may be absent).
+
+    Args:
+        labels (numpy.ndarray): non-negative integer labels
+        presence (numpy.ndarray): table from :func:`label_presence`, to reuse it instead of scanning the labels again
+    """
+    if presence is None:
+        presence = label_presence(labels)
+    return bool(presence[1:].all())
+
+
+def _output_dtype(in_dtype, new_max_label, out_dtype):
+    if out_dtype == "min":
+        return np.min_scalar_type(new_max_label)
+    if out_dtype is not None:
+        out_dtype = np.dtype(out_dtype)
+        if new_max_label > np.iinfo(out_dtype).max:
+            raise ValueError(
+                f"{new_max_label} labels do not fit in dtype {out_dtype}"
+            )
+        return out_dtype
+    # as skimage : keep the input dtype unless the new labels overflow it
+    required = np.min_scalar_type(new_max_label)
+    if required.itemsize > in_dtype.itemsize:
+        return required
+    return in_dtype
+
+
+def relabel_sequential(labels, offset=1, out_dtype=None, in_place=False):
+    """Relabels arbitrary labels to offset...offset + n - 1, with a compiled kernel.
+
+    Same outputs as ``skimage.segmentation.relabel_sequential``, but the labels present are found
+    with a presence table instead of np.unique, and no work is done when the labels are already
+    sequential (and the dtype is unchanged) : the input array itself is then returned.
+
+    Args:
+        labels (numpy.ndarray): non-negative integer labels
+        offset (int): first new label. Default: 1
+        out_dtype: dtype of the output, "min" for the smallest unsigned dtype holding the labels,
+            or None to keep the input dtype unless the new labels overflow it. Default: None
+        in_place (bool): write the result into labels. Requires a C-contiguous array and an unchanged dtype. Default: False
+
+    Returns:
+        tuple: relabeled labels, forward map (old id -> new id) and inverse map (new id -> old id)
+    """
+    offset = int(offset)
+    if offset <= 0:
+        raise ValueError("Offset must be strictly positive.")
+    labels = np.asarray(labels)
+    present = label_presence(labels)
+    present[0] = False
+    old_labels = np.flatnonzero(present)
+    new_max_label = offset - 1 + len(old_labels)
+    dtype = _output_dtype(labels.dtype, new_max_label, out_dtype)
+
+    forward_map = np.zeros(len(present), dtype=dtype)
+    forward_map[old_labels] = np.arange(offset, new_max_label + 1)
+    inverse_map = np.zeros(new_max_label + 1, dtype=dtype)
+    inverse_map[offset:] = old_labels
+
+    if offset == 1 and label_are_sequential(labels, present):
+        # forward map is the identity
+        if dtype == labels.dtype:
+            return labels, forward_map, inverse_map
+        if not in_place:
+            return labels.astype(dtype), forward_map, inverse_map
+
+    if in_place:
+        if dtype != labels.dtype:
+            raise ValueError(
+                f"Cannot relabel in place from {labels.dtype} to {dtype}"
+            )
+        if not labels.flags.c_contiguous or not labels.flags.writeable:
+            raise ValueError(
+                "In place relabelling requires a writeable C-contiguous array"
+            )
+        out = labels
+    else:
+        out = np.empty(labels.shape, dtype=dtype)
+    _apply_map(labels.reshape(-1), forward_map, out.reshape(-1))
+    return out, forward_map, inverse_map
@@ -0,0 +1,186 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ZOOM_MODES = ["area", "nearest", "trilinear"]
+
+
+def zoomed_shape(shape, zoom):
+    """Returns the spatial shape obtained after zooming, as computed by MONAI's ``Zoom(keep_size=False)``.
+
+    Args:
+        shape (tuple): spatial shape of the volume
+        zoom (list): zoom factor for each spatial dimension
+    """
+    return tuple(int(np.floor(s * z)) for s, z in zip(shape, zoom))
+
+
+def _axis_weights(in_size, out_size, mode):
+    """Builds the (out_size, in_size) interpolation matrix along one axis.
+
+    The matrices reproduce torch's ``interpolate`` for the given mode, so that
+    applying them separably along each axis gives the same result as MONAI's ``Zoom``.
+    """
+    weights = np.zeros((out_size, in_size), dtype=np.float32)
+    out_index = np.arange(out_size)
+    scale = in_size / out_size
+    if mode == "area":  # adaptive average pooling bins
+        starts = (out_index * in_size) // out_size
+        ends = -(-((out_index + 1) * in_size) // out_size)
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            weights[i, start:end] = 1.0 / (end - start)
+    elif mode == "nearest":
+        source = np.minimum(
+            np.floor(out_index * scale).astype(int), in_size - 1
+        )
+        weights[out_index, source] = 1.0
+    elif mode == "trilinear":  # align_corners=False
+        source = np.maximum((out_index + 0.5) * scale - 0.5, 0)
+        low = np.minimum(np.floor(source).astype(int), in_size - 1)
+        high = np.minimum(low + 1, in_size - 1)
+        frac = (source - low).astype(np.float32)
+        np.add.at(weights, (out_index, low), 1 - frac)
+        np.add.at(weights, (out_index, high), frac)
+    else:
+        raise ValueError(
+            f"Zoom mode {mode} is not supported, use one of {ZOOM_MODES}"
+        )
+    return weights
+
+
+def _tile_bounds(size, tile_size):
+    return [
+        (start, min(start + tile_size, size))
+        for start in range(0, size, tile_size)
+    ]
+
+
+def tiled_zoom(
+    image,
+    zoom,
+    mode="area",
+    tile_size=64,
+    num_workers=None,
+    out=None,
+):
+    """Zooms a channel-first volume tile by tile instead of in a single call.
+
+    Each output tile only reads the input region it depends on, and tiles are
+    computed in parallel threads. The output shape and values match MONAI's
+    ``Zoom(zoom, keep_size=False, mode=mode)``, up to float32 rounding.
+
+    Args:
+        image (array-like): volume of shape :math:`(C, Z, Y, X)`. Can be any array supporting slicing (numpy, memmap, dask...)
+        zoom (list): zoom factor for each spatial dimension
+        mode (str): interpolation mode, one of "area", "nearest" or "trilinear". Default: "area"
+        tile_size (int): size of the output tiles along each dimension. Default: 64
+        num_workers (int): number of threads used to compute tiles. Default: None (as many as the executor allows)
+        out (numpy.ndarray): optional pre-allocated output (e.g. a np.memmap) of shape :math:`(C,)` + zoomed shape
+
+    Returns:
+        numpy.ndarray: the zoomed volume
+    """
+    spatial_shape = tuple(image.shape[1:])
+    if len(zoom) != len(spatial_shape):
+        raise ValueError(
+            f"Zoom {zoom} does not match the {len(spatial_shape)} spatial dimensions of the image"
+        )
+    out_shape = zoomed_shape(spatial_shape, zoom)
+    if out is None:
+        out = np.empty((image.shape[0],) + out_shape, dtype=np.float32)
+    elif tuple(out.shape) != (image.shape[0],) + out_shape:
+        raise ValueError(
+            f"Output array has shape {out.shape}, expected {(image.shape[0],) + out_shape}"
+        )
+
+    weights = [
+        _axis_weights(in_size, out_size, mode)
+        for in_size, out_size in zip(spatial_shape, out_shape)
+    ]
+
+    def zoom_tile(bounds):
+        out_slices = tuple(slice(start, end) for start, end in bounds)
+        in_slices = []
+        tile_weights = []
+        for w, out_slice in zip(weights, out_slices):
+            used = np.flatnonzero(w[out_slice].any(axis=0))
+            in_slice = slice(used[0], used[-1] + 1)
+            in_slices.append(in_slice)
+            tile_weights.append(w[out_slice, in_slice])
+        tile = np.asarray(
+            image[(slice(None),) + tuple(in_slices)], dtype=np.float32
+        )
+        for axis, w in enumerate(tile_weights):
+            tile = np.moveaxis(
+                np.tensordot(w, tile, axes=([1], [axis + 1])), 0, axis + 1
+            )
+        out[(slice(None),) + out_slices] = tile
+
+    tiles = list(
+        product(*[_tile_bounds(size, tile_size) for size in out_shape])
+    )
+    logger.debug(
+        f"Zooming {spatial_shape} to {out_shape} in {len(tiles)} tiles"
+    )
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        list(pool.map(zoom_tile, tiles))
+    return out
+
+
+def label_resize_indices(in_size, out_size):
+    """Source index of each output index for a nearest-neighbour resize along one axis.
+
+    Matches the coordinates used by ``skimage.transform.resize(order=0)``.
+    """
+    zoom = np.float64(in_size) / np.float64(out_size)
+    source = np.floor((np.arange(out_size) + 0.5) * zoom - 0.5 + 0.5)
+    return np.clip(source.astype(np.int64), 0, in_size - 1)
+
+
+def resize_labels(
+    labels, output_shape, num_workers=None, slab_size=16, out=None
+):
+    """Nearest-neighbour resize of a label volume using integer indexing only.
+
+    Gives the same result as ``skimage.transform.resize(labels, output_shape, order=0,
+    preserve_range=True, anti_aliasing=False)``, without converting to float.
+    The dtype of the labels is preserved, and slabs along the first axis are filled in parallel.
+
+    Args:
+        labels (array-like): label volume
+        output_shape (tuple): shape of the output
+        num_workers (int): number of threads used to fill slabs. Default: None (as many as the executor allows)
+        slab_size (int): number of output planes computed by each task. Default: 16
+        out (numpy.ndarray): optional pre-allocated output (e.g. a np.memmap)
+
+    Returns:
+        numpy.ndarray: resized labels
+    """
+    output_shape = tuple(int(s) for s in output_shape)
+    if len(output_shape) != labels.ndim:
+        raise ValueError(
+            f"Output shape {output_shape} does not match the {labels.ndim} dimensions of the labels"
+        )
+    if out is None:
+        out = np.empty(output_shape, dtype=labels.dtype)
+    indices = [
+        label_resize_indices(in_size, out_size)
+        for in_size, out_size in zip(labels.shape, output_shape)
+    ]
+    if tuple(labels.shape) == output_shape:
+        out[...] = labels
+        return out
+
+    def resize_slab(bounds):
+        start, end = bounds
+        source = indices[0][start:end]
+        slab = np.asarray(labels[source[0] : source[-1] + 1])
+        out[start:end] = slab[np.ix_(source - source[0], *indices[1:])]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        list(pool.map(resize_slab, _tile_bounds(output_shape[0], slab_size)))
+    return out
@@ -0,0 +1,202 @@
+import logging
+from dataclasses import dataclass
+from typing import Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SparseLabels:
+    """Run-length encoded instance labels, stored per object.
+
+    Only labelled voxels are stored : each object is a list of runs of consecutive
+    voxels in the C-order flattened volume, along with its bounding box.
+    Memory therefore scales with the number of labelled voxels, not with the volume size.
+
+    Attributes:
+        shape (tuple): shape of the dense volume
+        dtype (str): dtype of the dense volume
+        labels (numpy.ndarray): (K,) label id of each object, sorted
+        offsets (numpy.ndarray): (K+1,) runs of object k are run_starts[offsets[k]:offsets[k+1]]
+        run_starts (numpy.ndarray): (R,) flat index of the first voxel of each run
+        run_lengths (numpy.ndarray): (R,) number of voxels in each run
+        bboxes (numpy.ndarray): (K, 2 * ndim) bounding box of each object, as (min_0, ..., min_n, max_0, ..., max_n) with exclusive max
+    """
+
+    shape: Tuple[int, ...]
+    dtype: str
+    labels: np.ndarray
+    offsets: np.ndarray
+    run_starts: np.ndarray
+    run_lengths: np.ndarray
+    bboxes: np.ndarray
+
+    @classmethod
+    def from_dense(cls, volume):
+        """Builds the sparse representation of a dense label volume."""
+        volume = np.asarray(volume)
+        flat = volume.ravel()
+        indices = np.flatnonzero(flat)
+        values = flat[indices]
+        order = np.argsort(values, kind="stable")  # by label, then by index
+        indices = indices[order]
+        values = values[order]
+
+        labels, first_voxel = np.unique(values, return_index=True)
+        new_run = np.ones(len(indices), dtype=bool)
+        new_run[1:] = (np.diff(indices) != 1) | (np.diff(values) != 0)
+        run_first_voxel = np.flatnonzero(new_run)
+        run_lengths = np.diff(np.append(run_first_voxel, len(indices)))
+        offsets = np.searchsorted(run_first_voxel, first_voxel)
+
+        if len(labels) > 0:
+            coordinates = np.stack(np.unravel_index(indices, volume.shape))
+            bboxes = np.concatenate(
+                [
+                    np.minimum.reduceat(coordinates, first_voxel, axis=1),
+                    np.maximum.reduceat(coordinates, first_voxel, axis=1) + 1,
+                ]
+            ).T
+        else:
+            bboxes = np.zeros((0, 2 * volume.ndim), dtype=np.int64)
+
+        return cls(
+            shape=tuple(volume.shape),
+            dtype=str(volume.dtype),
+            labels=labels,
+            offsets=np.append(offsets, len(run_first_voxel)).astype(np.int64),
+            run_starts=indices[new_run].astype(np.int64),
+            run_lengths=run_lengths.astype(np.uint32),
+            bboxes=bboxes.astype(np.int64),
+        )
+
+    @property
+    def n_objects(self):
+        """Number of labelled objects."""
+        return len(self.labels)
+
+    def volumes(self):
+        """Number of voxels of each object."""
+        if self.n_objects == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.add.reduceat(
+            self.run_lengths.astype(np.int64), self.offsets[:-1]
+        )
+
+    def flat_indices(self):
+        """Flat index of every labelled voxel, grouped by object."""
+        lengths = self.run_lengths.astype(np.int64)
+        run_offsets = np.cumsum(lengths) - lengths
+        return np.repeat(self.run_starts - run_offsets, lengths) + np.arange(
+            lengths.sum()
+        )
+
+    def coordinates(self):
+        """(N, ndim) coordinates of every labelled voxel, grouped by object."""
+        return np.stack(
+            np.unravel_index(self.flat_indices(), self.shape), axis=1
+        )
+
+    def voxel_labels(self):
+        """Label of every labelled voxel, in the same order as :meth:`coordinates`."""
+        return np.repeat(self.labels, self.volumes())
+
+    def to_dense(self, window=None):
+        """Converts back to a dense label volume.
+
+        Args:
+            window (tuple of slices): optional region to render, e.g. a crop. Only objects whose bounding box intersects it are decoded.
+        """
+        if window is None:
+            dense = np.zeros(int(np.prod(self.shape)), dtype=self.dtype)
+            dense[self.flat_indices()] = self.voxel_labels()
+            return dense.reshape(self.shape)
+
+        ndim = len(self.shape)
+        starts = np.array(
+            [w.indices(s)[0] for w, s in zip(window, self.shape)]
+        )
+        stops = np.array([w.indices(s)[1] for w, s in zip(window, self.shape)])
+        dense = np.zeros(
+            tuple(np.maximum(stops - starts, 0)), dtype=self.dtype
+        )
+        intersects = np.all(
+            (self.bboxes[:, :ndim] < stops) & (self.bboxes[:, ndim:] > starts),
+            axis=1,
+        )
+        for k in np.flatnonzero(intersects):
+            coordinates = self.object_coordinates(k)
+            inside = np.all(
+                (coordinates >= starts) & (coordinates < stops), axis=1
+            )
+            dense[tuple((coordinates[inside] - starts).T)] = self.labels[k]
+        return dense
+
+    def object_coordinates(self, k):
+        """(n, ndim) coordinates of the voxels of the k-th object."""
+        runs = slice(self.offsets[k], self.offsets[k + 1])
+        lengths = self.run_lengths[runs].astype(np.int64)
+        run_offsets = np.cumsum(lengths) - lengths
+        flat = np.repeat(
+            self.run_starts[runs] - run_offsets, lengths
+        ) + np.arange(lengths.sum())
+        return np.stack(np.unravel_index(flat, self.shape), axis=1)
+
+    def moments(self):
+        """Computes per-object volume, centroid and inertia tensor eigenvalues without a dense volume.
+
+        Returns:
+            tuple: volumes (K,), centroids (K, ndim) and inertia tensor eigenvalues (K, ndim), sorted in decreasing order as in skimage's regionprops
+        """
+        ndim = len(self.shape)
+        volumes = self.volumes()
+        if self.n_objects == 0:
+            return volumes, np.zeros((0, ndim)), np.zeros((0, ndim))
+        coordinates = self.coordinates().astype(np.float64)
+        first_voxel = np.cumsum(volumes) - volumes
+        counts = volumes[:, None].astype(np.float64)
+
+        centroids = np.add.reduceat(coordinates, first_voxel, axis=0) / counts
+        centered = coordinates - np.repeat(centroids, volumes, axis=0)
+        covariance = (
+            np.add.reduceat(
+                centered[:, :, None] * centered[:, None, :],
+                first_voxel,
+                axis=0,
+            )
+            / counts[:, :, None]
+        )
+        # Iii is the sum of the second-order moments of every other axis, Iij = -cov_ij
+        variances = np.diagonal(covariance, axis1=1, axis2=2)
+        inertia = -covariance
+        diagonal = variances.sum(axis=1, keepdims=True) - variances
+        inertia[:, np.arange(ndim), np.arange(ndim)] = diagonal
+        eigvals = np.clip(np.linalg.eigvalsh(inertia), 0, None)[:, ::-1]
+        return volumes, centroids, eigvals
+
+    def to_dict(self):
+        """Serializable form, e.g. to store in a DataJoint blob attribute."""
+        return {
+            "shape": np.array(self.shape, dtype=np.int64),
+            "dtype": self.dtype,
+            "labels": self.labels,
+            "offsets": self.offsets,
+            "run_starts": self.run_starts,
+            "run_lengths": self.run_lengths,
+            "bboxes": self.bboxes,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuilds SparseLabels from :meth:`to_dict`."""
+        return cls(
+            shape=tuple(int(s) for s in data["shape"]),
+            dtype=str(data["dtype"]),
+            labels=np.asarray(data["labels"]),
+            offsets=np.asarray(data["offsets"], dtype=np.int64),
+            run_starts=np.asarray(data["run_starts"], dtype=np.int64),
+            run_lengths=np.asarray(data["run_lengths"], dtype=np.uint32),
+            bboxes=np.asarray(data["bboxes"], dtype=np.int64),
+        )
@@ -0,0 +1,249 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+from tifffile import TiffFile, imread, imwrite
+
+from cellseg3dmodule.relabel import relabel_sequential
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_LEVELS = 255
+
+# Maximum absolute error on probabilities in [0, 1] after encoding then decoding
+# uint8 : half a quantization step, 1 / (2 * 255)
+# float16 : half the float16 spacing in [0.5, 1], 2 ** -12 (smaller values are more precise)
+PROBABILITY_CODECS = {
+    "uint8": 1 / (2 * QUANTIZATION_LEVELS),
+    "float16": 2**-12,
+    "float32": 0.0,
+}
+
+# key of the codec in the metadata of saved probability maps, see codec_metadata
+CODEC_METADATA_KEY = "codec"
+
+
+def check_probabilities(probabilities):
+    """Raises a ValueError if a map has values outside [0, 1], e.g. un-activated model outputs (logits).
+
+    Returns:
+        numpy.ndarray: probabilities as float32
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float32)
+    if probabilities.size and (
+        probabilities.min() < 0 or probabilities.max() > 1
+    ):
+        raise ValueError(
+            f"Probabilities must be in [0, 1], got values in [{probabilities.min()}, {probabilities.max()}]."
+            " Apply the model activation (e.g. sigmoid) before encoding"
+        )
+    return probabilities
+
+
+def quantize_probabilities(probabilities):
+    """Stores a probability map in [0, 1] as uint8 fixed-point values in [0, 255].
+
+    The maximum absolute error after :func:`dequantize_probabilities` is 1 / (2 * 255) ~ 0.002.
+
+    Args:
+        probabilities (numpy.ndarray): probability map
+
+    Returns:
+        numpy.ndarray: uint8 quantized probabilities
+
+    Raises:
+        ValueError: if values are outside [0, 1], see :func:`check_probabilities`
+    """
+    probabilities = check_probabilities(probabilities)
+    return np.rint(probabilities * QUANTIZATION_LEVELS).astype(np.uint8)
+
+
+def dequantize_probabilities(quantized):
+    """Decodes uint8 fixed-point probabilities from :func:`quantize_probabilities` back to float32 in [0, 1]."""
+    return np.asarray(quantized).astype(np.float32) / QUANTIZATION_LEVELS
+
+
+def encode_probabilities(probabilities, codec="uint8"):
+    """Encodes a probability map for storage.
+
+    Args:
+        probabilities (numpy.ndarray): probability map, values in [0, 1]
+        codec (str): one of "uint8" (fixed-point, max error ~0.002), "float16" (max error ~0.00025)
+            or "float32" (lossless). See PROBABILITY_CODECS
+
+    Returns:
+        numpy.ndarray: encoded probabilities, decoded by :func:`decode_probabilities`
+
+    Raises:
+        ValueError: if the codec is not supported, or values are outside [0, 1]
+    """
+    if codec == "uint8":
+        return quantize_probabilities(probabilities)
+    if codec == "float16":
+        return check_probabilities(probabilities).astype(np.float16)
+    if codec == "float32":
+        return check_probabilities(probabilities)
+    raise ValueError(
+        f"Codec {codec} is not supported, use one of {list(PROBABILITY_CODECS.keys())}"
+    )
+
+
+def decode_probabilities(encoded, codec=None):
+    """Decodes probabilities stored with one of the PROBABILITY_CODECS back to float32.
+
+    Args:
+        encoded (numpy.ndarray): encoded probabilities
+        codec (str): codec used to encode them, e.g. from :func:`read_codec`. If None, the input must
+            already be float probabilities: integer volumes (masks, labels, scans) are not guessed to be encoded
+
+    Raises:
+        ValueError: if the codec is not supported, or an integer input has no codec
+    """
+    encoded = np.asarray(encoded)
+    if codec is None:
+        if not np.issubdtype(encoded.dtype, np.floating):
+            raise ValueError(
+                f"Cannot decode {encoded.dtype} probabilities without their codec"
+            )
+        return encoded.astype(np.float32, copy=False)
+    if codec == "uint8":
+        return dequantize_probabilities(encoded)
+    if codec in PROBABILITY_CODECS:
+        return encoded.astype(np.float32, copy=False)
+    raise ValueError(
+        f"Codec {codec} is not supported, use one of {list(PROBABILITY_CODECS.keys())}"
+    )
+
+
+def codec_metadata(codec):
+    """tif metadata recording the codec of an encoded probability map, read back by :func:`read_codec`."""
+    return {CODEC_METADATA_KEY: codec}
+
+
+def read_codec(file_path):
+    """Codec of a probability map written with :func:`codec_metadata`, None if it was not recorded."""
+    with TiffFile(file_path) as tif:
+        metadata = tif.shaped_metadata
+    if not metadata:
+        return None
+    return metadata[0].get(CODEC_METADATA_KEY)
+
+
+def save_probabilities(
+    file_path, probabilities, codec="uint8", compression="zlib", tile=None
+):
+    """Encodes and writes a probability map as a (compressed) tif, recording the codec in its metadata.
+
+    Args:
+        file_path: path to write to
+        probabilities (numpy.ndarray): probability map, values in [0, 1]
+        codec (str): see :func:`encode_probabilities`
+        compression (str): tifffile compression codec, or None. Default: "zlib"
+        tile (tuple): tile shape (Y, X) used to chunk each plane, or None to compress whole planes
+    """
+    imwrite(
+        file_path,
+        encode_probabilities(probabilities, codec),
+        compression=compression,
+        tile=tile,
+        metadata=codec_metadata(codec),
+    )
+    return file_path
+
+
+def load_probabilities(file_path):
+    """Reads a probability map written by :func:`save_probabilities` and decodes it to float32.
+
+    Raises:
+        ValueError: if the map is stored as integers without a recorded codec
+    """
+    return decode_probabilities(imread(file_path), read_codec(file_path))
+
+
+def compact_labels(labels):
+    """Casts instance labels to the smallest unsigned dtype able to hold them.
+
+    If the largest label does not fit in a uint8, labels are first made sequential
+    so that gaps (e.g. left by small object removal) do not force a wider dtype.
+
+    Args:
+        labels (numpy.ndarray): non-negative integer labels
+
+    Returns:
+        numpy.ndarray: labels as uint8, uint16, uint32 or uint64
+    """
+    labels = np.asarray(labels)
+    if labels.size == 0:
+        return labels.astype(np.uint8)
+    if labels.min() < 0:
+        raise ValueError("Cannot compact labels with negative values")
+    max_label = int(labels.max())
+    if max_label > np.iinfo(np.uint8).max:
+        labels, _, _ = relabel_sequential(labels, out_dtype="min")
+        return labels
+    return labels.astype(np.min_scalar_type(max_label), copy=False)
+
+
+def save_labels(file_path, labels, compression="zlib", tile=None):
+    """Writes instance labels with the smallest dtype and a lossless codec.
+
+    Label volumes are mostly background, which deflate-based codecs compress very well.
+
+    Args:
+        file_path: path to write to
+        labels (numpy.ndarray): instance labels
+        compression (str): lossless tifffile compression codec, or None. Default: "zlib"
+        tile (tuple): tile shape (Y, X) used to chunk each plane, or None to compress whole planes
+    """
+    imwrite(
+        file_path,
+        compact_labels(labels),
+        compression=compression,
+        tile=tile,
+    )
+    return file_path
+
+
+def iter_blocks(source, block_size):
+    """Yields consecutive blocks of block_size planes of a volume, without loading it entirely.
+
+    Args:
+        source: path to a multi-page tif (one page per plane, read with tifffile),
+            or any array supporting slicing along its first axis (numpy, memmap, dask, zarr...)
+        block_size (int): number of planes per block
+    """
+    if isinstance(source, (str, Path)):
+        with TiffFile(source) as tif:
+            n_planes = len(tif.pages)
+        for start in range(0, n_planes, block_size):
+            end = min(start + block_size, n_planes)
+            block = imread(source, key=range(start, end))
+            # a single page is read without its plane axis
+            yield block[np.newaxis] if end - start == 1 else block
+    else:
+        for start in range(0, source.shape[0], block_size):
+            yield np.asarray(source[start : start + block_size])
+
+
+def read_region(source, region, block_size=64):
+    """Reads a box of a volume, without loading the planes outside of it.
+
+    Args:
+        source: path to a multi-page tif or any array supporting slicing, see :func:`iter_blocks`
+        region (tuple): slices along each axis, with explicit start and stop
+        block_size (int): number of tif planes decoded at once, only the region of each is kept. Default: 64
+
+    Returns:
+        numpy.ndarray: the region of the volume
+    """
+    region = tuple(region)
+    if not isinstance(source, (str, Path)):
+        return np.asarray(source[region])
+    blocks = []
+    for start in range(region[0].start, region[0].stop, block_size):
+        end = min(start + block_size, region[0].stop)
+        block = imread(source, key=range(start, end))
+        if end - start == 1:
+            block = block[np.newaxis]
+        blocks.append(block[(slice(None),) + region[1:]])
+    return np.concatenate(blocks)
@@ -194,7 +194,7 @@ def volume_stats(volume_image) -> ImageStats:
     return ImageStats(
         volume=volume,
         centroid_x=[region.centroid[0] for region in properties],
-        centroid_y=[region.centroid[0] for region in properties],
+        centroid_y=[region.centroid[1] for region in properties],
         centroid_z=[region.centroid[2] for region in properties],
         sphericity_ax=sphericity_ax,
         image_size=volume_image.shape,
@@ -205,6 +205,52 @@ def volume_stats(volume_image) -> ImageStats:
     )
 
 
+def sparse_volume_stats(sparse_labels) -> ImageStats:
+    """Computes the same statistics as volume_stats, directly from SparseLabels.
+
+    Only labelled voxels are read, so cost scales with the number of cell voxels instead of the image size.
+
+    Args:
+        sparse_labels (SparseLabels): instance labels, see cellseg3dmodule.sparse_labels
+
+    Returns:
+        ImageStats: Statistics described in volume_stats
+    """
+    volume, centroids, eigvals = sparse_labels.moments()
+
+    def axis_length(sign):
+        # equivalent to regionprops axis_major_length (sign=1) and axis_minor_length (sign=-1) in 3D
+        lengths = 10 * (
+            sign * eigvals[:, 0] + eigvals[:, 1] - sign * eigvals[:, 2]
+        )
+        return np.sqrt(np.maximum(lengths, 0))
+
+    sphericity_ax = [
+        sphericity_axis(major * 0.5, minor * 0.5)
+        for major, minor in zip(axis_length(1), axis_length(-1))
+    ]
+
+    total_image_volume = int(np.prod(sparse_labels.shape))
+    total_filled_volume = int(np.sum(volume))
+    if total_image_volume != 0:
+        ratio = total_filled_volume / total_image_volume
+    else:
+        ratio = 0
+
+    return ImageStats(
+        volume=volume.tolist(),
+        centroid_x=centroids[:, 0].tolist(),
+        centroid_y=centroids[:, 1].tolist(),
+        centroid_z=centroids[:, 2].tolist(),
+        sphericity_ax=sphericity_ax,
+        image_size=sparse_labels.shape,
+        total_image_volume=total_image_volume,
+        total_filled_volume=total_filled_volume,
+        filling_ratio=ratio,
+        number_objects=sparse_labels.n_objects,
+    )
+
+
 def fill_list_in_between(lst, n, elem):
     """Fills a list with n * elem between each member of list.
     Example with list = [1,2,3], n=2, elem='&' : returns [1, &, &,2,&,&,3,&,&]
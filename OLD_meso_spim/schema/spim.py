@@ -1,19 +1,28 @@
 """Draft for the meso spim schema."""
 
 import logging
+from copy import deepcopy
+from dataclasses import replace
 from datetime import datetime
 from pathlib import Path
 
 import datajoint as dj
-import numpy as np
 import scripts.brainreg_utils as brg_utils
 from cellseg3dmodule.config import InferenceWorkerConfig
 from cellseg3dmodule.predict import Inference
-from cellseg3dmodule.utils import volume_stats, zoom_factor
+from cellseg3dmodule.sparse_labels import SparseLabels
+from cellseg3dmodule.storage import load_probabilities
+from cellseg3dmodule.utils import sparse_volume_stats, zoom_factor
 from schema import user
+from schema.utils.datastore import add_store
 from schema.utils.path_dataclass import PathConfig
-from scripts import generate_report
-from scripts.napari_brainreg_ui import open_brainreg_window
+from scripts import (
+    brainreg_headless,
+    census,
+    downsample,
+    generate_report,
+    region_index,
+)
 from tifffile import imread, imwrite
 
 # logging.basicConfig(level=logging.INFO)
@@ -35,9 +44,21 @@ FILE_STORAGE = PathConfig().load_from_json(
 )
 #################
 # FILE_STORAGE = Path.home() / Path("Desktop/Code/BRAINREG_DATA/test_data")
+# external store for large blobs (e.g. sparse instance labels)
+SPIM_STORE = "spim_storage"
+add_store(
+    SPIM_STORE,
+    {
+        "protocol": "file",
+        "location": str(Path(FILE_STORAGE.file_storage) / "external"),
+    },
+)
 CELLSEG_CONFIG = InferenceWorkerConfig().load_from_json(
     Path().absolute() / "cellseg3dmodule/inference_config.json"
 )
+BRAINREG_CONFIG = brainreg_headless.BrainregConfig.load_from_json(
+    Path().absolute() / "scripts/brainreg_config.json"
+)
 
 
 @schema
@@ -64,6 +85,62 @@ class Scan(dj.Manual):
         return image.shape
 
 
+@schema
+class DownsampledScan(dj.Computed):
+    """Autofluorescence scan block-averaged to about the atlas resolution, used as brainreg input.
+
+    The scan is read slab by slab (raw files are memory-mapped), so only a few planes are in memory at once.
+    """
+
+    definition = """  # autofluorescence scan downsampled for registration
+    -> Scan
+    ---
+    downsampled_path: varchar(200)
+    voxel_size_x: double   # voxel size of the downsampled scan, in microns
+    voxel_size_y: double
+    voxel_size_z: double
+    """
+
+    def make(self, key):
+        """Downsamples the autofluo scan by averaging blocks of voxels."""
+        autofluo_scan_path, mouse_name, attempt = (Scan() & key).fetch1(
+            "autofluo_path", "mouse_name", "attempt"
+        )
+        # scan axes are z, y, x, as the voxel sizes given to brainreg (see brg_utils.VOXEL_SIZE_AXES)
+        voxel_size = (
+            BRAINREG_CONFIG.voxel_size_z,
+            BRAINREG_CONFIG.voxel_size_y,
+            BRAINREG_CONFIG.voxel_size_x,
+        )
+        atlas = brg_utils.get_atlas(BRAINREG_CONFIG.atlas)
+        axes, _ = brg_utils.orientation_mapping(
+            atlas.orientation, BRAINREG_CONFIG.orientation
+        )
+        factors = downsample.downsampling_factors(
+            voxel_size, [atlas.resolution[axis] for axis in axes]
+        )
+
+        if Path(autofluo_scan_path).suffix == ".raw":
+            source = brg_utils.load_raw(autofluo_scan_path)
+        else:
+            source = autofluo_scan_path
+        volume = downsample.block_mean_downsample(source, factors)
+
+        folder = Path(FILE_STORAGE.file_storage) / Path("downsampled")
+        folder.mkdir(parents=True, exist_ok=True)
+        downsampled_path = folder / Path(
+            f"{mouse_name}_{attempt}_autofluo.tif"
+        )
+        logger.info(f"Saving downsampled scan {downsampled_path}")
+        imwrite(downsampled_path, volume)
+
+        key["downsampled_path"] = str(downsampled_path)
+        key["voxel_size_z"], key["voxel_size_y"], key["voxel_size_x"] = [
+            size * factor for size, factor in zip(voxel_size, factors)
+        ]
+        self.insert1(key)
+
+
 @schema
 class BrainRegistration(dj.Computed):
     """Brain registration table. Contains the results of brainreg."""
@@ -89,15 +166,51 @@ class BrainRegistration(dj.Computed):
         roi_id: int unsigned   # roi id
         ---
         roi_volume_path  : varchar(200)   # path to the cFOS volume cropped to the specified ROI
+        roi_bbox = null : longblob   # (min_z, min_y, min_x, max_z, max_y, max_x) of the volume in the scan, exclusive max
+        """
+
+    class Labels(dj.Part):
+        """Registered atlas labels at full scan resolution, computed once per registration."""
+
+        definition = """  # registered atlas labels, reoriented and rescaled to the scan
+        -> BrainRegistration
+        ---
+        labels_path: varchar(200)   # zlib-compressed tiled tif of uint16 labels
+        atlas_ids: longblob   # atlas id of each label, see brainreg_utils.compact_atlas_labels
         """
 
+    @property
+    def key_source(self):
+        """Scans to register. Headless runs on downsampled scans wait for DownsampledScan."""
+        if BRAINREG_CONFIG.headless and BRAINREG_CONFIG.downsample:
+            return Scan() & DownsampledScan()
+        return Scan()
+
     def make(self, key):
-        """Runs brainreg on the autofluo scan."""
+        """Runs brainreg on the autofluo scan.
+
+        In headless mode (see scripts/brainreg_config.json), brainreg runs from the command line
+        into the output folder of the key, otherwise the napari plugin is opened.
+        """
         autofluo_scan_path = (Scan() & key).fetch1("autofluo_path")
 
-        brainreg_data: brg_utils.BrainregParams = open_brainreg_window(
-            autofluo_scan_path
-        )  # has to be removed/modified to use command line brainreg
+        if BRAINREG_CONFIG.headless:
+            brainreg_data = brainreg_headless.run_brainreg(
+                *self.get_brainreg_input(key),
+            )
+            # brainreg may have run on the downsampled scan, keep the voxel size of the full scan
+            brainreg_data = replace(
+                brainreg_data,
+                voxel_size_x=BRAINREG_CONFIG.voxel_size_x,
+                voxel_size_y=BRAINREG_CONFIG.voxel_size_y,
+                voxel_size_z=BRAINREG_CONFIG.voxel_size_z,
+            )
+        else:
+            from scripts.napari_brainreg_ui import open_brainreg_window
+
+            brainreg_data: brg_utils.BrainregParams = open_brainreg_window(
+                autofluo_scan_path
+            )
 
         key["registration_path"] = brainreg_data.path
         key["atlas"] = brainreg_data.atlas
@@ -107,26 +220,129 @@ class BrainRegistration(dj.Computed):
         key["orientation"] = brainreg_data.orientation
         self.insert1(key)
 
-        rois = (Scan() & key).fetch1("regions_of_interest_ids")
         brainreg_labels_path = Path(brainreg_data.path) / Path(
             "registered_atlas.tiff"
         )
-
-        split_volumes = brg_utils.prepare_roi_cfos(
-            roi_ids=rois,
-            cfos_scan_path=str(autofluo_scan_path),
-            brainreg_labels_path=str(brainreg_labels_path),
+        labels, atlas_ids = brg_utils.prepare_registration_labels(
+            str(brainreg_labels_path),
             original_orientation=brainreg_data.orientation,
             atlas=brainreg_data.atlas,
+            volume_shape=(Scan() & key).get_shape(),
+        )
+        labels_path = brg_utils.save_registration_labels(
+            Path(brainreg_data.path) / Path("registered_labels_scan.tif"),
+            labels,
+        )
+        self.Labels.insert1(
+            dict(key, labels_path=str(labels_path), atlas_ids=atlas_ids),
+            ignore_extra_fields=True,
+        )
+
+        self.add_rois(key, labels=labels)
+
+    @staticmethod
+    def get_output_folder(key):
+        """brainreg output folder of a registration, one per key."""
+        return (
+            Path(FILE_STORAGE.file_storage)
+            / Path("brainreg")
+            / Path(f"{key['mouse_name']}_{key['attempt']}")
+        )
+
+    def get_brainreg_input(self, key):
+        """Input scan, output folder and config of the headless brainreg run of a registration.
+
+        If downsampling is enabled in the config, the input is the DownsampledScan of the key,
+        and the config holds its voxel size.
+        """
+        output_folder = self.get_output_folder(key)
+        if not BRAINREG_CONFIG.downsample:
+            autofluo_scan_path = (Scan() & key).fetch1("autofluo_path")
+            return autofluo_scan_path, output_folder, BRAINREG_CONFIG
+
+        downsampled_path, voxel_x, voxel_y, voxel_z = (
+            DownsampledScan() & key
+        ).fetch1(
+            "downsampled_path", "voxel_size_x", "voxel_size_y", "voxel_size_z"
+        )
+        config = replace(
+            BRAINREG_CONFIG,
+            voxel_size_x=voxel_x,
+            voxel_size_y=voxel_y,
+            voxel_size_z=voxel_z,
         )
+        return downsampled_path, output_folder, config
 
-        attempt = (Scan() & key).fetch1("attempt")
-        mouse_name = (Scan() & key).fetch1("mouse_name")
+    def register(self, max_workers=None):
+        """Runs brainreg on all scans not registered yet, several at once, then populates the table.
 
-        for roi in rois:
-            roi_name = brg_utils.get_atlas_region_name_from_id(
-                roi, brainreg_data.atlas
+        Args:
+            max_workers (int): maximum number of brainreg runs at once. Default: None (see scripts/brainreg_config.json)
+        """
+        if BRAINREG_CONFIG.downsample:
+            DownsampledScan().populate()
+        keys = (self.key_source - self).fetch("KEY")
+        jobs = [self.get_brainreg_input(key) for key in keys]
+        logger.info(f"Registering {len(jobs)} scans")
+        results = brainreg_headless.run_brainreg_batch(
+            jobs, BRAINREG_CONFIG, max_workers=max_workers
+        )
+        # reuses the brainreg results of each output folder
+        self.populate(
+            [
+                key
+                for key, result in zip(keys, results)
+                if not isinstance(result, Exception)
+            ]
+        )
+
+    def add_rois(self, key, labels=None):
+        """Extracts the regions of interest of the Scan that are not in BrainRegistration.ROI yet.
+
+        Uses the labels stored in BrainRegistration.Labels, so adding a region to a Scan
+        neither runs brainreg again nor recomputes the existing ROIs.
+
+        Args:
+            key: key of the registration
+            labels (numpy.ndarray): full resolution labels if already in memory, read from BrainRegistration.Labels otherwise
+        """
+        autofluo_scan_path, mouse_name, attempt, rois = (Scan() & key).fetch1(
+            "autofluo_path", "mouse_name", "attempt", "regions_of_interest_ids"
+        )
+        atlas = (self & key).fetch1("atlas")
+        labels_path, atlas_ids = (self.Labels & key).fetch1(
+            "labels_path", "atlas_ids"
+        )
+        done = set((self.ROI & key).fetch("roi_id").tolist())
+        new_rois = [int(roi) for roi in rois if int(roi) not in done]
+        if len(new_rois) == 0:
+            logger.info("All regions of interest are already extracted")
+            return
+        logger.info(f"Extracting regions of interest {new_rois}")
+
+        # each ROI is read within its bounding box only
+        if RegionIndex() & key:
+            index = RegionIndex().get_region_index(key)
+        else:
+            index = region_index.RegionIndex.build(
+                self.get_registration_labels(key),
+                (Scan() & key).get_shape(),
+                RegionIndex.chunk_size,
             )
+        bboxes = brg_utils.roi_bboxes(new_rois, index, atlas)
+        split_volumes = brg_utils.extract_rois(
+            new_rois,
+            brg_utils.load_volumes(autofluo_scan_path),
+            labels_path if labels is None else labels,
+            atlas_ids,
+            atlas,
+            region_index=index,
+        )
+
+        for roi in new_rois:
+            if str(roi) not in split_volumes:
+                continue
+            roi_name = brg_utils.get_atlas_region_name_from_id(roi, atlas)
             roi_name = brg_utils.format_roi_name_to_path(roi_name)
 
             folder = Path(autofluo_scan_path).parent / Path(f"{roi_name}")
@@ -136,25 +352,85 @@ class BrainRegistration(dj.Computed):
                 f"{roi}_cropped_{brg_utils.get_date_time()}.tif"
             )
 
-            brg_utils.get_atlas_orientation(brainreg_data.atlas)
-            # logger.info(f"Re-orienting cropped ROI to atlas standard : {standard_orientation}")
-            # brg_utils.reorient_volume(split_volumes[str(roi)], brainreg_data.orientation, standard_orientation)
             logger.info(f"Saving ROI volume {volume_path}")
             imwrite(volume_path, split_volumes[str(roi)])
 
-            results_dict = [mouse_name, attempt, int(roi), str(volume_path)]
+            bbox = bboxes[str(roi)]
+            results_dict = [
+                mouse_name,
+                attempt,
+                roi,
+                str(volume_path),
+                [b.start for b in bbox] + [b.stop for b in bbox],
+            ]
             logger.debug(f"brainreg label processing results : {results_dict}")
-            BrainRegistration.ROI.insert1(results_dict)
+            BrainRegistration.ROI.insert1(
+                results_dict, allow_direct_insert=True
+            )
+
+    def get_registration_labels(self, key):
+        """Returns the registered atlas labels, at registration resolution and in the orientation of the scan.
+
+        The atlas is read once and reoriented as a strided view, without copy.
+        """
+        registration_path, atlas, orientation = (self & key).fetch1(
+            "registration_path", "atlas", "orientation"
+        )
+        labels = imread(str(Path(registration_path) / "registered_atlas.tiff"))
+        return brg_utils.reorient_volume(
+            labels,
+            source=brg_utils.get_atlas_orientation(atlas),
+            target=orientation,
+        )
+
+
+@schema
+class RegionIndex(dj.Computed):
+    """Chunk-level spatial index of the atlas regions of a registration, see scripts.region_index.
+
+    Gives the bounding box and the scan chunks of any region, including regions requested
+    after the registration, without scanning the label volume again.
+    """
+
+    definition = """  # bounding box and chunks of each atlas region, in scan voxels
+    -> BrainRegistration
+    ---
+    chunk_size: smallint unsigned   # size of the chunks along each axis
+    region_index: blob@spim_storage   # see RegionIndex.to_dict
+    """
+
+    chunk_size = 256  # chunk size used by new entries
+
+    def make(self, key):
+        """Builds the index from the registered atlas, at registration resolution."""
+        registration_labels = BrainRegistration().get_registration_labels(key)
+        scan_shape = (Scan() & key).get_shape()
+
+        index = region_index.RegionIndex.build(
+            registration_labels, scan_shape, self.chunk_size
+        )
+        logger.info(
+            f"Indexed {len(index.region_ids)} regions in chunks of {index.chunk_size}"
+        )
+        key["chunk_size"] = self.chunk_size
+        key["region_index"] = index.to_dict()
+        self.insert1(key)
+
+    def get_region_index(self, key):
+        """Returns the RegionIndex of a registration."""
+        return region_index.RegionIndex.from_dict(
+            (self & key).fetch1("region_index")
+        )
 
 
 @schema
 class SemanticSegmentation(dj.Computed):
-    """Semantic image segmentation."""
+    """Semantic image segmentation. Stores the quantized probability map, thresholding is done downstream."""
 
     definition = """  # semantic image segmentation
     -> BrainRegistration.ROI
     ---
-    semantic_labels: varchar(200)
+    semantic_labels: varchar(200)  # path to the encoded probability map, see cellseg3dmodule.storage
     """
 
     def make(self, key):  # from ROI in brainreg
@@ -163,21 +439,13 @@ class SemanticSegmentation(dj.Computed):
             "roi_volume_path"
         )
         roi_id = (BrainRegistration.ROI() & key).fetch1("roi_id")
-        voxel_x = (BrainRegistration() & key).fetch1("voxel_size_x")
-        voxel_y = (BrainRegistration() & key).fetch1("voxel_size_y")
-        voxel_z = (BrainRegistration() & key).fetch1("voxel_size_z")
         cFOS_scan = imread(roi_volume_path)
 
-        config = CELLSEG_CONFIG
+        config = deepcopy(CELLSEG_CONFIG)  # the shared config is left as is
         config.image = cFOS_scan
+        config.post_process_config.zoom.zoom_values = self.get_zoom(key)
 
-        zoom = zoom_factor(
-            [voxel_x, voxel_z, voxel_y]
-        )  # TODO(cyril) fix orientation. also see napari_brainreg_ui
-        logger.debug(f"zoom : {zoom}")
-        config.post_process_config.zoom.zoom_values = zoom
-
-        config.results_path = FILE_STORAGE
+        config.results_path = FILE_STORAGE.file_storage
 
         logger.info(f"Starting prediction on : {roi_volume_path}")
 
@@ -187,6 +455,83 @@ class SemanticSegmentation(dj.Computed):
         key["semantic_labels"] = result_path
         self.insert1(key)
 
+    @staticmethod
+    def get_zoom(key):
+        """Anisotropic zoom applied to the model output, from the registration voxel sizes.
+
+        Returns one zoom value per axis of the scan arrays, in (z, y, x) order as the voxel sizes
+        given to brainreg (see brg_utils.VOXEL_SIZE_AXES).
+        """
+        voxel_sizes = (BrainRegistration() & key).fetch1(
+            *[f"voxel_size_{axis}" for axis in brg_utils.VOXEL_SIZE_AXES]
+        )
+        zoom = zoom_factor(voxel_sizes)
+        logger.debug(f"zoom (z, y, x) : {zoom}")
+        return zoom
+
+
+@schema
+class ThresholdParams(dj.Lookup):
+    """Thresholds to apply to the semantic probability maps."""
+
+    definition = """  # threshold applied to the probability maps
+    threshold_id: int
+    ---
+    threshold_value: float
+    """
+    contents = [
+        [
+            0,
+            CELLSEG_CONFIG.post_process_config.thresholding.threshold_value,
+        ],
+    ]
+
+
+@schema
+class ThresholdedSegmentation(dj.Computed):
+    """Binary segmentation obtained by thresholding the stored probabilities."""
+
+    definition = """  # thresholded semantic segmentation
+    -> SemanticSegmentation
+    -> ThresholdParams
+    ---
+    thresholded_labels: varchar(200)
+    """
+
+    def make(self, key):
+        """Thresholds the semantic probability map, does not run the model."""
+        inference_worker = Inference(CELLSEG_CONFIG)
+
+        labels_path = (SemanticSegmentation() & key).fetch1("semantic_labels")
+        threshold = (ThresholdParams() & key).fetch1("threshold_value")
+        roi_id = (BrainRegistration.ROI() & key).fetch1("roi_id")
+
+        key["thresholded_labels"] = inference_worker.save_thresholded(
+            load_probabilities(labels_path), threshold, image_id=roi_id
+        )
+        self.insert1(key)
+
+
+@schema
+class InstanceSegParams(dj.Lookup):
+    """Parameters for instance segmentation of the probability maps."""
+
+    definition = """  # instance segmentation parameters
+    instance_params_id: int
+    ---
+    method: varchar(30)   # see cellseg3dmodule.config.INSTANCE_SEGMENTATION_METHOD_LIST
+    threshold: float   # probability threshold
+    size_small: int   # objects smaller than this are removed
+    """
+    contents = [
+        [
+            0,
+            CELLSEG_CONFIG.post_process_config.instance.method,
+            CELLSEG_CONFIG.post_process_config.instance.threshold.threshold_value,
+            CELLSEG_CONFIG.post_process_config.instance.small_object_removal_threshold.threshold_value,
+        ],
+    ]
+
 
 @schema
 class InstanceSegmentation(dj.Computed):
@@ -194,23 +539,123 @@ class InstanceSegmentation(dj.Computed):
 
     definition = """  # instance image segmentation
     -> SemanticSegmentation
+    -> InstanceSegParams
     ---
     instance_labels: varchar(200)
+    sparse_labels: blob@spim_storage  # run-length encoded labels, see SparseLabels.to_dict
     """
 
     def make(self, key):
-        """Runs instance segmentation on the semantic labels."""
+        """Runs instance segmentation on the stored probabilities, does not run the model."""
         config = CELLSEG_CONFIG
         inference_worker = Inference(config)
 
         labels_path = (SemanticSegmentation() & key).fetch1("semantic_labels")
-        semantic_labels = imread(labels_path)
+        semantic_labels = load_probabilities(labels_path)  # decoded to float
+        method, threshold, size_small = (InstanceSegParams() & key).fetch1(
+            "method", "threshold", "size_small"
+        )
 
         roi_id = (BrainRegistration.ROI() & key).fetch1("roi_id")
-        key["instance_labels"] = inference_worker.instance_seg(
-            semantic_labels, image_id=roi_id
+        instance_path, instance_labels = inference_worker.instance_seg(
+            semantic_labels,
+            image_id=roi_id,
+            method_name=method,
+            threshold=threshold,
+            size_small=size_small,
+            return_labels=True,
+        )
+        key["instance_labels"] = instance_path
+        key["sparse_labels"] = SparseLabels.from_dense(
+            instance_labels
+        ).to_dict()
+        self.insert1(key)
+
+    def get_sparse_labels(self, key):
+        """Returns the instance labels as SparseLabels, without loading the dense volume."""
+        return SparseLabels.from_dict((self & key).fetch1("sparse_labels"))
+
+
+@schema
+class Census(dj.Computed):
+    """Whole-brain cell census, as an alternative to the per-ROI chain.
+
+    The cFOS scan is segmented once, chunk by chunk, and each cell is assigned to the atlas region
+    containing its centroid. Counts are rolled up the atlas hierarchy, so every region is covered
+    at once and overlapping ROIs are never segmented twice.
+    """
+
+    definition = """  # whole-brain cell census
+    -> BrainRegistration
+    -> InstanceSegParams
+    ---
+    cell_counts: int
+    centroids: blob@spim_storage   # (N, 3) cell centroids, in scan voxels
+    cell_volumes: blob@spim_storage   # (N,) cell volumes, in voxels
+    cell_region_ids: blob@spim_storage   # (N,) atlas id of the region containing each centroid
+    """
+
+    class Region(dj.Part):
+        """Cell count and density of an atlas region, including its descendants."""
+
+        definition = """  # cells per atlas region
+        -> Census
+        region_id: int unsigned   # atlas id
+        ---
+        acronym: varchar(30)
+        region_name: varchar(200)
+        cell_count: int   # cells in the region and its descendants
+        volume_mm3: float
+        density: float   # cells per mm3
+        """
+
+    def make(self, key):
+        """Segments the whole cFOS scan once and counts cells per atlas region."""
+        cfos_scan_path = (Scan() & key).fetch1("cfos_path")
+        atlas = (BrainRegistration() & key).fetch1("atlas")
+        voxel_size = (BrainRegistration() & key).fetch1(
+            "voxel_size_x", "voxel_size_y", "voxel_size_z"
+        )
+        method, threshold, size_small = (InstanceSegParams() & key).fetch1(
+            "method", "threshold", "size_small"
+        )
+
+        scan = brg_utils.load_volumes(cfos_scan_path)
+        registration_labels = BrainRegistration().get_registration_labels(key)
+
+        # same zoom as SemanticSegmentation, instance parameters are in zoomed voxels
+        config = deepcopy(CELLSEG_CONFIG)  # the shared config is left as is
+        config.post_process_config.zoom.zoom_values = (
+            SemanticSegmentation.get_zoom(key)
+        )
+        config.results_path = FILE_STORAGE.file_storage
+        inference_worker = Inference(config)  # model is loaded once
+        cells = census.segment_scan(
+            scan, inference_worker, method, threshold, size_small, zoom=True
+        )
+        cells.region_ids = census.lookup_regions(
+            cells.centroids, registration_labels, scan.shape
+        )
+        regions = census.census_table(
+            cells,
+            registration_labels,
+            scan.shape,
+            voxel_size,
+            brg_utils.get_atlas_structures(atlas),
+        )
+        logger.info(
+            f"Census found {cells.n_cells} cells in {len(regions)} regions"
         )
+
+        key["cell_counts"] = cells.n_cells
+        key["centroids"] = cells.centroids
+        key["cell_volumes"] = cells.volumes
+        key["cell_region_ids"] = cells.region_ids
         self.insert1(key)
+        self.Region.insert(
+            [dict(key, **region) for region in regions],
+            ignore_extra_fields=True,
+        )
 
 
 @schema
@@ -233,15 +678,11 @@ class Analysis(dj.Computed):
 
     def make(self, key):
         """Runs analysis on the instance segmentation."""
-        labels_path = (InstanceSegmentation & key).fetch1("instance_labels")
+        labels = InstanceSegmentation().get_sparse_labels(key)
 
-        labels = imread(labels_path)
+        stats = sparse_volume_stats(labels)
 
-        stats = volume_stats(labels)
-
-        key["cell_counts"] = (
-            np.unique(labels.flatten()).size - 1
-        )  # remove background
+        key["cell_counts"] = labels.n_objects  # background is not stored
         key["density"] = stats.filling_ratio
         key["image_size"] = stats.image_size
         key["centroids"] = [
@@ -284,9 +725,7 @@ class Report(
         email = (user.User() & key).fetch1("email")
         username = (user.User() & key).fetch1("name")
         stats = (Analysis() & key).get_stats_summary(key)
-        labels_path = (InstanceSegmentation() & key).fetch1("instance_labels")
-
-        labels = imread(labels_path)
+        labels = InstanceSegmentation().get_sparse_labels(key)
 
         logger.debug(stats)
 
@@ -306,7 +745,7 @@ class Report(
 
         key["date"] = datetime.today()
         key["stats_summary"] = stats
-        key["instance_samples"] = labels
+        key["instance_samples"] = labels.to_dict()
 
         self.insert1(key)
 
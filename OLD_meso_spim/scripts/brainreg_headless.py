@@ -0,0 +1,144 @@
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List
+
+import scripts.brainreg_utils as utils
+from cellseg3dmodule.config import load_json_config
+from dataclasses_json import dataclass_json
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG_PATH = Path(__file__).parent / Path("brainreg_config.json")
+
+
+@dataclass_json
+@dataclass
+class BrainregConfig:
+    """Parameters of headless brainreg runs, see the brainreg command line documentation.
+
+    Axes follow the scan arrays, (z, y, x): voxel sizes are passed to brainreg in this order.
+
+    Attributes:
+        headless (bool): run brainreg from the command line. If False, BrainRegistration opens the napari plugin instead
+        downsample (bool): register the scan block-averaged to the atlas resolution (see DownsampledScan) instead of the full resolution scan
+        atlas (str): atlas name from BrainGlobeAtlas
+        orientation (str): 3-characters orientation of the scans
+        voxel_size_x (float): voxel size of the full resolution scan in microns along x
+        voxel_size_y (float): voxel size of the full resolution scan in microns along y
+        voxel_size_z (float): voxel size of the full resolution scan in microns along z
+        n_free_cpus (int): cpus left free by each brainreg run
+        max_workers (int): maximum number of brainreg runs at once
+        command (str): brainreg executable
+        extra_args (List[str]): additional brainreg arguments, e.g. ["--debug"]
+    """
+
+    headless: bool = True
+    downsample: bool = True
+    atlas: str = "allen_mouse_25um"
+    orientation: str = "sal"
+    voxel_size_x: float = 1.5
+    voxel_size_y: float = 1.5
+    voxel_size_z: float = 5
+    n_free_cpus: int = 2
+    max_workers: int = 2
+    command: str = "brainreg"
+    extra_args: List[str] = field(default_factory=list)
+
+    @classmethod
+    def load_from_json(cls, path=DEFAULT_CONFIG_PATH):
+        """Load config from json file."""
+        data = load_json_config(path)
+        logger.info("Config loaded from json for brainreg")
+        return cls.from_dict(data)
+
+    def command_line(self, input_path, output_folder):
+        """brainreg command registering input_path into output_folder.
+
+        Only the atlas-space outputs are written: registered_atlas.tiff is reoriented to the scan
+        by the pipeline itself (see BrainRegistration.get_registration_labels).
+        """
+        return [
+            self.command,
+            str(input_path),
+            str(output_folder),
+            "-v",  # see utils.VOXEL_SIZE_AXES
+            str(self.voxel_size_z),
+            str(self.voxel_size_y),
+            str(self.voxel_size_x),
+            "--orientation",
+            self.orientation,
+            "--atlas",
+            self.atlas,
+            "--n-free-cpus",
+            str(self.n_free_cpus),
+        ] + list(self.extra_args)
+
+
+def run_brainreg(input_path, output_folder, config: BrainregConfig):
+    """Registers a scan with brainreg in a subprocess, without any user interaction.
+
+    Each run writes to its own output folder, along with the config used and the brainreg log.
+    If the folder already holds brainreg results, they are reused and brainreg is not run again.
+
+    Args:
+        input_path (str): path to the autofluorescence scan
+        output_folder (str): brainreg output folder, one per registration
+        config (BrainregConfig): brainreg parameters
+
+    Returns:
+        BrainregParams: parameters read from the brainreg.json written by brainreg
+    """
+    output_folder = Path(output_folder)
+    results_path = output_folder / Path("brainreg.json")
+    if (
+        results_path.is_file()
+        and (output_folder / Path("registered_atlas.tiff")).is_file()
+    ):
+        logger.info(f"Reusing brainreg results in {output_folder}")
+        return utils.BrainregParams.load_from_json(str(results_path))
+
+    output_folder.mkdir(parents=True, exist_ok=True)
+    (output_folder / Path("brainreg_config.json")).write_text(
+        config.to_json(indent=2)
+    )
+    command = config.command_line(input_path, output_folder)
+    logger.info(f"Running {' '.join(command)}")
+    with (output_folder / Path("brainreg_log.txt")).open("w") as log:
+        subprocess.run(
+            command, stdout=log, stderr=subprocess.STDOUT, check=True
+        )
+    return utils.BrainregParams.load_from_json(str(results_path))
+
+
+def run_brainreg_batch(jobs, config: BrainregConfig, max_workers=None):
+    """Runs several registrations at once, at most max_workers at a time.
+
+    The atlas is loaded once beforehand, so that it is downloaded at most once and
+    the concurrent runs only read the local copy.
+
+    Args:
+        jobs (list): (input_path, output_folder, config) of each registration, config being None to use the default config
+        config (BrainregConfig): default brainreg parameters
+        max_workers (int): maximum number of brainreg runs at once. Default: None (config.max_workers)
+
+    Returns:
+        list: BrainregParams of each job, or the exception raised by its run
+    """
+    utils.get_atlas(config.atlas)
+    max_workers = config.max_workers if max_workers is None else max_workers
+
+    def run(job):
+        input_path, output_folder, job_config = job
+        try:
+            return run_brainreg(
+                input_path, output_folder, job_config or config
+            )
+        except (subprocess.CalledProcessError, OSError) as e:
+            logger.error(f"brainreg failed on {input_path} : {e}")
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(run, jobs))
@@ -1,19 +1,20 @@
 import logging
 from dataclasses import dataclass
 from datetime import datetime
-from functools import partial
+from functools import lru_cache, partial
 from pathlib import Path
 from typing import List
 
-import bg_space as bgs
 import numpy as np
 from bg_atlasapi import BrainGlobeAtlas
 from cellseg3dmodule.config import load_json_config
+from cellseg3dmodule.resampling import resize_labels
+from cellseg3dmodule.storage import iter_blocks, read_region
 from dask.array.image import imread as dask_imread
 from dataclasses_json import dataclass_json
 from scipy.ndimage import find_objects, label
-from skimage.transform import resize
 from tifffile import imread as tif_imread
+from tifffile import imwrite as tif_imwrite
 from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
@@ -34,7 +35,7 @@ def prepare_roi_cfos(
     """Crops the cFOS scan regions of interest.
 
     Args:
-        roi_ids (List[int]): list of IDs for the region of interest. See get_atlas_ref_df
+        roi_ids (List[int]): list of IDs for the region of interest, each including its sub-regions. See get_atlas_ref_df
         cfos_scan_path (str): path to the cFOS scan for cellseg
         brainreg_labels_path (str): path to the labels from brainreg
         original_orientation (str): 3-characters string containing original orientation of the brain used for brainreg
@@ -45,36 +46,127 @@ def prepare_roi_cfos(
     cFOS = load_volumes(
         cfos_scan_path
     )  # TODO(Cyril) adapt if dims not always 2048x2048
+    labels, atlas_ids = prepare_registration_labels(
+        brainreg_labels_path, original_orientation, atlas, cFOS.shape
+    )
+    return extract_rois(roi_ids, cFOS, labels, atlas_ids, atlas)
+
+
+def prepare_registration_labels(
+    brainreg_labels_path: str,
+    original_orientation: str,
+    atlas: str,
+    volume_shape,
+):
+    """Registered atlas labels reoriented to the scan, compacted and rescaled to the scan shape.
+
+    Args:
+        brainreg_labels_path (str): path to the labels from brainreg
+        original_orientation (str): 3-characters string containing original orientation of the brain used for brainreg
+        atlas (str): atlas name from BrainGlobeAtlas
+        volume_shape (tuple): shape of the scan
+    Returns:
+        tuple: uint16 labels of the scan shape, and the atlas id of each label (see compact_atlas_labels)
+    """
     labels = load_volumes(brainreg_labels_path)
     logger.info(
         f"Loaded labels at {brainreg_labels_path} of shape {labels.shape}"
     )
 
     labels = reorient_volume(
-        labels.compute(),
+        labels,
         source=get_atlas_orientation(atlas),
         target=original_orientation,
     )
+    labels, atlas_ids = compact_atlas_labels(labels)
     logger.info("Rescaling image, please wait...")
-    labels = rescale_labels(labels, cFOS.shape)
+    labels = rescale_labels(labels, volume_shape)
     logger.info("Done")
-    logger.info("Extracting ROIs...")
-    rois_dict = {}
-
-    for roi_id in tqdm(roi_ids):
-        roi_label = get_roi_label(roi_id, labels)
-        roi_image = get_roi_image(cFOS.compute(), roi_label)
-        #############################
-        debug_path = Path.home() / Path("Desktop")
-        np.save(str(debug_path / Path("lab1")), roi_label)
-        np.save(str(debug_path / Path("im1")), roi_image)
-        ############################# # DEBUG TODO REMOVE
-        # roi_image = split_volumes(
-        #     roi_image
-        # )  # TODO(cyril) find optimal way of removing smaller
-        rois_dict[str(roi_id)] = roi_image
-        logger.debug(f"roi shape {roi_image.shape}")
+    return labels, atlas_ids
+
+
+def save_registration_labels(path, labels, tile=(256, 256)):
+    """Writes full resolution registration labels as a zlib-compressed tif, tiled in each plane."""
+    tif_imwrite(path, labels, compression="zlib", tile=tile)
+    return path
+
+
+def roi_bboxes(roi_ids, region_index, atlas):
+    """Bounding box in the scan of each region of interest, including its sub-regions.
 
+    Args:
+        roi_ids (List[int]): list of IDs for the region of interest
+        region_index (scripts.region_index.RegionIndex): index of the registration
+        atlas (str): atlas name from BrainGlobeAtlas
+    Returns:
+        dict: tuple of slices for each ROI id (as str), None for regions absent from the scan
+    """
+    selector = RoiSelector(roi_ids, get_atlas_structures(atlas))
+    return {
+        str(roi_id): region_index.bbox(selector.member_ids(index))
+        for index, roi_id in enumerate(roi_ids, start=1)
+    }
+
+
+def extract_rois(
+    roi_ids,
+    cfos,
+    labels,
+    atlas_ids,
+    atlas,
+    block_size=64,
+    region_index=None,
+):
+    """Crops the cFOS scan regions of interest, reading scan and labels block by block of planes.
+
+    With a region_index, each ROI is read and allocated within its bounding box only (see roi_bboxes),
+    and its volume is cropped to it. Regions absent from the scan are then left out.
+
+    Args:
+        roi_ids (List[int]): list of IDs for the region of interest, each including its sub-regions
+        cfos (array-like): cFOS scan, any array supporting slicing (numpy, dask...)
+        labels: labels from prepare_registration_labels, as an array or the path of a tif saved with save_registration_labels
+        atlas_ids (numpy.ndarray): atlas id of each label
+        atlas (str): atlas name from BrainGlobeAtlas
+        block_size (int): number of planes read at once. Default: 64
+        region_index (scripts.region_index.RegionIndex): index of the registration, or None to extract ROIs
+            with the shape of the scan. Default: None
+    Returns:
+        dict: cFOS scan with only the specified ROI, for each ROI id (as str)
+    """
+    logger.info("Extracting ROIs...")
+    selector = RoiSelector(roi_ids, get_atlas_structures(atlas))
+    # a label can belong to several ROIs, e.g. a region and its parent
+    membership = selector.member_of(atlas_ids)
+
+    if region_index is not None:
+        rois_dict = {}
+        for index, roi_id in enumerate(tqdm(roi_ids)):
+            bbox = region_index.bbox(selector.member_ids(index + 1))
+            if bbox is None:
+                logger.warning(f"Region {roi_id} is not in the scan")
+                continue
+            rois_dict[str(roi_id)] = get_roi_image(
+                read_region(cfos, bbox, block_size),
+                membership[:, index][read_region(labels, bbox, block_size)],
+            )
+        return rois_dict
+
+    rois_dict = {
+        str(roi_id): np.zeros(cfos.shape, dtype=cfos.dtype)
+        for roi_id in roi_ids
+    }
+    start = 0
+    for cfos_block, labels_block in tqdm(
+        zip(iter_blocks(cfos, block_size), iter_blocks(labels, block_size)),
+        total=-(-cfos.shape[0] // block_size),
+    ):
+        end = start + len(cfos_block)
+        for index, roi_id in enumerate(roi_ids):
+            rois_dict[str(roi_id)][start:end] = get_roi_image(
+                cfos_block, membership[:, index][labels_block]
+            )
+        start = end
     return rois_dict
 
 
@@ -98,31 +190,46 @@ def imread_load_raw(x=2048, y=2048):
 
 
 def load_raw(path, x=2048, y=2048):
-    """Load raw image from the mesoSPIM."""
-    vol = np.fromfile(path, dtype=np.unint16, count=-1)
+    """Load raw image from the mesoSPIM, memory-mapped so that planes are only read when used."""
+    vol = np.memmap(path, dtype=np.uint16, mode="r")
     return vol.reshape((-1, x, y))
 
 
+@lru_cache(maxsize=None)
+def get_atlas(atlas: str = "allen_mouse_25um"):
+    """Get a BrainGlobeAtlas from the local cache, loaded once per process.
+
+    The latest version is not checked online, so that the pipeline runs offline once the atlas
+    has been downloaded (the first call downloads it if it is not available locally).
+    """
+    return BrainGlobeAtlas(atlas, check_latest=False)
+
+
 def get_atlas_ref_df(atlas: str = "allen_mouse_25um"):
     """Get reference dataframe from BrainGlobeAtlas as a pandas dataframe."""
-    return BrainGlobeAtlas(atlas).lookup_df  # asr
+    return get_atlas(atlas).lookup_df  # asr
 
 
 def get_atlas_orientation(atlas: str = "allen_mouse_25um"):
     """Get orientation from given atlas."""
-    return BrainGlobeAtlas(atlas).orientation
+    return get_atlas(atlas).orientation
 
 
 def get_atlas_shape(atlas: str = "allen_mouse_25um"):
     """Get shape from given atlas."""
-    return BrainGlobeAtlas(atlas).shape
+    return get_atlas(atlas).shape
+
+
+def get_atlas_structures(atlas: str = "allen_mouse_25um"):
+    """Get the structures (hierarchy, names, acronyms) of the given atlas, indexed by region id."""
+    return get_atlas(atlas).structures
 
 
 def get_atlas_region_name_from_id(
     roi_id: int, atlas: str = "allen_mouse_25um"
 ):
     """Get region name from given atlas and region id."""
-    return BrainGlobeAtlas(atlas).structures[roi_id]["name"]
+    return get_atlas(atlas).structures[roi_id]["name"]
 
 
 def format_roi_name_to_path(roi_name: str):
@@ -139,11 +246,135 @@ def get_roi_label(roi_id, labels):
 
 
 def get_roi_labels(roi_ids, labels):
-    """Get labels for a given list of ids in a label image."""
-    res = np.zeros_like(labels)
-    for roi_id in roi_ids:
-        res += get_roi_label(roi_id, labels)
-    return res
+    """Get labels for a given list of ids in a label image, in a single pass."""
+    return np.where(
+        np.isin(labels, list(roi_ids)), labels, np.zeros_like(labels)
+    )
+
+
+class RoiSelector:
+    """Maps atlas labels to the selected regions containing them, with lookup tables.
+
+    Each selected region is expanded to all of its descendants in the atlas hierarchy, so that
+    e.g. selecting "Isocortex" also selects the layers labelled in the registered atlas.
+    A label can belong to several selected regions, e.g. a region and one of its ancestors:
+    :meth:`roi_mask` gives every voxel of one region, while :meth:`select` builds a single
+    index map in which the most specific selection wins.
+
+    Args:
+        roi_ids (List[int]): selected region ids, region roi_ids[i] gets index i + 1 (0 is unselected)
+        structures: BrainGlobe structures (atlas.structures), see get_atlas_structures.
+            If None, only the given ids themselves are selected.
+    """
+
+    # largest dense table built from label values, bigger ids are looked up by sorted search
+    MAX_LUT_SIZE = 2**24
+
+    def __init__(self, roi_ids, structures=None):
+        self.roi_ids = [int(roi_id) for roi_id in roi_ids]
+        self.dtype = np.min_scalar_type(len(self.roi_ids))
+        selected = {roi_id: i + 1 for i, roi_id in enumerate(self.roi_ids)}
+
+        if structures is None:
+            paths = {roi_id: [roi_id] for roi_id in selected}
+        else:
+            paths = {
+                int(region_id): structure["structure_id_path"]
+                for region_id, structure in structures.items()
+            }
+        # selected ancestors (or the region itself) of each region, from the root down
+        members = {}
+        for region_id, path in paths.items():
+            indices = [selected[a] for a in path if a in selected]
+            if indices:
+                members[region_id] = indices
+        self.atlas_ids = np.array(sorted(members), dtype=np.int64)
+        # deepest selected ancestor, and whether each atlas id belongs to each selected region
+        self.indices = np.array(
+            [members[a][-1] for a in self.atlas_ids.tolist()], dtype=self.dtype
+        )
+        self.membership = np.zeros(
+            (len(self.atlas_ids), len(self.roi_ids)), dtype=bool
+        )
+        for row, region_id in enumerate(self.atlas_ids.tolist()):
+            self.membership[row, np.array(members[region_id]) - 1] = True
+
+    def _find(self, atlas_ids):
+        """Row of each atlas id in self.atlas_ids, and whether it is there."""
+        position = np.searchsorted(self.atlas_ids, atlas_ids)
+        position = np.minimum(position, len(self.atlas_ids) - 1)
+        return position, self.atlas_ids[position] == atlas_ids
+
+    def index_of(self, atlas_ids):
+        """Index of the most specific selected region containing each atlas id, 0 if none."""
+        atlas_ids = np.asarray(atlas_ids)
+        if len(self.atlas_ids) == 0:
+            return np.zeros(atlas_ids.shape, dtype=self.dtype)
+        position, found = self._find(atlas_ids)
+        return np.where(found, self.indices[position], 0).astype(self.dtype)
+
+    def member_of(self, atlas_ids):
+        """Whether each atlas id belongs to each selected region, as a boolean table of shape atlas_ids.shape + (len(roi_ids),)."""
+        atlas_ids = np.asarray(atlas_ids)
+        if len(self.atlas_ids) == 0:
+            return np.zeros(atlas_ids.shape + (len(self.roi_ids),), dtype=bool)
+        position, found = self._find(atlas_ids)
+        return self.membership[position] & found[..., None]
+
+    def member_ids(self, index):
+        """Atlas ids belonging to a selected region, index being i + 1 for roi_ids[i]."""
+        return self.atlas_ids[self.membership[:, index - 1]]
+
+    def lookup_table(self, size):
+        """Dense table giving the region index of every atlas id below size."""
+        lut = np.zeros(size, dtype=self.dtype)
+        below = self.atlas_ids < size
+        lut[self.atlas_ids[below]] = self.indices[below]
+        return lut
+
+    def select(self, labels, atlas_ids=None):
+        """Region index volume of an atlas label volume, computed with a single table lookup.
+
+        Voxels belonging to several selected regions get the index of the most specific one.
+
+        Args:
+            labels (numpy.ndarray): atlas labels (region ids), or dense indices from compact_atlas_labels
+            atlas_ids (numpy.ndarray): if labels are dense indices, the region id of each index. Default: None
+
+        Returns:
+            numpy.ndarray: labels of the same shape, with the index of the selected region containing each voxel
+        """
+        labels = np.asarray(labels)
+        if atlas_ids is not None:
+            return self.index_of(atlas_ids)[labels]
+        max_label = int(labels.max()) if labels.size else 0
+        if max_label >= self.MAX_LUT_SIZE:
+            return self.index_of(labels)
+        return self.lookup_table(max_label + 1)[labels]
+
+    def roi_mask(self, labels, index, atlas_ids=None):
+        """Voxels of an atlas label volume belonging to one selected region, including all of its descendants.
+
+        Unlike :meth:`select`, voxels also belonging to a more specific selected region are kept.
+
+        Args:
+            labels (numpy.ndarray): atlas labels (region ids), or dense indices from compact_atlas_labels
+            index (int): index of the region, i + 1 for roi_ids[i]
+            atlas_ids (numpy.ndarray): if labels are dense indices, the region id of each index. Default: None
+
+        Returns:
+            numpy.ndarray: boolean mask of the same shape as labels
+        """
+        labels = np.asarray(labels)
+        if atlas_ids is not None:
+            return self.member_of(atlas_ids)[:, index - 1][labels]
+        members = self.member_ids(index)
+        max_label = int(labels.max()) if labels.size else 0
+        if max_label >= self.MAX_LUT_SIZE:
+            return np.isin(labels, members)
+        lut = np.zeros(max_label + 1, dtype=bool)
+        lut[members[members <= max_label]] = True
+        return lut[labels]
 
 
 def get_roi_image(volume, region_labels):
@@ -151,16 +382,96 @@ def get_roi_image(volume, region_labels):
     return np.where(region_labels != 0, volume, np.zeros_like(volume))
 
 
+def compact_atlas_labels(labels):
+    """Remaps atlas region ids to a dense uint16 index, keeping background as 0.
+
+    Atlas ids go up to hundreds of millions and need 32 bits, while an atlas only has a
+    few thousand regions. Compacting before rescaling halves the size of full resolution labels.
+
+    Args:
+        labels (numpy.ndarray): atlas labels (region ids)
+
+    Returns:
+        tuple: uint16 index labels, and the region id of each index (atlas_ids[index_labels] gives back the labels)
+    """
+    atlas_ids, index = np.unique(np.asarray(labels), return_inverse=True)
+    if len(atlas_ids) == 0 or atlas_ids[0] != 0:
+        atlas_ids = np.concatenate([[0], atlas_ids]).astype(atlas_ids.dtype)
+        index = index + 1
+    if len(atlas_ids) > np.iinfo(np.uint16).max + 1:
+        raise ValueError(
+            f"{len(atlas_ids)} atlas regions do not fit in a uint16 index"
+        )
+    return index.reshape(np.shape(labels)).astype(np.uint16), atlas_ids
+
+
 def rescale_labels(labels, volume_shape):
-    """Rescale labels to match volume shape."""
-    return resize(
-        labels, volume_shape, order=0, preserve_range=True, anti_aliasing=False
+    """Rescale labels to match volume shape, with nearest-neighbour integer indexing."""
+    return resize_labels(labels, volume_shape)
+
+
+# each axis of an orientation string goes from one end of one of these pairs to the other
+ORIENTATION_AXES = ("ap", "si", "lr")
+
+
+def _orientation_axes(orientation):
+    """Pair of ORIENTATION_AXES of each axis of an orientation string."""
+    pairs = [
+        next((pair for pair in ORIENTATION_AXES if c in pair), "")
+        for c in orientation
+    ]
+    if len(orientation) != 3 or sorted(pairs) != sorted(ORIENTATION_AXES):
+        raise ValueError(f"Invalid orientation {orientation}")
+    return pairs
+
+
+def orientation_mapping(source, target):
+    """Axes permutation and flips mapping a source orientation to a target orientation.
+
+    Orientations are 3-characters strings as in BrainGlobe, e.g. "asr" : the first axis goes
+    from anterior to posterior, the second from superior to inferior, the third from right to left.
+
+    Returns:
+        tuple: target axis i is source axis axes[i], reversed if flips[i]
+    """
+    source_axes = _orientation_axes(source)
+    axes = tuple(source_axes.index(pair) for pair in _orientation_axes(target))
+    flips = tuple(
+        source[axis] != direction for axis, direction in zip(axes, target)
     )
+    return axes, flips
 
 
 def reorient_volume(scan, source="asr", target="sal"):
-    """Reorient volume from source to target orientation."""
-    return bgs.map_stack_to(source, target, scan, copy=False)
+    """Reorient volume from source to target orientation, as a view without any copy.
+
+    Reorientation only permutes and reverses axes : numpy arrays give a strided view,
+    dask arrays stay lazy. Any array supporting transpose and slicing can be used.
+    """
+    axes, flips = orientation_mapping(source, target)
+    return scan.transpose(axes)[
+        tuple(slice(None, None, -1) if flip else slice(None) for flip in flips)
+    ]
+
+
+def reorient_points(points, shape, source="asr", target="sal"):
+    """Maps voxel coordinates from source to target orientation, matching reorient_volume.
+
+    Args:
+        points (numpy.ndarray): (N, 3) coordinates in the source volume
+        shape (tuple): shape of the source volume
+        source (str): orientation of the source volume
+        target (str): orientation of the target volume
+
+    Returns:
+        numpy.ndarray: (N, 3) coordinates p' such that reorient_volume(volume)[p'] is volume[p]
+    """
+    axes, flips = orientation_mapping(source, target)
+    points = np.asarray(points)[:, axes]
+    for target_axis, (axis, flip) in enumerate(zip(axes, flips)):
+        if flip:
+            points[:, target_axis] = shape[axis] - 1 - points[:, target_axis]
+    return points
 
 
 def split_volumes(cFOS_cropped_volume):
@@ -181,6 +492,10 @@ def split_volumes(cFOS_cropped_volume):
     return results[biggest_id]
 
 
+# axis of each voxel size given to and read from brainreg, the axis order of the scan arrays
+VOXEL_SIZE_AXES = ("z", "y", "x")
+
+
 @dataclass_json
 @dataclass
 class BrainregParams:
@@ -200,10 +515,14 @@ class BrainregParams:
         logger.info("Config loaded from json for brainreg results")
 
         data_dict = {
-            "path": data["registration_output_folder"],
-            "voxel_size_x": data["voxel_sizes"][1],
-            "voxel_size_y": data["voxel_sizes"][2],
-            "voxel_size_z": data["voxel_sizes"][0],
+            # napari plugin and command line name the output folder differently
+            "path": data.get(
+                "registration_output_folder", data.get("brainreg_directory")
+            ),
+            # brainreg voxel sizes are in (z, y, x) order, see VOXEL_SIZE_AXES
+            "voxel_size_x": float(data["voxel_sizes"][2]),
+            "voxel_size_y": float(data["voxel_sizes"][1]),
+            "voxel_size_z": float(data["voxel_sizes"][0]),
             "orientation": data["orientation"],
             "atlas": data["atlas"],
         }
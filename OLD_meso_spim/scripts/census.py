@@ -0,0 +1,223 @@
+import logging
+from dataclasses import dataclass
+from itertools import product
+
+import numpy as np
+from cellseg3dmodule.resampling import label_resize_indices
+from cellseg3dmodule.sparse_labels import SparseLabels
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CellCensus:
+    """Cells detected in a whole scan.
+
+    Attributes:
+        centroids (numpy.ndarray): (N, 3) centroid of each cell, in scan voxels
+        volumes (numpy.ndarray): (N,) volume of each cell, in scan voxels
+        region_ids (numpy.ndarray): (N,) atlas id of the region containing each centroid, 0 outside of the brain
+    """
+
+    centroids: np.ndarray
+    volumes: np.ndarray
+    region_ids: np.ndarray = None
+
+    @property
+    def n_cells(self):
+        """Number of detected cells."""
+        return len(self.volumes)
+
+
+def chunk_slices(shape, chunk_size, halo):
+    """Yields (read, core) slices covering a volume chunk by chunk.
+
+    Cores tile the volume without overlap, reads extend each core by halo voxels on every side
+    (clipped to the volume), so that objects crossing a core boundary are seen whole in one chunk.
+    """
+    if np.isscalar(chunk_size):
+        chunk_size = (chunk_size,) * len(shape)
+    starts = [range(0, size, step) for size, step in zip(shape, chunk_size)]
+    for start in product(*starts):
+        core = tuple(
+            slice(s, min(s + step, size))
+            for s, step, size in zip(start, chunk_size, shape)
+        )
+        read = tuple(
+            slice(max(0, c.start - halo), min(size, c.stop + halo))
+            for c, size in zip(core, shape)
+        )
+        yield read, core
+
+
+def segment_scan(
+    volume,
+    inference_worker,
+    method_name,
+    threshold,
+    size_small,
+    chunk_size=256,
+    halo=16,
+    zoom=False,
+):
+    """Segments a whole scan chunk by chunk and returns its cells, without keeping any label volume.
+
+    Each chunk is read with a halo, predicted with the already loaded model (see Inference.predict)
+    and segmented into instances. A cell is kept only by the chunk whose core contains its centroid,
+    so cells crossing chunk boundaries are counted once, as long as they are smaller than the halo.
+
+    With zoom, each chunk is segmented after the anisotropic zoom of Inference.inference, so that size_small
+    and threshold mean the same as for SemanticSegmentation and InstanceSegmentation.
+    Centroids and volumes are then mapped back to scan voxels.
+
+    Args:
+        volume (array-like): whole scan, any array supporting slicing (numpy, memmap, dask...)
+        inference_worker (Inference): worker used to predict each chunk
+        method_name (str): instance segmentation method, see Inference.segment_instances
+        threshold (float): probability threshold
+        size_small (int): objects smaller than this are removed, in voxels of the (zoomed) probabilities
+        chunk_size (int or tuple): size of the chunk cores. Default: 256
+        halo (int): margin read around each core. Default: 16
+        zoom (bool): zoom the probabilities by the zoom of the inference_worker config, one value per
+            axis of the scan (see SemanticSegmentation.get_zoom). Default: False
+
+    Returns:
+        CellCensus: centroids and volumes of all cells, region_ids left to None
+    """
+    centroids = []
+    volumes = []
+    chunks = list(chunk_slices(volume.shape, chunk_size, halo))
+    logger.info(
+        f"Segmenting scan of shape {volume.shape} in {len(chunks)} chunks"
+    )
+    for read, core in tqdm(chunks):
+        chunk = np.asarray(volume[read])
+        probabilities = inference_worker.predict(chunk, zoom=zoom)
+        # scan voxels per voxel of the probabilities, along each axis
+        scale = np.array(chunk.shape) / np.array(probabilities.shape)
+        labels = SparseLabels.from_dense(
+            inference_worker.segment_instances(
+                probabilities, method_name, threshold, size_small
+            )
+        )
+        chunk_volumes, chunk_centroids, _ = labels.moments()
+        chunk_volumes = chunk_volumes * np.prod(scale)
+        chunk_centroids = (chunk_centroids + 0.5) * scale - 0.5
+        chunk_centroids = chunk_centroids + [r.start for r in read]
+        in_core = np.all(
+            (chunk_centroids >= [c.start for c in core])
+            & (chunk_centroids < [c.stop for c in core]),
+            axis=1,
+        )
+        centroids.append(chunk_centroids[in_core])
+        volumes.append(chunk_volumes[in_core])
+    return CellCensus(
+        centroids=np.concatenate(centroids) if centroids else np.zeros((0, 3)),
+        volumes=np.concatenate(volumes) if volumes else np.zeros(0),
+    )
+
+
+def lookup_regions(centroids, registration_labels, scan_shape):
+    """Atlas id at each centroid, without upsampling the registration labels.
+
+    Centroids are mapped to the registration voxel they would be read from in
+    ``resize_labels(registration_labels, scan_shape)``, see label_resize_indices.
+
+    Args:
+        centroids (numpy.ndarray): (N, 3) positions in scan voxels
+        registration_labels (numpy.ndarray): atlas labels in the orientation of the scan, at registration resolution
+        scan_shape (tuple): shape of the scan
+    """
+    indices = []
+    for axis, (in_size, out_size) in enumerate(
+        zip(registration_labels.shape, scan_shape)
+    ):
+        position = np.clip(
+            np.rint(centroids[:, axis]).astype(np.int64), 0, out_size - 1
+        )
+        indices.append(label_resize_indices(in_size, out_size)[position])
+    return np.asarray(registration_labels)[tuple(indices)]
+
+
+def region_voxel_counts(registration_labels, scan_shape):
+    """Number of scan voxels of each atlas region, as in the labels resized to scan_shape.
+
+    Each registration voxel is weighted by the number of scan voxels read from it, so the counts
+    are exact without upsampling the labels.
+
+    Returns:
+        dict: atlas id -> number of scan voxels
+    """
+    registration_labels = np.asarray(registration_labels)
+    weights = np.ones((1,) * registration_labels.ndim)
+    for axis, (in_size, out_size) in enumerate(
+        zip(registration_labels.shape, scan_shape)
+    ):
+        axis_weights = np.bincount(
+            label_resize_indices(in_size, out_size), minlength=in_size
+        )
+        shape = [1] * registration_labels.ndim
+        shape[axis] = in_size
+        weights = weights * axis_weights.reshape(shape)
+    ids, inverse = np.unique(registration_labels, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=weights.ravel())
+    return dict(zip(ids.tolist(), counts.astype(np.int64).tolist()))
+
+
+def roll_up(values, structures):
+    """Sums values of atlas regions into all their ancestors.
+
+    Args:
+        values (dict): atlas id -> value, for the regions labelled in the atlas
+        structures: BrainGlobe structures (atlas.structures), giving the structure_id_path of each region
+
+    Returns:
+        dict: atlas id -> value of the region and all its descendants, for every region with a non-zero total
+    """
+    totals = {}
+    for region_id, value in values.items():
+        if region_id not in structures:
+            continue  # background, outside of the brain
+        for ancestor in structures[region_id]["structure_id_path"]:
+            totals[ancestor] = totals.get(ancestor, 0) + value
+    return totals
+
+
+def census_table(
+    census, registration_labels, scan_shape, voxel_size, structures
+):
+    """Per-region cell count, volume and density, rolled up the atlas hierarchy.
+
+    Args:
+        census (CellCensus): cells with their region_ids
+        registration_labels (numpy.ndarray): atlas labels in the orientation of the scan, at registration resolution
+        scan_shape (tuple): shape of the scan
+        voxel_size (tuple): scan voxel size in microns, along each axis
+        structures: BrainGlobe structures (atlas.structures)
+
+    Returns:
+        list: one dict per region with region_id, acronym, region_name, cell_count, volume_mm3 and density (cells per mm3)
+    """
+    ids, counts = np.unique(census.region_ids, return_counts=True)
+    cell_counts = roll_up(dict(zip(ids.tolist(), counts.tolist())), structures)
+    voxel_counts = roll_up(
+        region_voxel_counts(registration_labels, scan_shape), structures
+    )
+    voxel_volume_mm3 = float(np.prod(voxel_size)) * 1e-9
+
+    rows = []
+    for region_id in sorted(voxel_counts):
+        volume_mm3 = voxel_counts[region_id] * voxel_volume_mm3
+        cell_count = cell_counts.get(region_id, 0)
+        rows.append(
+            {
+                "region_id": int(region_id),
+                "acronym": structures[region_id]["acronym"],
+                "region_name": structures[region_id]["name"],
+                "cell_count": int(cell_count),
+                "volume_mm3": volume_mm3,
+                "density": cell_count / volume_mm3 if volume_mm3 > 0 else 0.0,
+            }
+        )
+    return rows
@@ -0,0 +1,80 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+from cellseg3dmodule.storage import iter_blocks
+from tifffile import TiffFile
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+def downsampling_factors(voxel_size, target_voxel_size):
+    """Integer block size along each axis bringing voxel_size closest to target_voxel_size.
+
+    Args:
+        voxel_size (tuple): voxel size of the scan along each axis, in microns
+        target_voxel_size (tuple): wanted voxel size along each axis, in microns
+    """
+    return tuple(
+        max(1, int(round(target / size)))
+        for size, target in zip(voxel_size, target_voxel_size)
+    )
+
+
+def block_mean(block, factors):
+    """Mean of each block of factors voxels. Incomplete blocks at the end of an axis are averaged over their voxels."""
+    block = np.asarray(block, dtype=np.float32)
+    in_shape = block.shape
+    counts = np.ones((1,) * block.ndim, dtype=np.float32)
+    for axis, factor in enumerate(factors):
+        starts = np.arange(0, in_shape[axis], factor)
+        if factor > 1:
+            block = np.add.reduceat(block, starts, axis=axis)
+        shape = [1] * block.ndim
+        shape[axis] = len(starts)
+        lengths = np.diff(np.append(starts, in_shape[axis]))
+        counts = counts * lengths.reshape(shape)
+    return block / counts
+
+
+def scan_shape(source):
+    """Shape of a scan given as a tif path or an array."""
+    if isinstance(source, (str, Path)):
+        with TiffFile(source) as tif:
+            return tuple(tif.series[0].shape)
+    return tuple(source.shape)
+
+
+def block_mean_downsample(source, factors, slab_size=1, dtype=None):
+    """Downsamples a scan by averaging blocks of voxels, reading it slab by slab.
+
+    Only factors[0] * slab_size planes are in memory at once, so whole-brain scans can be
+    downsampled to registration resolution without being loaded.
+
+    Args:
+        source: path to a multi-page tif, or any array supporting slicing (numpy memmap of a raw file, dask...)
+        factors (tuple): block size along each axis, e.g. from downsampling_factors
+        slab_size (int): number of output planes computed from each slab. Default: 1
+        dtype: output dtype. Default: None (dtype of the scan, rounded if it is an integer dtype)
+
+    Returns:
+        numpy.ndarray: downsampled scan, of shape ceil(shape / factors)
+    """
+    factors = tuple(int(f) for f in factors)
+    shape = scan_shape(source)
+    logger.info(
+        f"Downsampling scan of shape {shape} by {factors} to {tuple(-(-s // f) for s, f in zip(shape, factors))}"
+    )
+    slabs = []
+    for block in tqdm(
+        iter_blocks(source, factors[0] * slab_size),
+        total=-(-shape[0] // (factors[0] * slab_size)),
+    ):
+        if dtype is None:
+            dtype = block.dtype
+        slab = block_mean(block, factors)
+        if np.issubdtype(dtype, np.integer):
+            slab = np.rint(slab)
+        slabs.append(slab.astype(dtype))
+    return np.concatenate(slabs)
@@ -3,6 +3,7 @@ from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
+from cellseg3dmodule.sparse_labels import SparseLabels
 from scripts import brainreg_utils as brg_utils
 
 logging.basicConfig(level=logging.INFO)
@@ -11,11 +12,17 @@ logging.basicConfig(level=logging.INFO)
 def generate_plot(
     image: np.array, filename: str, result_path: str, threshold: float = 0.9
 ):
-    """Generate 3D plot of the cell segmentation."""
-    image[image > threshold] = 1
-    image[image <= threshold] = 0
-    pred3d = image
-    z, x, y = pred3d.nonzero()
+    """Generate 3D plot of the cell segmentation.
+
+    Instance labels can be given as SparseLabels, in which case only the labelled voxels are read.
+    """
+    if isinstance(image, SparseLabels):
+        z, x, y = image.coordinates().T
+    else:
+        image[image > threshold] = 1
+        image[image <= threshold] = 0
+        pred3d = image
+        z, x, y = pred3d.nonzero()
     plt.figure(figsize=(10, 10))
     ax = plt.axes(projection="3d")
     ax.scatter3D(x, y, z, c=z, alpha=1)
@@ -3,7 +3,7 @@ from dataclasses import dataclass
 from pathlib import Path
 
 import numpy as np
-from monai.transforms import AddChannel, RandSpatialCrop
+from cellseg3dmodule.sparse_labels import SparseLabels
 from schema.utils import gitWrapper, spim_sendEmail
 from scripts.generate_cell_plot import generate_plot
 
@@ -20,7 +20,7 @@ class Report:
     roi_name: str
     results_path: str
     stats_summary: dict
-    labels: np.array
+    labels: SparseLabels
 
     def send_report(self):
         """Send report to user."""
@@ -49,6 +49,15 @@ class Report:
             w = csv.writer(f)
             w.writerows(self.stats_summary.items())
 
+    def random_crop(self, crop_size):
+        """Random dense crop of the labels, only decoding the objects inside it."""
+        rng = np.random.default_rng()
+        window = []
+        for size, crop in zip(self.labels.shape, crop_size):
+            start = rng.integers(0, max(size - crop, 0) + 1)
+            window.append(slice(start, start + crop))
+        return self.labels.to_dense(window=tuple(window))
+
     def stats_report(self):
         """Generate human-readable stats report for user."""
         msg_body = (
@@ -66,12 +75,6 @@ class Report:
 
         # csv = self.image_stats.get_dict()
 
-        labels = AddChannel()(self.labels)
-        samples = [
-            np.squeeze(
-                RandSpatialCrop([16, 16, 16], random_size=False)(labels)
-            )
-            for i in range(5)
-        ]
+        samples = [self.random_crop([16, 16, 16]) for i in range(5)]
 
         return msg_body, samples
@@ -0,0 +1,205 @@
+import logging
+from dataclasses import dataclass
+from itertools import product
+from typing import Tuple
+
+import numpy as np
+from cellseg3dmodule.resampling import label_resize_indices
+from scipy.ndimage import find_objects
+
+logger = logging.getLogger(__name__)
+
+
+def scan_ranges(in_size, out_size):
+    """For each registration index, the [start, stop) range of scan indices read from it.
+
+    Uses the nearest-neighbour mapping of ``resize_labels``, see label_resize_indices.
+    The range is empty for registration indices that no scan index reads from.
+    """
+    source = label_resize_indices(in_size, out_size)
+    indices = np.arange(in_size)
+    return (
+        np.searchsorted(source, indices, side="left"),
+        np.searchsorted(source, indices, side="right"),
+    )
+
+
+@dataclass
+class RegionIndex:
+    """Spatial index of the atlas regions of a registration, in scan voxels.
+
+    For every region labelled in the registered atlas, stores its exact bounding box in the scan
+    and the chunks of a regular grid that contain at least one of its voxels, so that a region can
+    be cropped or segmented by reading only these chunks.
+    Chunk lists are stored as in a CSR matrix, chunks of region k being chunks[offsets[k]:offsets[k+1]].
+
+    Attributes:
+        shape (tuple): shape of the scan
+        chunk_size (tuple): size of the chunks along each axis
+        region_ids (numpy.ndarray): (K,) atlas ids, sorted
+        bboxes (numpy.ndarray): (K, 2 * ndim) bounding box of each region, as (min_0, ..., min_n, max_0, ..., max_n) with exclusive max
+        offsets (numpy.ndarray): (K+1,) offsets of the chunks of each region
+        chunks (numpy.ndarray): flat index of each chunk in the grid, sorted for each region
+    """
+
+    shape: Tuple[int, ...]
+    chunk_size: Tuple[int, ...]
+    region_ids: np.ndarray
+    bboxes: np.ndarray
+    offsets: np.ndarray
+    chunks: np.ndarray
+
+    @classmethod
+    def build(cls, registration_labels, scan_shape, chunk_size=256):
+        """Builds the index from atlas labels at registration resolution, without upsampling them.
+
+        Gives the same result as indexing ``resize_labels(registration_labels, scan_shape)``.
+
+        Args:
+            registration_labels (numpy.ndarray): atlas labels in the orientation of the scan, at registration resolution
+            scan_shape (tuple): shape of the scan
+            chunk_size (int or tuple): size of the chunks along each axis. Default: 256
+        """
+        labels = np.asarray(registration_labels)
+        scan_shape = tuple(int(s) for s in scan_shape)
+        if np.isscalar(chunk_size):
+            chunk_size = (chunk_size,) * labels.ndim
+        chunk_size = tuple(int(c) for c in chunk_size)
+        grid_shape = tuple(-(-s // c) for s, c in zip(scan_shape, chunk_size))
+
+        # registration voxels actually read by the scan, with their scan ranges
+        used, starts, stops = [], [], []
+        for in_size, out_size in zip(labels.shape, scan_shape):
+            start, stop = scan_ranges(in_size, out_size)
+            axis_used = np.flatnonzero(stop > start)
+            used.append(axis_used)
+            starts.append(start[axis_used])
+            stops.append(stop[axis_used])
+        region_ids, index = np.unique(
+            labels[np.ix_(*used)], return_inverse=True
+        )
+        index = index.reshape([len(u) for u in used]) + 1
+        if len(region_ids) and region_ids[0] == 0:  # background is not indexed
+            region_ids = region_ids[1:]
+            index -= 1
+
+        bboxes = np.zeros((len(region_ids), 2 * labels.ndim), dtype=np.int64)
+        for k, location in enumerate(find_objects(index)):
+            for axis, axis_slice in enumerate(location):
+                bboxes[k, axis] = starts[axis][axis_slice.start]
+                bboxes[k, labels.ndim + axis] = stops[axis][
+                    axis_slice.stop - 1
+                ]
+
+        # registration voxels overlapping each chunk, along each axis
+        axis_blocks = []
+        for axis, c in enumerate(chunk_size):
+            bounds = np.arange(grid_shape[axis] + 1) * c
+            axis_blocks.append(
+                [
+                    slice(
+                        np.searchsorted(stops[axis], low, side="right"),
+                        np.searchsorted(starts[axis], high, side="left"),
+                    )
+                    for low, high in zip(bounds[:-1], bounds[1:])
+                ]
+            )
+        region_rows, chunk_ids = [], []
+        for chunk_id, block in enumerate(product(*axis_blocks)):
+            present = np.unique(index[block])
+            present = present[present > 0] - 1
+            region_rows.append(present)
+            chunk_ids.append(np.full(len(present), chunk_id, dtype=np.int64))
+        region_rows = np.concatenate(region_rows)
+        chunk_ids = np.concatenate(chunk_ids)
+        order = np.lexsort((chunk_ids, region_rows))
+        offsets = np.searchsorted(
+            region_rows[order], np.arange(len(region_ids) + 1)
+        )
+        logger.debug(
+            f"Indexed {len(region_ids)} regions in {np.prod(grid_shape)} chunks"
+        )
+        return cls(
+            shape=scan_shape,
+            chunk_size=chunk_size,
+            region_ids=region_ids,
+            bboxes=bboxes,
+            offsets=offsets.astype(np.int64),
+            chunks=chunk_ids[order],
+        )
+
+    @property
+    def grid_shape(self):
+        """Number of chunks along each axis."""
+        return tuple(-(-s // c) for s, c in zip(self.shape, self.chunk_size))
+
+    def _rows(self, region_ids):
+        region_ids = np.atleast_1d(np.asarray(region_ids))
+        rows = np.searchsorted(self.region_ids, region_ids)
+        rows = rows[rows < len(self.region_ids)]
+        return rows[np.isin(self.region_ids[rows], region_ids)]
+
+    def bbox(self, region_ids):
+        """Bounding box of the union of the given regions, as a tuple of slices. None if none is in the scan.
+
+        Args:
+            region_ids (int or List[int]): atlas ids. Parent regions are not labelled in the atlas,
+                use e.g. RoiSelector(roi_ids, structures).atlas_ids to include their descendants
+        """
+        rows = self._rows(region_ids)
+        if len(rows) == 0:
+            return None
+        ndim = len(self.shape)
+        low = self.bboxes[rows, :ndim].min(axis=0)
+        high = self.bboxes[rows, ndim:].max(axis=0)
+        return tuple(slice(int(lo), int(hi)) for lo, hi in zip(low, high))
+
+    def chunk_ids(self, region_ids):
+        """Flat index of the chunks containing at least one voxel of the given regions."""
+        rows = self._rows(region_ids)
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(
+            np.concatenate(
+                [
+                    self.chunks[self.offsets[row] : self.offsets[row + 1]]
+                    for row in rows
+                ]
+            )
+        )
+
+    def chunk_slices(self, region_ids):
+        """Slices of the chunks containing at least one voxel of the given regions, clipped to the scan."""
+        positions = np.unravel_index(
+            self.chunk_ids(region_ids), self.grid_shape
+        )
+        return [
+            tuple(
+                slice(p * c, min((p + 1) * c, s))
+                for p, c, s in zip(position, self.chunk_size, self.shape)
+            )
+            for position in zip(*[p.tolist() for p in positions])
+        ]
+
+    def to_dict(self):
+        """Serializable form, e.g. to store in a DataJoint blob attribute."""
+        return {
+            "shape": np.array(self.shape, dtype=np.int64),
+            "chunk_size": np.array(self.chunk_size, dtype=np.int64),
+            "region_ids": self.region_ids,
+            "bboxes": self.bboxes,
+            "offsets": self.offsets,
+            "chunks": self.chunks,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuilds a RegionIndex from :meth:`to_dict`."""
+        return cls(
+            shape=tuple(int(s) for s in data["shape"]),
+            chunk_size=tuple(int(c) for c in data["chunk_size"]),
+            region_ids=np.asarray(data["region_ids"]),
+            bboxes=np.asarray(data["bboxes"], dtype=np.int64),
+            offsets=np.asarray(data["offsets"], dtype=np.int64),
+            chunks=np.asarray(data["chunks"], dtype=np.int64),
+        )
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from skimage.measure import label
+
+from cellseg3dmodule.component_tree import ComponentTree
+
+
+def _remove_small(labels, min_size):
+    sizes = np.bincount(labels.ravel())
+    small = sizes < min_size
+    small[0] = False
+    labels = labels.copy()
+    labels[small[labels]] = 0
+    return labels
+
+
+def assert_same_partition(labels, expected):
+    """Same objects, up to the order of the label ids."""
+    np.testing.assert_array_equal(labels > 0, expected > 0)
+    pairs = np.unique(np.stack([labels.ravel(), expected.ravel()]), axis=1)
+    assert (
+        len(np.unique(pairs[0])) == len(np.unique(pairs[1])) == len(pairs[0])
+    )
+
+
+@pytest.mark.parametrize("threshold", [0.3, 0.5, 0.62, 0.8, 1.0])
+@pytest.mark.parametrize("min_size", [0, 3, 10])
+def test_label_matches_connected_components(threshold, min_size):
+    rng = np.random.default_rng(0)
+    probabilities = rng.random((12, 14, 16)).astype(np.float32)
+    tree = ComponentTree(probabilities)
+    expected = _remove_small(label(probabilities > threshold), min_size)
+    labels = tree.label(threshold, min_size)
+    assert_same_partition(labels, expected)
+    # labels are sequential
+    assert labels.max() == len(np.unique(labels[labels > 0]))
+
+
+def test_sweep_matches_label():
+    probabilities = np.random.default_rng(1).random((8, 9, 10))
+    tree = ComponentTree(probabilities, connectivity=1)
+    for (threshold, min_size), labels in tree.sweep((0.4, 0.7), (0, 5)):
+        expected = _remove_small(
+            label(probabilities > threshold, connectivity=1), min_size
+        )
+        assert_same_partition(labels, expected)
@@ -0,0 +1,63 @@
+import numpy as np
+
+from cellseg3dmodule.evaluate_semantic import (
+    SemanticEvaluator,
+    _confusion_counts,
+    semantic_metrics,
+    threshold_curve,
+)
+from cellseg3dmodule.storage import encode_probabilities, save_probabilities
+
+
+def _volumes(seed=0, shape=(20, 16, 16)):
+    rng = np.random.default_rng(seed)
+    return rng.random(shape).astype(np.float32), rng.random(shape) > 0.5
+
+
+def test_uint8_mask_matches_bool_mask():
+    probabilities, target = _volumes()
+    mask = probabilities > 0.5
+    from_uint8 = SemanticEvaluator().evaluate(mask.astype(np.uint8), target)
+    from_bool = SemanticEvaluator().evaluate(mask, target)
+    assert from_bool["tp"][0] > 0
+    for name in ("tp", "fp", "fn", "tn"):
+        np.testing.assert_array_equal(from_uint8[name], from_bool[name])
+
+
+def test_encoded_probabilities_are_decoded(tmp_path):
+    probabilities, target = _volumes()
+    thresholds = (0.25, 0.5, 0.75)
+    expected = SemanticEvaluator(thresholds).evaluate(probabilities, target)
+    encoded = SemanticEvaluator(thresholds).evaluate(
+        encode_probabilities(probabilities, "float16"),
+        target,
+        codec="float16",
+    )
+    path = save_probabilities(tmp_path / "p.tif", probabilities, "float32")
+    from_file = SemanticEvaluator(thresholds).evaluate(str(path), target)
+    np.testing.assert_allclose(encoded["iou"], expected["iou"], atol=1e-3)
+    np.testing.assert_array_equal(from_file["tp"], expected["tp"])
+
+
+def test_threshold_curve_matches_threshold_loop():
+    probabilities, target = _volumes(1)
+    # unsorted, repeated and exact voxel values, compared with ``>``
+    thresholds = [0.7, 0.1, 0.5, 0.5, float(probabilities[3, 4, 5]), 1.0]
+    curve = threshold_curve(probabilities, target, thresholds, chunk_size=7)
+    for k, threshold in enumerate(thresholds):
+        tp, fp, fn = _confusion_counts(target, probabilities > threshold)
+        assert (curve["tp"][k], curve["fp"][k], curve["fn"][k]) == (tp, fp, fn)
+        assert curve["tn"][k] == target.size - tp - fp - fn
+        for name, value in semantic_metrics(tp, fp, fn).items():
+            np.testing.assert_allclose(curve[name][k], value)
+
+
+def test_evaluate_block_by_block_matches_whole_volume():
+    probabilities, target = _volumes(2)
+    thresholds = np.linspace(0, 1, 11)
+    whole = SemanticEvaluator(thresholds).update(probabilities, target)
+    blocks = SemanticEvaluator(thresholds).evaluate(
+        probabilities, target, chunk_size=3
+    )
+    for name in ("tp", "fp", "fn", "tn"):
+        np.testing.assert_array_equal(whole.metrics()[name], blocks[name])
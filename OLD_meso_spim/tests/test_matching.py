@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from cellseg3dmodule.matching import (
+    label_overlap,
+    matching,
+    sparse_assignment,
+    sparse_label_overlap,
+)
+
+
+def _labels(seed, shape=(10, 24, 24), n_objects=40):
+    """Random boxes, later boxes overwriting earlier ones."""
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype=np.int32)
+    for i in range(1, n_objects + 1):
+        start = [rng.integers(0, s - 3) for s in shape]
+        size = [rng.integers(2, 6) for _ in shape]
+        labels[tuple(slice(a, a + b) for a, b in zip(start, size))] = i
+    return labels
+
+
+def test_sparse_label_overlap_matches_dense():
+    x, y = _labels(0), _labels(1)
+    x_ids, y_ids, counts, x_sizes, y_sizes = sparse_label_overlap(x, y)
+    dense = label_overlap(x, y, check=False)
+    sparse = np.zeros_like(dense)
+    sparse[x_ids, y_ids] = counts
+    np.testing.assert_array_equal(sparse[1:, 1:], dense[1:, 1:])
+    np.testing.assert_array_equal(x_sizes, dense.sum(axis=1))
+    np.testing.assert_array_equal(y_sizes, dense.sum(axis=0))
+
+
+@pytest.mark.parametrize("criterion", ["iou", "iot", "iop"])
+def test_sparse_matching_matches_dense(criterion):
+    y_true, y_pred = _labels(2), _labels(2)
+    # shift the prediction, so that some objects overlap partially
+    y_pred = np.roll(y_pred, 1, axis=1)
+    y_pred[_labels(3) == 5] = 100
+    thresholds = (0.1, 0.3, 0.5, 0.7)
+    dense = matching(
+        y_true, y_pred, thresh=thresholds, criterion=criterion, sparse=False
+    )
+    sparse = matching(
+        y_true, y_pred, thresh=thresholds, criterion=criterion, sparse=True
+    )
+    for d, s in zip(dense, sparse):
+        assert (d.tp, d.fp, d.fn) == (s.tp, s.fp, s.fn)
+        assert np.isclose(d.mean_matched_score, s.mean_matched_score)
+
+
+def _max_matching(true_ind, pred_ind):
+    """Size of a maximum matching of a small bipartite graph, by brute force."""
+    pairs = list(zip(true_ind.tolist(), pred_ind.tolist()))
+    best = 0
+
+    def extend(start, used_true, used_pred, size):
+        nonlocal best
+        best = max(best, size)
+        for k in range(start, len(pairs)):
+            t, p = pairs[k]
+            if t not in used_true and p not in used_pred:
+                extend(k + 1, used_true | {t}, used_pred | {p}, size + 1)
+
+    extend(0, frozenset(), frozenset(), 0)
+    return best
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_sparse_assignment_is_maximal(seed):
+    rng = np.random.default_rng(seed)
+    n_pairs = 12
+    true_ind = rng.integers(0, 6, n_pairs)
+    pred_ind = rng.integers(0, 6, n_pairs)
+    keys = np.unique(true_ind * 6 + pred_ind)
+    true_ind, pred_ind = keys // 6, keys % 6
+    scores = rng.random(len(keys))
+    thresh = 0.3
+    assigned_true, assigned_pred, assigned_scores = sparse_assignment(
+        true_ind, pred_ind, scores, thresh, n_matched=6
+    )
+    # a valid matching of candidate pairs
+    assert len(set(assigned_true.tolist())) == len(assigned_true)
+    assert len(set(assigned_pred.tolist())) == len(assigned_pred)
+    assert np.all(assigned_scores >= thresh)
+    candidates = scores >= thresh
+    assert len(assigned_true) == _max_matching(
+        true_ind[candidates], pred_ind[candidates]
+    )
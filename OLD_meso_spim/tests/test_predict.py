@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("monai")
+
+from cellseg3dmodule.config import (  # noqa: E402
+    InferenceWorkerConfig,
+    PostProcessConfig,
+    Zoom,
+)
+from cellseg3dmodule.predict import Inference  # noqa: E402
+
+ZOOM_VALUES = [0.5, 1.0, 0.75]
+
+
+def _worker(results_path, **zoom):
+    config = InferenceWorkerConfig(
+        results_path=results_path,
+        post_process_config=PostProcessConfig(
+            zoom=Zoom(zoom_values=ZOOM_VALUES, **zoom)
+        ),
+    )
+    return Inference(config)
+
+
+def _image():
+    return torch.rand(
+        1, 1, 20, 24, 16, generator=torch.Generator().manual_seed(0)
+    )
+
+
+def test_tiled_memmap_zoom_matches_monai_zoom(tmp_path):
+    expected = np.asarray(_worker(str(tmp_path)).aniso_transform(_image()))
+    tiled = _worker(
+        str(tmp_path), tiled=True, tile_size=8, memmap=True
+    ).aniso_transform(_image())
+    assert tiled.shape == expected.shape
+    np.testing.assert_allclose(np.asarray(tiled), expected, atol=1e-5)
+
+
+def test_tiled_memmap_zoom_without_path_results_path(tmp_path):
+    # e.g. a PathConfig, the default temporary directory is used
+    results_path = SimpleNamespace(file_storage=str(tmp_path))
+    tiled = _worker(
+        results_path, tiled=True, tile_size=8, memmap=True
+    ).aniso_transform(_image())
+    expected = np.asarray(_worker(str(tmp_path)).aniso_transform(_image()))
+    np.testing.assert_allclose(np.asarray(tiled), expected, atol=1e-5)
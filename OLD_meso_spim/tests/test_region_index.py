@@ -0,0 +1,74 @@
+from itertools import product
+
+import numpy as np
+import pytest
+
+from cellseg3dmodule.resampling import resize_labels
+from scripts.region_index import RegionIndex
+
+
+def _registration_labels(seed=0, shape=(9, 11, 10)):
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype=np.uint32)
+    for region_id in (7, 45, 1000, 600_000_000):
+        start = [rng.integers(0, s - 2) for s in shape]
+        size = [rng.integers(1, 5) for _ in shape]
+        labels[tuple(slice(a, a + b) for a, b in zip(start, size))] = region_id
+    return labels
+
+
+def _brute_force(labels, chunk_size):
+    """Bounding box and chunks of each region, from the full resolution labels."""
+    grid = [range(0, s, chunk_size) for s in labels.shape]
+    bboxes, chunks = {}, {}
+    for region_id in np.unique(labels[labels > 0]).tolist():
+        coordinates = np.argwhere(labels == region_id)
+        bboxes[region_id] = tuple(
+            slice(int(low), int(high) + 1)
+            for low, high in zip(coordinates.min(0), coordinates.max(0))
+        )
+        chunks[region_id] = [
+            chunk_id
+            for chunk_id, start in enumerate(product(*grid))
+            if np.any(
+                labels[tuple(slice(s, s + chunk_size) for s in start)]
+                == region_id
+            )
+        ]
+    return bboxes, chunks
+
+
+@pytest.mark.parametrize("scan_shape", [(30, 25, 41), (6, 11, 5)])
+def test_build_matches_full_resolution_labels(scan_shape):
+    labels = _registration_labels()
+    chunk_size = 8
+    index = RegionIndex.build(labels, scan_shape, chunk_size)
+    bboxes, chunks = _brute_force(
+        resize_labels(labels, scan_shape), chunk_size
+    )
+    assert index.region_ids.tolist() == sorted(bboxes)
+    for region_id in bboxes:
+        assert index.bbox(region_id) == bboxes[region_id]
+        assert index.chunk_ids(region_id).tolist() == chunks[region_id]
+
+
+def test_union_and_round_trip():
+    labels = _registration_labels(1)
+    scan_shape = (20, 22, 20)
+    index = RegionIndex.build(labels, scan_shape, 8)
+    full = resize_labels(labels, scan_shape)
+    region_ids = index.region_ids[:2]
+    mask = np.isin(full, region_ids)
+    bbox = index.bbox(region_ids)
+    assert mask[bbox].sum() == mask.sum()
+    # every voxel of the regions is in one of their chunks
+    covered = np.zeros(scan_shape, dtype=bool)
+    for chunk in index.chunk_slices(region_ids):
+        covered[chunk] = True
+    assert np.all(covered[mask])
+    assert index.bbox([12345]) is None
+
+    restored = RegionIndex.from_dict(index.to_dict())
+    assert restored.shape == index.shape
+    assert restored.bbox(region_ids) == bbox
+    np.testing.assert_array_equal(restored.chunks, index.chunks)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from skimage.segmentation import relabel_sequential as skimage_relabel
+
+from cellseg3dmodule.relabel import label_are_sequential, relabel_sequential
+
+
+@pytest.mark.parametrize("offset", [1, 5])
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int32, np.int64])
+def test_relabel_sequential_matches_skimage(offset, dtype):
+    rng = np.random.default_rng(0)
+    ids = np.array([0, 3, 7, 40, 90, 120], dtype=dtype)
+    labels = rng.choice(ids, size=(6, 7, 8))
+    expected, expected_forward, expected_inverse = skimage_relabel(
+        labels, offset=offset
+    )
+    relabeled, forward_map, inverse_map = relabel_sequential(
+        labels, offset=offset
+    )
+    np.testing.assert_array_equal(relabeled, expected)
+    assert relabeled.dtype == expected.dtype
+    np.testing.assert_array_equal(forward_map[ids], expected_forward[ids])
+    np.testing.assert_array_equal(inverse_map, np.asarray(expected_inverse))
+
+
+def test_relabel_sequential_overflowing_dtype():
+    labels = (np.arange(300, dtype=np.uint16) * 2).reshape(10, 30)
+    relabeled, _, _ = relabel_sequential(labels, out_dtype="min")
+    assert relabeled.dtype == np.uint16
+    np.testing.assert_array_equal(relabeled, skimage_relabel(labels)[0])
+
+
+def test_sequential_labels_are_returned_as_is():
+    labels = np.array([[0, 1, 2], [3, 2, 1]], dtype=np.uint8)
+    assert label_are_sequential(labels)
+    assert relabel_sequential(labels)[0] is labels
+
+
+def test_relabel_in_place():
+    labels = np.array([[0, 10, 10], [4, 0, 10]], dtype=np.int32)
+    expected = skimage_relabel(labels)[0]
+    relabeled, _, _ = relabel_sequential(labels, in_place=True)
+    assert relabeled is labels
+    np.testing.assert_array_equal(labels, expected)
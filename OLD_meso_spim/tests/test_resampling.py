@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from skimage.transform import resize
+
+from cellseg3dmodule.resampling import label_resize_indices, resize_labels
+
+
+@pytest.mark.parametrize(
+    "in_shape, out_shape",
+    [
+        ((7, 9, 11), (7, 9, 11)),
+        ((7, 9, 11), (20, 31, 13)),
+        ((20, 31, 13), (7, 9, 11)),
+        ((5, 17, 8), (13, 6, 29)),
+    ],
+)
+def test_resize_labels_matches_skimage(in_shape, out_shape):
+    labels = np.random.default_rng(0).integers(
+        0, 700_000_000, in_shape, dtype=np.uint32
+    )
+    expected = resize(
+        labels,
+        out_shape,
+        order=0,
+        preserve_range=True,
+        anti_aliasing=False,
+    ).astype(labels.dtype)
+    resized = resize_labels(labels, out_shape, slab_size=4)
+    assert resized.dtype == labels.dtype
+    np.testing.assert_array_equal(resized, expected)
+
+
+def test_resize_labels_into_out():
+    labels = np.arange(24, dtype=np.uint16).reshape(2, 3, 4)
+    out = np.zeros((5, 6, 7), dtype=np.uint16)
+    assert resize_labels(labels, out.shape, out=out) is out
+    np.testing.assert_array_equal(out, resize_labels(labels, out.shape))
+
+
+@pytest.mark.parametrize("in_size, out_size", [(10, 3), (3, 10), (7, 7)])
+def test_label_resize_indices_matches_skimage(in_size, out_size):
+    expected = resize(
+        np.arange(in_size, dtype=np.float64),
+        (out_size,),
+        order=0,
+        preserve_range=True,
+        anti_aliasing=False,
+    ).astype(np.int64)
+    np.testing.assert_array_equal(
+        label_resize_indices(in_size, out_size), expected
+    )